@@ -25,20 +25,42 @@ key-value pairs:
 | central_freqs   | 1d array of shape n containing the central frequencies of |
 |                 | the filters                                               |
 +-----------------+-----------------------------------------------------------+
+| shape           | the shape (M, N) of the input fields                      |
++-----------------+-----------------------------------------------------------+
 
 where r = int(max(N, M)/2)+1
 
 The filter weights are assumed to be normalized so that for any Fourier
 wavenumber they sum to one.
 
+If the filter method is called with compact=True, the dense weights_2d array
+is not computed. Instead, the filter contains the following key-value pairs in
+addition to weights_1d, central_freqs and shape:
+
+.. tabularcolumns:: |p{1.8cm}|L|
+
++-----------------+-----------------------------------------------------------+
+|       Key       |                Value                                      |
++=================+===========================================================+
+| compact         | True                                                      |
++-----------------+-----------------------------------------------------------+
+| weights_radial  | 2d array of shape (n, u) containing the filter weights    |
+|                 | for the u distinct wavenumber radii of the grid           |
++-----------------+-----------------------------------------------------------+
+| radius_index    | 2d integer array of shape (M, int(N/2)+1) mapping each    |
+|                 | wavenumber of the rfft2 half-spectrum to the columns of   |
+|                 | weights_radial                                            |
++-----------------+-----------------------------------------------------------+
+
+The 2d weights of a frequency band are then materialized with a gather when
+they are needed. The function get_weights_2d returns the 2d weights of a band
+for both types of filters.
+
 """
 
 import numpy as np
 
-# TODO: Should the filter always return an 1d array and should we use a separate
-# method for generating the 2d filter from the 1d filter?
-
-def filter_uniform(shape, n):
+def filter_uniform(shape, n, compact=False):
     """A dummy filter with one frequency band covering the whole domain. The
     weights are set to one.
 
@@ -49,6 +71,8 @@ def filter_uniform(shape, n):
         it assumes to be a square domain.
     n : int
         Not used. Needed for compatibility with the filter interface.
+    compact : bool
+        If True, return a compact filter without the weights_2d array.
 
     """
     result = {}
@@ -61,12 +85,19 @@ def filter_uniform(shape, n):
     r_max = int(max(N, M)/2)+1
 
     result["weights_1d"]    = np.ones((1, r_max))
-    result["weights_2d"]    = np.ones((1, M, N))
+    if not compact:
+        result["weights_2d"] = np.ones((1, M, N))
+    else:
+        result["compact"]        = True
+        result["weights_radial"] = np.ones((1, 1))
+        result["radius_index"]   = np.broadcast_to(np.int32(0), (M, int(N/2)+1))
     result["central_freqs"] = None
+    result["shape"]         = (M, N)
 
     return result
 
-def filter_gaussian(shape, n, l_0=3, gauss_scale=0.5, gauss_scale_0=0.5):
+def filter_gaussian(shape, n, l_0=3, gauss_scale=0.5, gauss_scale_0=0.5,
+                    compact=False):
     """Implements a set of Gaussian band-pass filters in logarithmic frequency
     scale.
 
@@ -86,6 +117,9 @@ def filter_gaussian(shape, n, l_0=3, gauss_scale=0.5, gauss_scale_0=0.5):
     gauss_scale_0 : float
         Optional scaling parameter for the Gaussian function corresponding to
         the first frequency band.
+    compact : bool
+        If True, return a compact filter where the weights are stored only for
+        the distinct wavenumber radii instead of the dense weights_2d array.
 
     Returns
     -------
@@ -106,19 +140,6 @@ def filter_gaussian(shape, n, l_0=3, gauss_scale=0.5, gauss_scale_0=0.5):
     except TypeError:
         M,N = (shape, shape)
 
-    if N % 2 == 1:
-        rx = np.s_[-int(N/2):int(N/2)+1]
-    else:
-        rx = np.s_[-int(N/2):int(N/2)]
-
-    if M % 2 == 1:
-        ry = np.s_[-int(M/2):int(M/2)+1]
-    else:
-        ry = np.s_[-int(M/2):int(M/2)]
-
-    Y,X = np.ogrid[ry, rx]
-    R = np.sqrt(X*X + Y*Y)
-
     L = max(N, M)
     r_max = int(L/2)+1
     r = np.arange(r_max)
@@ -127,25 +148,103 @@ def filter_gaussian(shape, n, l_0=3, gauss_scale=0.5, gauss_scale_0=0.5):
                                gauss_scale_0=gauss_scale_0)
 
     w = np.empty((n, r_max))
-    W = np.empty((n, M, N))
-
     for i,wf in enumerate(wfs):
         w[i, :] = wf(r)
-        W[i, :, :] = wf(R)
-
     w_sum = np.sum(w, axis=0)
-    W_sum = np.sum(W, axis=0)
-    for k in range(W.shape[0]):
-        w[k, :]    /= w_sum
-        W[k, :, :] /= W_sum
+    for k in range(w.shape[0]):
+        w[k, :] /= w_sum
 
     result = {}
-    result["weights_1d"]    = w
-    result["weights_2d"]    = W
+    result["weights_1d"] = w
+
+    if not compact:
+        if N % 2 == 1:
+            rx = np.s_[-int(N/2):int(N/2)+1]
+        else:
+            rx = np.s_[-int(N/2):int(N/2)]
+
+        if M % 2 == 1:
+            ry = np.s_[-int(M/2):int(M/2)+1]
+        else:
+            ry = np.s_[-int(M/2):int(M/2)]
+
+        Y,X = np.ogrid[ry, rx]
+        R = np.sqrt(X*X + Y*Y)
+
+        W = np.empty((n, M, N))
+        for i,wf in enumerate(wfs):
+            W[i, :, :] = wf(R)
+        W_sum = np.sum(W, axis=0)
+        for k in range(W.shape[0]):
+            W[k, :, :] /= W_sum
+
+        result["weights_2d"] = W
+    else:
+        # the squared wavenumber radii of the rfft2 half-spectrum are integers,
+        # so the weights need to be computed only for their distinct values
+        ky = np.fft.fftfreq(M, 1.0/M).round().astype(np.int64)
+        kx = np.arange(int(N/2)+1, dtype=np.int64)
+        R2 = ky[:, None]*ky[:, None] + kx[None, :]*kx[None, :]
+        R2_u,R2_idx = np.unique(R2, return_inverse=True)
+        R_u = np.sqrt(R2_u)
+
+        W = np.empty((n, len(R_u)))
+        for i,wf in enumerate(wfs):
+            W[i, :] = wf(R_u)
+        W /= np.sum(W, axis=0)
+
+        result["compact"]        = True
+        result["weights_radial"] = W
+        result["radius_index"]   = R2_idx.reshape(R2.shape).astype(np.int32)
+
     result["central_freqs"] = np.array(cfs)
+    result["shape"]         = (M, N)
 
     return result
 
+def get_weights_2d(filter, k, half_spectrum=False):
+    """Return the 2d weights of a frequency band of the given filter.
+
+    Parameters
+    ----------
+    filter : dict
+        A filter returned by any method implemented in this module. Both dense
+        and compact filters are accepted.
+    k : int
+        Index of the frequency band.
+    half_spectrum : bool
+        If False, return the weights for the centered (fftshifted) full
+        spectrum of shape (M,N), i.e. the same values as weights_2d[k]. If
+        True, return the weights for the unshifted rfft2 half-spectrum of shape
+        (M,int(N/2)+1).
+
+    Returns
+    -------
+    out : ndarray
+        The 2d filter weights for frequency band k.
+
+    """
+    if not filter.get("compact", False):
+        W = filter["weights_2d"][k, :, :]
+        if not half_spectrum:
+            return W
+        else:
+            return np.fft.ifftshift(W)[:, :int(W.shape[1]/2)+1]
+
+    W_h = filter["weights_radial"][k, :][filter["radius_index"]]
+    if half_spectrum:
+        return W_h
+
+    # the weights depend only on the wavenumber radius, so the negative
+    # x-frequencies missing from the half-spectrum are obtained by mirroring
+    # its columns
+    N = filter["shape"][1]
+    W = np.empty(filter["shape"])
+    W[:, :W_h.shape[1]] = W_h
+    W[:, W_h.shape[1]:] = W_h[:, 1:N-W_h.shape[1]+1][:, ::-1]
+
+    return np.fft.fftshift(W)
+
 def _gaussweights_1d(l, n, l_0=3, gauss_scale=0.5, gauss_scale_0=0.5):
     e = pow(0.5*l/l_0, 1.0/(n-2))
     r = [(l_0*pow(e, k-1), l_0*pow(e, k)) for k in range(1, n-1)]
@@ -14,30 +14,36 @@ dictionary with the following key-value pairs:
 +===================+==========================================================+
 |  cascade_levels   | three-dimensional array of shape (k,m,n), where k is the |
 |                   | number of cascade levels and the input fields have shape |
-|                   | (m,n)                                                    |
+|                   | (m,n). If the output domain is 'spectral', the levels    |
+|                   | are given as complex half-spectra of shape               |
+|                   | (k,m,int(n/2)+1) as returned by rfft2                    |
 +-------------------+----------------------------------------------------------+
 |  means            | list of mean values for each cascade level               |
 +-------------------+----------------------------------------------------------+
 |  stds             | list of standard deviations for each cascade level       |
 +-------------------+----------------------------------------------------------+
+|  domain           | the domain of the cascade levels: 'spatial' or           |
+|                   | 'spectral'                                               |
++-------------------+----------------------------------------------------------+
+|  normalized       | True if the cascade levels have been normalized to zero  |
+|                   | mean and unit variance by using the means and stds       |
++-------------------+----------------------------------------------------------+
+
+The cascade levels have the precision of the input field: single-precision
+inputs give single-precision levels (complex64 in the spectral domain), and
+other inputs give double-precision levels.
+
+If the input is a stack of b fields of shape (b,m,n), the fields are decomposed
+simultaneously. In this case the cascade levels have shape (b,k,m,n) and the
+means and standard deviations are given as arrays of shape (b,k).
+
+A decomposition can be transformed back into a single field with the
+corresponding recompose_xxx(decomp, optional arguments) method.
 """
 
 import numpy as np
-# Use the pyfftw interface if it is installed. If not, fall back to the fftpack
-# interface provided by SciPy, and finally to numpy if SciPy is not installed.
-try:
-    import pyfftw.interfaces.numpy_fft as fft
-    import pyfftw
-    # TODO: Caching and multithreading currently disabled because they give a
-    # segfault with dask.
-    #pyfftw.interfaces.cache.enable()
-    fft_kwargs = {"threads":1, "planner_effort":"FFTW_ESTIMATE"}
-except ImportError:
-    import scipy.fftpack as fft
-    fft_kwargs = {}
-except ImportError:
-    import numpy.fft as fft
-    fft_kwargs = {}
+from ..utils import fft as fft_utils
+from .bandpass_filters import get_weights_2d
 
 def decomposition_fft(X, filter, **kwargs):
     """Decompose a 2d input field into multiple spatial scales by using the Fast
@@ -46,16 +52,33 @@ def decomposition_fft(X, filter, **kwargs):
     Parameters
     ----------
     X : array_like
-      Two-dimensional array containing the input field. All values are required
-      to be finite.
+      Two-dimensional array containing the input field, or a three-dimensional
+      array of shape (b,m,n) containing a stack of b input fields that are
+      decomposed simultaneously. All values are required to be finite.
     filter : dict
-      A filter returned by any method implemented in bandpass_filters.py.
+      A filter returned by any method implemented in bandpass_filters.py. Both
+      dense and compact filters are accepted.
 
     Other Parameters
     ----------------
     MASK : array_like
       Optional mask to use for computing the statistics for the cascade levels.
       Pixels with MASK==False are excluded from the computations.
+    fft_method : str or object
+      The FFT backend to use, given as a name or an object returned by
+      pysteps.utils.fft.get_backend. None uses the default backend.
+    output_domain : {'spatial', 'spectral'}
+      If 'spatial', the cascade levels are transformed back into the spatial
+      domain. If 'spectral', they are returned as half-spectra computed with
+      rfft2, and no inverse transforms are done unless MASK is given. Default:
+      'spatial'.
+    compute_stats : bool
+      If True, compute the means and standard deviations of the cascade
+      levels. In the spectral domain and without MASK, they are computed from
+      the spectra by using Parseval's theorem. Default: True.
+    normalize : bool
+      If True, normalize the cascade levels to zero mean and unit variance.
+      Requires compute_stats=True. Default: False.
 
     Returns
     -------
@@ -65,35 +88,180 @@ def decomposition_fft(X, filter, **kwargs):
 
     """
     MASK = kwargs.get("MASK", None)
+    fft  = fft_utils.get_backend(kwargs.get("fft_method", None))
+    output_domain = kwargs.get("output_domain", "spatial")
+    compute_stats = kwargs.get("compute_stats", True)
+    normalize     = kwargs.get("normalize", False)
 
-    if len(X.shape) != 2:
-        raise ValueError("the input is not two-dimensional array")
-    if MASK is not None and MASK.shape != X.shape:
+    if output_domain not in ["spatial", "spectral"]:
+        raise ValueError("unknown output domain %s: must be 'spatial' or 'spectral'" % output_domain)
+    if normalize and not compute_stats:
+        raise ValueError("normalize=True requires compute_stats=True")
+
+    if len(X.shape) not in [2, 3]:
+        raise ValueError("the input is not two- or three-dimensional array")
+    if MASK is not None and MASK.shape != X.shape[-2:]:
       raise ValueError("dimension mismatch between X and MASK: X.shape=%s, MASK.shape=%s" % \
         (str(X.shape), str(MASK.shape)))
-    if X.shape != filter["weights_2d"].shape[1:3]:
-        raise ValueError("dimension mismatch between X and filter: X.shape=%s, filter['weights_2d'].shape[1:3]=%s" % (str(X.shape), str(filter["weights_2d"].shape[1:3])))
+    filter_shape = tuple(filter["shape"]) if "shape" in filter else filter["weights_2d"].shape[1:3]
+    if X.shape[-2:] != filter_shape:
+        raise ValueError("dimension mismatch between X and filter: X.shape=%s, filter shape=%s" % (str(X.shape), str(filter_shape)))
     if np.any(~np.isfinite(X)):
       raise ValueError("X contains non-finite values")
 
+    batched = len(X.shape) == 3
+
+    dtype  = np.result_type(X.dtype, np.float32)
+    cdtype = np.result_type(dtype, np.complex64)
+
     result = {}
     means  = []
     stds   = []
 
-    F = fft.fftshift(fft.fft2(X, **fft_kwargs))
+    if output_domain == "spatial":
+        F = fft.fftshift(fft.fft2(X, axes=(-2, -1)), axes=(-2, -1))
+    else:
+        F = fft.rfft2(X, axes=(-2, -1))
+    F = F.astype(cdtype, copy=False)
+
     X_decomp = []
     for k in range(len(filter["weights_1d"])):
-        W_k = filter["weights_2d"][k, :, :]
-        X_ = np.real(fft.ifft2(fft.ifftshift(F*W_k), **fft_kwargs))
+        W_k = get_weights_2d(filter, k, half_spectrum=output_domain == "spectral")
+        W_k = W_k.astype(dtype, copy=False)
+        if output_domain == "spatial":
+            X_ = np.real(fft.ifft2(fft.ifftshift(F*W_k, axes=(-2, -1)),
+                                   axes=(-2, -1))).astype(dtype, copy=False)
+        else:
+            X_ = F * W_k
         X_decomp.append(X_)
 
-        if MASK is not None:
-            X_ = X_[MASK]
-        means.append(np.mean(X_))
-        stds.append(np.std(X_))
+        if not compute_stats:
+            continue
 
-    result["cascade_levels"] = np.stack(X_decomp)
-    result["means"] = means
-    result["stds"]  = stds
+        if output_domain == "spectral" and MASK is None:
+            mu,sigma = _compute_spectral_stats(X_, X.shape[-2:])
+        else:
+            if output_domain == "spectral":
+                X_ = fft.irfft2(X_, s=X.shape[-2:], axes=(-2, -1)).astype(dtype, copy=False)
+            if MASK is not None:
+                X_ = X_[..., MASK]
+            X_ = X_.reshape(X_.shape[0], -1) if batched else X_
+            mu    = np.mean(X_, axis=-1) if batched else np.mean(X_)
+            sigma = np.std(X_, axis=-1) if batched else np.std(X_)
+        means.append(mu)
+        stds.append(sigma)
+
+        if normalize:
+            X_decomp[-1] = _normalize_level(X_decomp[-1], mu, sigma,
+                                            output_domain, X.shape[-2:])
+
+    if not batched:
+        result["cascade_levels"] = np.stack(X_decomp)
+        if compute_stats:
+            result["means"] = means
+            result["stds"]  = stds
+    else:
+        result["cascade_levels"] = np.stack(X_decomp, axis=1)
+        if compute_stats:
+            result["means"] = np.stack(means, axis=1)
+            result["stds"]  = np.stack(stds, axis=1)
+
+    result["domain"]     = output_domain
+    result["normalized"] = normalize
 
     return result
+
+def recompose_fft(decomp, **kwargs):
+    """Recompose a cascade decomposition returned by decomposition_fft into a
+    single field by summing the cascade levels. If the cascade is in the
+    spectral domain, the levels are summed in the spectral domain and only one
+    inverse transform is done.
+
+    Parameters
+    ----------
+    decomp : dict
+      A cascade decomposition returned by decomposition_fft.
+
+    Other Parameters
+    ----------------
+    shape : tuple
+      The shape (m,n) of the recomposed field. Required if the cascade is in
+      the spectral domain.
+    fft_method : str or object
+      The FFT backend to use, given as a name or an object returned by
+      pysteps.utils.fft.get_backend. None uses the default backend.
+
+    Returns
+    -------
+    out : ndarray
+      Array of shape (m,n) containing the recomposed field, or (b,m,n) if the
+      decomposition was computed from a stack of b fields.
+
+    """
+    shape = kwargs.get("shape", None)
+    fft   = fft_utils.get_backend(kwargs.get("fft_method", None))
+
+    X = decomp["cascade_levels"]
+    batched = len(X.shape) == 4
+    domain = decomp.get("domain", "spatial")
+
+    if domain == "spectral" and shape is None:
+        raise ValueError("shape must be given for a cascade in the spectral domain")
+
+    if decomp.get("normalized", False):
+        mu    = np.asarray(decomp["means"], dtype=X.real.dtype)
+        sigma = np.asarray(decomp["stds"], dtype=X.real.dtype)
+        if batched:
+            mu    = np.moveaxis(mu, 1, 0)
+            sigma = np.moveaxis(sigma, 1, 0)
+        X_sum = 0.0
+        for k in range(X.shape[-3]):
+            X_sum = X_sum + X[..., k, :, :] * _expand(sigma[k], batched)
+        mu = np.sum(mu, axis=0)
+        if domain == "spatial":
+            X_sum = X_sum + _expand(mu, batched)
+        else:
+            X_sum[..., 0, 0] += mu * shape[0] * shape[1]
+    else:
+        X_sum = np.sum(X, axis=-3)
+
+    if domain == "spectral":
+        return fft.irfft2(X_sum, s=shape, axes=(-2, -1))
+    else:
+        return X_sum
+
+def _compute_spectral_stats(F, shape):
+    # compute the means and standard deviations of fields from their rfft2
+    # half-spectra by using Parseval's theorem
+    M,N = shape
+    n_full = M * N
+
+    # each column of the half-spectrum except the zero-frequency column and,
+    # for even N, the Nyquist column represents two columns of the full
+    # spectrum
+    c = np.full(F.shape[-1], 2.0)
+    c[0] = 1.0
+    if N % 2 == 0:
+        c[-1] = 1.0
+
+    mu = F[..., 0, 0].real.astype(np.float64) / n_full
+    sumsq = np.sum(np.sum(F.real**2 + F.imag**2, axis=-2, dtype=np.float64) * c,
+                   axis=-1) / n_full
+    var = sumsq / n_full - mu*mu
+
+    return mu, np.sqrt(np.maximum(var, 0.0))
+
+def _expand(x, batched):
+    return x[:, None, None] if batched else x
+
+def _normalize_level(X, mu, sigma, domain, shape):
+    batched = len(X.shape) == 3
+    # keep the precision of the cascade level
+    mu    = np.asarray(mu, dtype=X.real.dtype)
+    sigma = np.asarray(sigma, dtype=X.real.dtype)
+    if domain == "spatial":
+        return (X - _expand(mu, batched)) / _expand(sigma, batched)
+    else:
+        X = X.copy()
+        X[..., 0, 0] -= mu * shape[0] * shape[1]
+        return X / _expand(sigma, batched)
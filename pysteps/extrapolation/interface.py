@@ -12,7 +12,13 @@ the domain. Optional keyword arguments that are specific to a given extrapolatio
 method are passed as a dictionary.
 
 The output of each method is an array R_e that includes the time series of extrapolated
-fields of shape (num_timesteps, m, n)."""
+fields of shape (num_timesteps, m, n). The methods also accept R of shape (k, m, n)
+for advecting k fields with the same motion field, and the output then has shape
+(num_timesteps, k, m, n). If the keyword argument return_final_step is True,
+only the field(s) of the last time step are returned, and the first dimension
+of the output has length 1. If the keyword argument out is given, the
+extrapolated fields are written into this array of the output shape, and it
+is returned as R_e."""
 
 def get_method(name):
     """Return a callable function for the extrapolation method corresponding to
@@ -38,11 +44,19 @@ def get_method(name):
     elif name.lower() in ["eulerian"]:
         def eulerian(R, V, num_timesteps, *args, **kwargs):
             return_displacement = kwargs.get("return_displacement", False)
-            R_e = np.repeat(R[None, :, :,], num_timesteps, axis=0)
+            return_final_step   = kwargs.get("return_final_step", False)
+            out                 = kwargs.get("out", None)
+            if return_final_step:
+                num_timesteps = 1
+            if out is None:
+                R_e = np.repeat(R[None, :, :,], num_timesteps, axis=0)
+            else:
+                R_e = out
+                R_e[:] = R[None, :, :]
             if not return_displacement:
                 return R_e
             else:
-                return R_e, np.zeros((2, R.shape[0], R.shape[1]))
+                return R_e, np.zeros((2, R.shape[-2], R.shape[-1]))
         return eulerian
     elif name.lower() in ["semilagrangian"]:
         from . import semilagrangian
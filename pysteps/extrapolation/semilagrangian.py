@@ -11,8 +11,13 @@ def extrapolate(R, V, num_timesteps, outval=np.nan, **kwargs):
     Parameters
     ----------
     R : array-like
-        Array of shape (m,n) containing the input precipitation field. All
-        values are required to be finite.
+        Array of shape (m,n) containing the input precipitation field, or an
+        array of shape (k,m,n) containing k fields that are advected with the
+        same motion field (e.g. the levels of a cascade decomposition). In the
+        latter case, the displacements are computed only once for all fields,
+        and the fields are advected with a single lookup of the displaced
+        pixels.
+        All values are required to be finite.
     V : array-like
         Array of shape (2,m,n) containing the x- and y-components of the m*n
         advection field. All values are required to be finite.
@@ -21,7 +26,7 @@ def extrapolate(R, V, num_timesteps, outval=np.nan, **kwargs):
     outval : float
         Optional argument for specifying the value for pixels advected from
         outside the domain. If outval is set to 'min', the value is taken as
-        the minimum value of R.
+        the minimum value of R (of each field if R is three-dimensional).
         Default : np.nan
 
     Other Parameters
@@ -41,21 +46,51 @@ def extrapolate(R, V, num_timesteps, outval=np.nan, **kwargs):
         If True, return the total advection velocity (displacement) between the
         initial input field and the advected one integrated along the trajectory.
         Default : False
+    return_final_step : bool
+        If True, advect the fields only to the last time step, and return an
+        array of shape (1,m,n), or (1,k,m,n) if R is three-dimensional. The
+        displacement is computed for all time steps, but the intermediate
+        fields are not computed.
+        Default : False
+    out : array-like
+        Optional array of shape (num_timesteps,m,n), or (num_timesteps,k,m,n)
+        if R is three-dimensional (the first dimension being 1 if
+        return_final_step is True), into which the extrapolated
+        fields are written. If given, no other arrays are allocated for the
+        output, and out is returned in place of a new array. It can be e.g. a
+        view to a slice of a larger preallocated array or a numpy.memmap.
+        Default : None
+    trajectory : dict
+        Optional trajectory returned by compute_trajectory. If given, the
+        displacements are taken from the trajectory instead of computing them
+        from V, and D_prev, n_iter and inverse are not used. This allows
+        advecting several fields (e.g. the members of an ensemble) along the
+        same trajectory without recomputing it.
+        Default : None
+    trajectory_offset : int
+        The index of the time step of the trajectory corresponding to the
+        first extrapolated time step.
+        Default : 0
 
     Returns
     -------
     out : array or tuple
         If return_displacement=False, return a time series extrapolated fields of
-        shape (num_timesteps,m,n). Otherwise, return a tuple containing the
+        shape (num_timesteps,m,n), or (num_timesteps,k,m,n) if R is
+        three-dimensional (the first dimension being 1 if return_final_step is
+        True). Otherwise, return a tuple containing the
         extrapolated fields and the total displacement along the advection trajectory.
+        The extrapolated fields have the data type of R, and the displacement
+        is computed in the floating point precision of V (single precision if V
+        is float32, double precision otherwise).
 
     References
     ----------
     :cite:`GZ2002`
 
     """
-    if len(R.shape) != 2:
-        raise ValueError("R must be a two-dimensional array")
+    if len(R.shape) not in [2, 3]:
+        raise ValueError("R must be a two- or three-dimensional array")
 
     if len(V.shape) != 3:
         raise ValueError("V must be a three-dimensional array")
@@ -72,27 +107,173 @@ def extrapolate(R, V, num_timesteps, outval=np.nan, **kwargs):
     n_iter              = kwargs.get("n_iter", 3)
     inverse             = kwargs.get("inverse", True)
     return_displacement = kwargs.get("return_displacement", False)
+    return_final_step   = kwargs.get("return_final_step", False)
+    out                 = kwargs.get("out", None)
+    trajectory          = kwargs.get("trajectory", None)
+    trajectory_offset   = kwargs.get("trajectory_offset", 0)
 
     if verbose:
         print("Computing the advection with the semi-lagrangian scheme.")
         t0 = time.time()
 
+    num_outputs = num_timesteps if not return_final_step else 1
+
+    if out is not None and out.shape != (num_outputs,) + R.shape:
+        raise ValueError("out has shape %s, but %s is expected" % \
+                         (str(out.shape), str((num_outputs,) + R.shape)))
+
+    batched = len(R.shape) == 3
+    R_ = R if batched else R[None, :, :]
+
     if outval == "min":
-        outval = np.nanmin(R)
+        outval = [np.nanmin(R__) for R__ in R_]
+    else:
+        outval = [outval for R__ in R_]
+
+    if trajectory is not None:
+        D_t = trajectory["D"]
+        if D_t.shape[2:] != R.shape[-2:]:
+            raise ValueError("the trajectory has shape %s, but the fields have shape %s" % \
+                             (str(D_t.shape[2:]), str(R.shape[-2:])))
+        if trajectory_offset + num_timesteps > D_t.shape[0]:
+            raise ValueError("the trajectory has only %d time steps" % D_t.shape[0])
+
+    if out is None:
+        R_e = np.empty((num_outputs,) + R.shape, dtype=R.dtype)
+    else:
+        R_e = out
+
+    # the grid is shared by the computation of the displacements and the
+    # interpolation
+    if trajectory is None:
+        XY = _get_grid(V.shape[1:], np.result_type(V.dtype, np.float32))
+        D_iter = _iterate_displacements(V, num_timesteps, D_prev, n_iter,
+                                        inverse, XY)
+    else:
+        XY = _get_grid(D_t.shape[2:], D_t.dtype) if trajectory["indices"] is None \
+            else None
+        D_iter = (D_t[trajectory_offset+t] for t in range(num_timesteps))
+
+    for t,D in enumerate(D_iter):
+        if return_final_step and t < num_timesteps - 1:
+            continue
+
+        # the displacement is shared by all fields
+        t_out = t if not return_final_step else 0
+        R_e_  = R_e[t_out] if batched else R_e[t_out][None, :, :]
+
+        if trajectory is not None and trajectory["indices"] is not None:
+            _gather(R_, trajectory["indices"][trajectory_offset+t], outval, R_e_)
+        else:
+            XYW = XY + D
+
+            if R_.shape[0] > 1:
+                # compute the interpolation indices once for all fields
+                _gather(R_, _get_indices(XYW), outval, R_e_)
+            else:
+                XYW = [XYW[1, :, :], XYW[0, :, :]]
+                ip.map_coordinates(R_[0, :, :], XYW, output=R_e_[0, :, :],
+                                   mode="constant", cval=outval[0], order=0,
+                                   prefilter=False)
+
+    if verbose:
+        print("--- %s seconds ---" % (time.time() - t0))
+
+    if not return_displacement:
+        return R_e
+    else:
+        return R_e, D.copy() if trajectory is not None else D
+
+def compute_trajectory(V, num_timesteps, return_indices=False, **kwargs):
+    """Compute the displacements of the semi-Lagrangian extrapolation for all
+    time steps. The trajectory can be given to extrapolate for advecting any
+    number of fields with the same motion field, which then reduces to a
+    lookup of the displaced pixels.
+
+    Parameters
+    ----------
+    V : array-like
+        Array of shape (2,m,n) containing the x- and y-components of the m*n
+        advection field. All values are required to be finite.
+    num_timesteps : int
+        Number of time steps to extrapolate.
+    return_indices : bool
+        If True, also compute the flat indices of the source pixels of the
+        nearest-neighbour interpolation for each time step. The fields are
+        then advected with a single gather per field and time step.
+
+    Other Parameters
+    ----------------
+    D_prev : array-like
+        Optional initial displacement vector field of shape (2,m,n) for the
+        extrapolation.
+        Default : None
+    n_iter : int
+        Number of inner iterations in the semi-Lagrangian scheme.
+        Default : 3
+    inverse : bool
+        If True, the extrapolation trajectory is computed backward along the
+        flow (default), forward otherwise.
+        Default : True
 
+    Returns
+    -------
+    out : dict
+        A dictionary containing the displacements of shape
+        (num_timesteps,2,m,n) ('D') and the indices of shape
+        (num_timesteps,m,n) ('indices'), which is None if return_indices is
+        False. The indices of the pixels advected from outside the domain are
+        set to m*n.
+
+    """
+    if len(V.shape) != 3:
+        raise ValueError("V must be a three-dimensional array")
+
+    if np.any(~np.isfinite(V)):
+        raise ValueError("V contains non-finite values")
+
+    D_prev  = kwargs.get("D_prev", None)
+    n_iter  = kwargs.get("n_iter", 3)
+    inverse = kwargs.get("inverse", True)
+
+    dtype = np.result_type(V.dtype, np.float32)
+
+    D_t = np.empty((num_timesteps,) + V.shape, dtype=dtype)
+    if return_indices:
+        indices = np.empty((num_timesteps,) + V.shape[1:], dtype=np.intp)
+    else:
+        indices = None
+
+    XY = _get_grid(V.shape[1:], dtype)
+    for t,D in enumerate(_iterate_displacements(V, num_timesteps, D_prev,
+                                                n_iter, inverse, XY)):
+        D_t[t] = D
+        if return_indices:
+            indices[t] = _get_indices(XY + D)
+
+    return {"D":D_t, "indices":indices}
+
+def _get_grid(shape, dtype):
+    X,Y = np.meshgrid(np.arange(shape[1], dtype=dtype),
+                      np.arange(shape[0], dtype=dtype))
+    return np.stack([X, Y])
+
+def _iterate_displacements(V, num_timesteps, D_prev, n_iter, inverse, XY):
+    # yield the total displacement after each time step. The same array is
+    # updated in place. XY is the grid returned by _get_grid.
     coeff = 1.0 if not inverse else -1.0
 
-    X,Y = np.meshgrid(np.arange(V.shape[2]), np.arange(V.shape[1]))
-    XY  = np.stack([X, Y])
+    dtype = np.result_type(V.dtype, np.float32)
 
-    R_e = []
     if D_prev is None:
-        D = np.zeros((2, V.shape[1], V.shape[2]))
+        D = np.zeros((2, V.shape[1], V.shape[2]), dtype=dtype)
     else:
-        D = D_prev.copy()
+        D = D_prev.astype(dtype)
+
+    V_inc = np.empty(D.shape, dtype=dtype)
 
     for t in range(num_timesteps):
-        V_inc = np.zeros(D.shape)
+        V_inc[:] = 0.0
 
         for k in range(n_iter):
             if t > 0 or k > 0 or D_prev is not None:
@@ -112,17 +293,29 @@ def extrapolate(R, V, num_timesteps, outval=np.nan, **kwargs):
 
             D += coeff * V_inc
 
-        XYW = XY + D
-        XYW = [XYW[1, :, :], XYW[0, :, :]]
+        yield D
 
-        IW = ip.map_coordinates(R, XYW, mode="constant", cval=outval, order=0,
-                              prefilter=False)
-        R_e.append(np.reshape(IW, R.shape))
+def _get_indices(XYW):
+    # compute the flat indices of the nearest-neighbour interpolation used by
+    # map_coordinates with order=0 and mode='constant'. The coordinates are
+    # rounded half up in double precision, and the coordinates outside the
+    # domain are mapped to the index m*n.
+    m,n = XYW.shape[1:]
+    X = XYW[0, :, :].astype(np.float64)
+    Y = XYW[1, :, :].astype(np.float64)
 
-    if verbose:
-        print("--- %s seconds ---" % (time.time() - t0))
+    inside = np.logical_and(np.logical_and(X >= 0, X <= n-1),
+                            np.logical_and(Y >= 0, Y <= m-1))
+    X = np.floor(np.where(inside, X, 0.0) + 0.5).astype(np.intp)
+    Y = np.floor(np.where(inside, Y, 0.0) + 0.5).astype(np.intp)
 
-    if not return_displacement:
-        return np.stack(R_e)
-    else:
-        return np.stack(R_e), D
+    return np.where(inside, Y*n + X, m*n)
+
+def _gather(R, indices, outval, R_e):
+    # advect the fields R of shape (k,m,n) into R_e by looking up the pixels
+    # with the given flat indices. The value of the index m*n is outval.
+    R_ext = np.empty(R[0].size + 1, dtype=R.dtype)
+    for i in range(R.shape[0]):
+        R_ext[:-1] = R[i].ravel()
+        R_ext[-1]  = outval[i]
+        np.take(R_ext, indices, out=R_e[i, :, :])
@@ -1,25 +1,11 @@
 """Implementation of the DARTS algorithm."""
 
 import numpy as np
-from numpy.linalg import lstsq, svd
+from numpy.linalg import eigh, lstsq
 import sys
-import time
-
-# Use the pyfftw interface if it is installed. If not, fall back to the fftpack
-# interface provided by SciPy, and finally to numpy if SciPy is not installed.
-try:
-    import pyfftw.interfaces.numpy_fft as fft
-    import pyfftw
-    # TODO: Caching and multithreading currently disabled because they give a
-    # segfault with dask.
-    #pyfftw.interfaces.cache.enable()
-    fft_kwargs = {"threads":1, "planner_effort":"FFTW_ESTIMATE"}
-except ImportError:
-    import scipy.fftpack as fft
-    fft_kwargs = {}
-except ImportError:
-    import numpy.fft as fft
-    fft_kwargs = {}
+
+from ..utils import fft as fft_utils
+from ..utils import profiling
 
 def DARTS(Z, **kwargs):
     """Compute the advection field from a sequence of input images by using the
@@ -51,9 +37,30 @@ def DARTS(Z, **kwargs):
     lsq_method : {1, 2}
       The method to use for solving the linear equations in the least squares
       sense: 1=numpy.linalg.lstsq, 2=explicit computation of the Moore-Penrose
-      pseudoinverse and SVD.
+      pseudoinverse of the normal equations. Their matrix is Hermitian, so the
+      pseudoinverse is computed from its eigendecomposition.
     verbose : bool
         if set to True, it prints information about the program
+    fft_method : str or object
+      The FFT backend to use, given as a name or an object returned by
+      pysteps.utils.fft.get_backend. None uses the default backend.
+    timestamps : list
+      Timestamps of the input images, e.g. as datetime.datetime objects. The
+      timestamps can be any hashable objects. Required if cache is given.
+    cache : dict
+      Optional dictionary for reusing the FFTs of the input images in the next
+      call (e.g. the next forecast cycle). The spatial FFT of each image is
+      stored into cache with a key containing its timestamp and the image
+      size, and the images already found in the cache are not transformed
+      again. The temporal DFT of the previous call is also stored. If the
+      window of images has moved by one image, the temporal DFT is updated
+      with a sliding DFT instead of recomputing it. It is recomputed after T
+      consecutive updates to limit the accumulation of rounding errors. Only
+      the images of the latest call are kept in the cache.
+    profiler : str or object
+      The profiler sink that receives the spans 'darts', 'darts.fft',
+      'darts.y_vector', 'darts.h_matrix' and 'darts.solve'. See
+      pysteps.utils.profiling. None uses the default sink.
 
     Returns
     -------
@@ -74,19 +81,30 @@ def DARTS(Z, **kwargs):
     print_info = kwargs.get("print_info", False)
     lsq_method = kwargs.get("lsq_method", 2)
     verbose             = kwargs.get("verbose", True)
+    profiler            = kwargs.get("profiler", None)
+    sink                = profiling.get_sink(profiler)
+    fft = fft_utils.get_backend(kwargs.get("fft_method", None))
+    timestamps          = kwargs.get("timestamps", None)
+    cache               = kwargs.get("cache", None)
 
     if N_t >= Z.shape[0]:
         raise ValueError("N_t = %d >= %d = T, but N_t < T required" % (N_t, Z.shape[0]))
+    if cache is not None:
+        if timestamps is None:
+            raise ValueError("cache is given but timestamps is None")
+        if len(timestamps) != Z.shape[0]:
+            raise ValueError("Z has %d images, but %d timestamps are given" % \
+                             (Z.shape[0], len(timestamps)))
 
     if verbose:
         print("Computing the motion field with the DARTS method.")
-        t0 = time.time()
 
-    Z = np.moveaxis(Z, (0, 1, 2), (2, 0, 1))
+    sp_total = profiling.span(sink, "darts").start()
+    sp_total.add(Z)
 
-    T_x = Z.shape[1]
-    T_y = Z.shape[0]
-    T_t = Z.shape[2]
+    T_x = Z.shape[2]
+    T_y = Z.shape[1]
+    T_t = Z.shape[0]
 
     if print_info:
         print("-----")
@@ -95,81 +113,73 @@ def DARTS(Z, **kwargs):
 
         print("  Computing the FFT of the reflectivity fields..."),
         sys.stdout.flush()
-        starttime = time.time()
 
-    Z = fft.fftn(Z, **fft_kwargs)
+    sp = profiling.span(sink, "darts.fft").start()
+    # the input is real, so only the non-negative frequencies of the
+    # x-axis are computed
+    if cache is None:
+        Z = fft.fftn(fft.rfft2(Z), axes=(0,))
+    else:
+        Z = _get_cached_spectrum(Z, timestamps, cache, fft)
+    sp.add(Z).stop()
 
     if print_info:
-        print("Done in %.2f seconds." % (time.time() - starttime))
+        print("Done in %.2f seconds." % sp.duration)
 
         print("  Constructing the y-vector..."),
         sys.stdout.flush()
-        starttime = time.time()
 
     m = (2*N_x+1)*(2*N_y+1)*(2*N_t+1)
     n = (2*M_x+1)*(2*M_y+1)
 
-    y = np.zeros(m, dtype=complex)
-
+    sp = profiling.span(sink, "darts.y_vector").start()
     k_t,k_y,k_x = np.unravel_index(np.arange(m), (2*N_t+1, 2*N_y+1, 2*N_x+1))
 
-    for i in range(m):
-        k_x_ = k_x[i] - N_x
-        k_y_ = k_y[i] - N_y
-        k_t_ = k_t[i] - N_t
-
-        Z_ = Z[k_y_, k_x_, k_t_]
+    k_x = k_x - N_x
+    k_y = k_y - N_y
+    k_t = k_t - N_t
 
-        y[i] = k_t_ * Z_
+    y = k_t * _get_coeffs(Z, T_x, k_t, k_y, k_x)
+    sp.add(y).stop()
 
     if print_info:
-        print("Done in %.2f seconds." % (time.time() - starttime))
+        print("Done in %.2f seconds." % sp.duration)
 
-    A = np.zeros((m, n), dtype=complex)
-    B = np.zeros((m, n), dtype=complex)
-
-    if print_info:
         print("  Constructing the H-matrix..."),
         sys.stdout.flush()
-        starttime = time.time()
 
+    sp = profiling.span(sink, "darts.h_matrix").start()
     c1 = -1.0*T_t / (T_x * T_y)
 
     kp_y,kp_x = np.unravel_index(np.arange(n), (2*M_y+1, 2*M_x+1))
 
-    for i in range(m):
-        k_x_  = k_x[i] - N_x
-        k_y_  = k_y[i] - N_y
-        k_t_  = k_t[i] - N_t
-
-        kp_x_ = kp_x[:] - M_x
-        kp_y_ = kp_y[:] - M_y
+    # the rows correspond to the coefficients of the input images and
+    # the columns to those of the advection field
+    i_ = k_y[:, None] - (kp_y[None, :] - M_y)
+    j_ = k_x[:, None] - (kp_x[None, :] - M_x)
 
-        i_ = k_y_ - kp_y_
-        j_ = k_x_ - kp_x_
+    Z_ = _get_coeffs(Z, T_x, k_t[:, None], i_, j_)
 
-        Z_ = Z[i_, j_, k_t_]
-
-        c2 = c1 / T_y * i_
-        A[i, :] = c2 * Z_
-
-        c2 = c1 / T_x * j_
-        B[i, :] = c2 * Z_
+    A = (c1 / T_y * i_) * Z_
+    B = (c1 / T_x * j_) * Z_
+    Z_ = None
+    sp.add(A, B).stop()
 
     if print_info:
-        print("Done in %.2f seconds." % (time.time() - starttime))
+        print("Done in %.2f seconds." % sp.duration)
 
         print("  Solving the linear systems..."),
         sys.stdout.flush()
-        starttime = time.time()
 
+    sp = profiling.span(sink, "darts.solve").start()
     if lsq_method == 1:
         x = lstsq(np.hstack([A, B]), y, rcond=0.01)[0]
     else:
         x = _leastsq(A, B, y)
+    sp.add(A, B).stop()
 
     if print_info:
-        print("Done in %.2f seconds." % (time.time() - starttime))
+        print("Done in %.2f seconds." % sp.duration)
 
     h,w = 2*M_y+1,2*M_x+1
 
@@ -183,11 +193,13 @@ def DARTS(Z, **kwargs):
 
     k_x,k_y = np.meshgrid(np.arange(-M_x, M_x+1), np.arange(-M_y, M_y+1))
 
-    U = np.real(fft.ifft2(_fill(U, Z.shape[0], Z.shape[1], k_x, k_y), **fft_kwargs))
-    V = np.real(fft.ifft2(_fill(V, Z.shape[0], Z.shape[1], k_x, k_y), **fft_kwargs))
+    U = np.real(fft.ifft2(_fill(U, T_y, T_x, k_x, k_y)))
+    V = np.real(fft.ifft2(_fill(V, T_y, T_x, k_x, k_y)))
+
+    sp_total.stop()
 
     if verbose:
-        print("--- %s seconds ---" % (time.time() - t0))
+        print("--- %s seconds ---" % sp_total.duration)
 
     # TODO: Sometimes the sign of the advection field is wrong. This appears to
     # depend on N_t...
@@ -200,15 +212,62 @@ def _leastsq(A, B, y):
 
     M = None
 
-    U,s,V = svd(MM, full_matrices=False)
+    # MM is Hermitian and positive semidefinite, so its singular values are
+    # its eigenvalues. The pseudoinverse is truncated as with the SVD.
+    s,U = eigh(MM)
     MM = None
-    mask = s > 0.01*s[0]
-    s = 1.0 / s[mask]
+    mask = s > 0.01*s[-1]
+    U = U[:, mask]
+
+    return np.dot(U, np.dot(U.conjugate().T, np.dot(M_ct, y)) / s[mask])
+
+def _get_cached_spectrum(Z, timestamps, cache, fft):
+    # return the spectrum of the images Z computed from the spatial FFTs of the
+    # images stored in the cache. The temporal DFT is updated with a sliding DFT
+    # if the previous window ends with the second-last image.
+    T = Z.shape[0]
+    shape = Z.shape[1:]
+    keys = [(t, shape) for t in timestamps]
+    for i,key in enumerate(keys):
+        if key not in cache:
+            cache[key] = fft.rfft2(Z[i, :, :])
+
+    key_s = ("spectrum", shape)
+    prev = cache.get(key_s, None)
+    if prev is not None and len(prev[0]) == T and prev[2] < T and \
+       prev[0][1:] == tuple(timestamps[:-1]) and (prev[0][0], shape) in cache:
+        # remove the oldest image, add the newest one and shift the time
+        # origin by one image
+        w = np.exp(2j*np.pi*np.arange(T)/T)[:, None, None]
+        Z_f = (prev[1] - cache[(prev[0][0], shape)] + cache[keys[-1]]) * w
+        n_updates = prev[2] + 1
+    elif prev is not None and prev[0] == tuple(timestamps):
+        Z_f = prev[1]
+        n_updates = prev[2]
+    else:
+        Z_f = fft.fftn(np.stack([cache[key] for key in keys]), axes=(0,))
+        n_updates = 0
+    cache[key_s] = (tuple(timestamps), Z_f, n_updates)
+
+    # keep only the images that can be used in the next call
+    for key in list(cache.keys()):
+        if key not in keys and key != key_s:
+            del cache[key]
+
+    return Z_f
+
+def _get_coeffs(Z, T_x, k_t, k_y, k_x):
+    # return the DFT coefficients of the given frequencies from the spectrum Z
+    # of shape (T_t,T_y,T_x//2+1) computed with a real-input FFT along the
+    # x-axis. The coefficients of the other frequencies are the complex
+    # conjugates of those of the opposite frequencies.
+    k_x = k_x % T_x
+    mask = k_x > T_x // 2
 
-    MM_inv = np.dot(np.dot(V[:len(s), :].conjugate().T, np.diag(s)),
-                    U[:, :len(s)].conjugate().T)
+    Z_ = Z[np.where(mask, -k_t, k_t), np.where(mask, -k_y, k_y),
+           np.where(mask, T_x - k_x, k_x)]
 
-    return np.dot(MM_inv, np.dot(M_ct, y))
+    return np.where(mask, Z_.conjugate(), Z_)
 
 def _fill(X, h, w, k_x, k_y):
     X_f = np.zeros((h, w), dtype=complex)
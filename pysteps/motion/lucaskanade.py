@@ -1,10 +1,12 @@
 """OpenCV implementation of the Lucas-Kanade method with interpolated motion
 vectors for areas with no precipitation."""
 
+import concurrent.futures
 import numpy as np
 import cv2
 import scipy.spatial
-import time
+
+from ..utils import profiling
 
 def dense_lucaskanade(R, **kwargs):
     """OpenCV implementation of the Lucas-Kanade method with interpolated motion
@@ -59,14 +61,44 @@ def dense_lucaskanade(R, **kwargs):
         split the grid points in n chunks to limit the memory usage during the
         interpolation
         default : 5
+    interp_step : int
+        the step of the grid on which the sparse vectors are interpolated [px].
+        If greater than 1, the motion field is interpolated on the coarse grid
+        and bilinearly upsampled to the domain
+        default : 1
     extra_vectors : array-like
         additional sparse motion vectors as 2d array (columns: x,y,u,v; rows:
         nbr. of vectors) to be integrated with the sparse vectors from the Lucas-Kanade
         local tracking.
         x and y must be in pixel coordinates, with (0,0) being the upper-left
         corner of the field R. u and v must be in pixel units
+    timestamps : list
+        timestamps of the input fields R, e.g. as datetime.datetime objects.
+        The timestamps can be any hashable objects. Required if cache is given.
+    cache : dict
+        optional dictionary for reusing the sparse vectors of the frame pairs
+        in the next call (e.g. the next forecast cycle). The vectors of each
+        pair are stored into cache with keys containing the timestamps of the
+        pair, the grid size and the parameters of the tracking. The pairs
+        already found in the cache are not tracked again, so in a rolling
+        window only the newest pair is tracked. The declustering and the
+        interpolation are applied to the merged vectors. Only the pairs used
+        by the latest call are kept in the cache.
+        default : None
+    num_workers : int
+        the number of threads used for preparing the images, tracking the
+        frame pairs and interpolating the chunks of the grid. OpenCV and the
+        KD-tree queries release the GIL, so these run concurrently. The
+        vectors are stacked in the order of the pairs regardless of the number
+        of threads.
+        default : 1
     verbose : bool
         if set to True, it prints information about the program
+    profiler : str or object
+        the profiler sink that receives the spans 'lucaskanade',
+        'lucaskanade.tracking', 'lucaskanade.declustering' and
+        'lucaskanade.interpolation'. See pysteps.utils.profiling.
+        default : the default sink
 
     Returns
     -------
@@ -98,6 +130,7 @@ def dense_lucaskanade(R, **kwargs):
     k                   = kwargs.get("k", 20)
     epsilon             = kwargs.get("epsilon", None)
     nchunks             = kwargs.get("nchunks", 5)
+    interp_step         = kwargs.get("interp_step", 1)
     extra_vectors       = kwargs.get("extra_vectors", None)
     if extra_vectors is not None:
         if len(extra_vectors.shape) != 2:
@@ -106,35 +139,48 @@ def dense_lucaskanade(R, **kwargs):
         if extra_vectors.shape[1] != 4:
             raise ValueError("extra_vectors has %i columns, but 4 columns are expected"
                                % extra_vectors.shape[1])
+    timestamps          = kwargs.get("timestamps", None)
+    cache               = kwargs.get("cache", None)
+    if cache is not None:
+        if timestamps is None:
+            raise ValueError("cache is given but timestamps is None")
+        if len(timestamps) != R.shape[0]:
+            raise ValueError("R has %i frames, but %i timestamps are given"
+                             % (R.shape[0], len(timestamps)))
+    num_workers         = kwargs.get("num_workers", 1)
     verbose             = kwargs.get("verbose", True)
+    profiler            = kwargs.get("profiler", None)
+    sink                = profiling.get_sink(profiler)
     if verbose:
         print("Computing the motion field with the Lucas-Kanade method.")
-        t0 = time.time()
+
+    sp_total = profiling.span(sink, "lucaskanade").start()
+    sp_total.add(R)
 
     nr_fields = R.shape[0]
     domain_size = (R.shape[1], R.shape[2])
-    y0Stack=[]
-    x0Stack=[]
-    uStack=[]
-    vStack=[]
-    for n in range(nr_fields-1):
-
-        # extract consecutive images
-        prvs = R[n,:,:].copy()
-        next = R[n+1,:,:].copy()
-
-        # scale between 0 and 255
-        prvs = (prvs - prvs.min())/(prvs.max() - prvs.min())*255
-        next = (next - next.min())/(next.max() - next.min())*255
-
-        # convert to 8-bit
-        prvs = np.ndarray.astype(prvs,"uint8")
-        next = np.ndarray.astype(next,"uint8")
-
-        # remove small noise with a morphological operator (opening)
-        prvs = _clean_image(prvs, n=size_opening)
-        next = _clean_image(next, n=size_opening)
 
+    # the pairs whose vectors are found in the cache are not tracked
+    if cache is not None:
+        params = (domain_size, max_corners_ST, quality_level_ST,
+                  min_distance_ST, block_size_ST, winsize_LK, nr_levels_LK,
+                  nr_IQR_outlier, size_opening)
+        keys = [(timestamps[n], timestamps[n+1]) + params
+                for n in range(nr_fields-1)]
+        pairs = [n for n in range(nr_fields-1) if keys[n] not in cache]
+    else:
+        pairs = list(range(nr_fields-1))
+    frames = sorted(set(pairs) | set([n+1 for n in pairs]))
+
+    # prepare the 8-bit images, each field is used by two pairs
+    def prepare(n):
+        return _prepare_image(R[n,:,:], size_opening)
+
+    def track(n):
+        prvs = images[n]
+        next = images[n+1]
+
+        sp = profiling.span(sink, "lucaskanade.tracking", pair=n).start()
         # Shi-Tomasi good features to track
         # TODO: implement different feature detection algorithms (e.g. Harris)
         p0 = _ShiTomasi_features_to_track(prvs, max_corners_ST, quality_level_ST,
@@ -143,6 +189,7 @@ def dense_lucaskanade(R, **kwargs):
         # get sparse u, v vectors with Lucas-Kanade tracking
         x0, y0, u, v = _LucasKanade_features_tracking(prvs, next, p0, winsize_LK,
                                                      nr_levels_LK)
+        sp.add(u).stop()
 
         # exclude outlier vectors
         vel = np.sqrt(u**2 + v**2) # [px/timesteps]
@@ -151,16 +198,36 @@ def dense_lucaskanade(R, **kwargs):
         max_speed_thr = q2 + nr_IQR_outlier*(q2 - q1)
         keep = np.logical_and(vel < max_speed_thr, vel > min_speed_thr)
 
-        u = u[keep][:,None]
-        v = v[keep][:,None]
-        y0 = y0[keep][:,None]
-        x0 = x0[keep][:,None]
-
-        # stack vectors within time window
-        y0Stack.append(y0)
-        x0Stack.append(x0)
-        uStack.append(u)
-        vStack.append(v)
+        return x0[keep][:,None], y0[keep][:,None], u[keep][:,None], v[keep][:,None]
+
+    if num_workers > 1:
+        # map returns the results in the order of the pairs
+        with concurrent.futures.ThreadPoolExecutor(num_workers) as executor:
+            images  = dict(zip(frames, executor.map(prepare, frames)))
+            vectors = list(executor.map(track, pairs))
+    else:
+        images  = {n:prepare(n) for n in frames}
+        vectors = [track(n) for n in pairs]
+    images = None
+
+    if cache is not None:
+        for n,vectors_ in zip(pairs, vectors):
+            cache[keys[n]] = vectors_
+        vectors = [cache[key] for key in keys]
+
+        # keep only the pairs that can be used in the next call
+        for key in list(cache.keys()):
+            if key not in keys:
+                del cache[key]
+
+        if verbose:
+            print("Using %d cached frame pairs." % (nr_fields - 1 - len(pairs)))
+
+    # stack vectors within time window
+    x0Stack = [vectors_[0] for vectors_ in vectors]
+    y0Stack = [vectors_[1] for vectors_ in vectors]
+    uStack  = [vectors_[2] for vectors_ in vectors]
+    vStack  = [vectors_[3] for vectors_ in vectors]
 
     # convert lists of arrays into single arrays
     y0 = np.vstack(y0Stack)
@@ -169,7 +236,9 @@ def dense_lucaskanade(R, **kwargs):
     v = np.vstack(vStack)
 
     # decluster sparse motion vectors
+    sp = profiling.span(sink, "lucaskanade.declustering").start()
     x, y, u, v = _declustering(x0, y0, u, v, decl_grid, min_nr_samples)
+    sp.add(u).stop()
 
     # append extra vectors if provided
     if extra_vectors is not None:
@@ -179,14 +248,47 @@ def dense_lucaskanade(R, **kwargs):
         v = np.concatenate((v, extra_vectors[:, 3]))
 
     # kernel interpolation
+    sp = profiling.span(sink, "lucaskanade.interpolation").start()
     X, Y, UV = _interpolate_sparse_vectors(x, y, u, v, domain_size, function=function,
-                                          k=k, epsilon=epsilon, nchunks=nchunks)
+                                          k=k, epsilon=epsilon, nchunks=nchunks,
+                                          interp_step=interp_step,
+                                          num_workers=num_workers)
+    sp.add(UV).stop()
+
+    sp_total.stop()
 
     if verbose:
-        print("--- %s seconds ---" % (time.time() - t0))
+        print("--- %s seconds ---" % sp_total.duration)
 
     return UV
 
+def _prepare_image(R, size_opening):
+    """Convert a precipitation field into an 8-bit image for the feature
+    detection and tracking.
+
+    Parameters
+    ----------
+    R : array-like
+        Array of shape (m,n) containing the input precipitation field.
+    size_opening : int
+        The structuring element size for the filtering of isolated pixels [px].
+
+    Returns
+    -------
+    R : array
+        Array of shape (m,n) containing the cleaned 8-bit image.
+
+    """
+
+    # scale between 0 and 255
+    R = (R - R.min())/(R.max() - R.min())*255
+
+    # convert to 8-bit
+    R = np.ndarray.astype(R,"uint8")
+
+    # remove small noise with a morphological operator (opening)
+    return _clean_image(R, n=size_opening)
+
 def _ShiTomasi_features_to_track(R, max_corners_ST, quality_level_ST,
                                  min_distance_ST, block_size_ST):
     """Call the Shi-Tomasi corner detection algorithm.
@@ -347,11 +449,11 @@ def _declustering(x, y, u, v, decl_grid, min_nr_samples):
     velocity components of the declustered motion vectors.
 
     """
-    # make sure these are all vertical arrays
-    x = x[:,None]
-    y = y[:,None]
-    u = u[:,None]
-    v = v[:,None]
+    # make sure these are all flat arrays
+    x = np.ravel(x)
+    y = np.ravel(y)
+    u = np.ravel(u)
+    v = np.ravel(v)
 
     # discretize coordinates into declustering grid
     xT = x/float(decl_grid)
@@ -361,34 +463,33 @@ def _declustering(x, y, u, v, decl_grid, min_nr_samples):
     xT = np.floor(xT)
     yT = np.floor(yT)
 
-    # keep only unique combinations of coordinates
-    xy = np.hstack((xT,yT)).squeeze()
+    # assign the vectors to the unique combinations of coordinates, the cells
+    # are ordered as the unique byte strings of the coordinates
+    xy = np.column_stack((xT,yT))
     xyb = np.ascontiguousarray(xy).view(np.dtype((np.void, xy.dtype.itemsize*xy.shape[1])))
-    _,idx = np.unique(xyb, return_index=True)
-    unique_xy = xy[idx]
-
-    # now loop through these unique values and average vectors which belong to
-    # the same declustering grid cell
-    xN=[]; yN=[]; uN=[]; vN=[]
-    for i in range(unique_xy.shape[0]):
-        idx = np.logical_and(xT==unique_xy[i,0], yT==unique_xy[i,1])
-        npoints = np.sum(idx)
-        if npoints >= min_nr_samples:
-            xN.append(np.median(x[idx]))
-            yN.append(np.median(y[idx]))
-            uN.append(np.median(u[idx]))
-            vN.append(np.median(v[idx]))
-
-    # convert to numpy arrays
-    x = np.array(xN)
-    y = np.array(yN)
-    u = np.array(uN)
-    v = np.array(vN)
-
-    return x, y, u, v
+    _,cells,npoints = np.unique(xyb.ravel(), return_inverse=True, return_counts=True)
+    cells = cells.ravel()
+
+    # take the medians of the vectors which belong to the same declustering
+    # grid cell from the values sorted within each cell
+    keep = npoints >= min_nr_samples
+    start = (np.cumsum(npoints) - npoints)[keep]
+    npoints = npoints[keep]
+    lo = start + (npoints - 1) // 2
+    hi = start + npoints // 2
+
+    def median(values):
+        values = values[np.lexsort((values, cells))]
+        return np.where(lo == hi, values[lo], (values[lo] + values[hi]) / 2)
+
+    if len(npoints) == 0:
+        return np.array([]), np.array([]), np.array([]), np.array([])
+
+    return median(x), median(y), median(u), median(v)
 
 def _interpolate_sparse_vectors(x, y, u, v, domain_size, function="inverse",
-                               k=20, epsilon=None, nchunks=5):
+                               k=20, epsilon=None, nchunks=5, interp_step=1,
+                               num_workers=1):
 
     """Interpolation of sparse motion vectors to produce a dense field of motion
     vectors.
@@ -415,11 +516,21 @@ def _interpolate_sparse_vectors(x, y, u, v, domain_size, function="inverse",
         default : 20
     epsilon : float
         adjustable constant for gaussian or inverse functions
-        default : median distance between sparse vectors
+        default : median distance between sparse vectors, which is estimated
+        from a subset of the vectors if there are more than 2000 of them
     nchunks : int
         split the grid points in n chunks to limit the memory usage during the
-        interpolation
+        interpolation. With k="all", the chunks are further split so that each
+        of them has at most 10^7 distances.
         default : 5
+    interp_step : int
+        the step of the grid on which the vectors are interpolated [px]. If
+        greater than 1, the coarse motion field is bilinearly upsampled to the
+        domain.
+        default : 1
+    num_workers : int
+        the number of threads used for interpolating the chunks
+        default : 1
 
     Returns
     -------
@@ -441,13 +552,21 @@ def _interpolate_sparse_vectors(x, y, u, v, domain_size, function="inverse",
     u = u[:,None]
     v = v[:,None]
     points = np.column_stack((x, y))
+    u = u.flatten()
+    v = v.flatten()
 
     if len(domain_size)==1:
         domain_size = (domain_size, domain_size)
 
-    # generate the grid
-    xgrid = np.arange(domain_size[1])
-    ygrid = np.arange(domain_size[0])
+    # generate the grid, which includes the last row and column of the domain
+    # if it is coarse
+    xgrid = np.arange(0, domain_size[1], interp_step)
+    ygrid = np.arange(0, domain_size[0], interp_step)
+    if interp_step > 1:
+        if xgrid[-1] != domain_size[1] - 1:
+            xgrid = np.append(xgrid, domain_size[1] - 1)
+        if ygrid[-1] != domain_size[0] - 1:
+            ygrid = np.append(ygrid, domain_size[0] - 1)
     X, Y = np.meshgrid(xgrid, ygrid)
     grid = np.column_stack((X.ravel(), Y.ravel()))
 
@@ -458,38 +577,44 @@ def _interpolate_sparse_vectors(x, y, u, v, domain_size, function="inverse",
     if k is not "all":
         k = np.min((k, points.shape[0]))
         tree = scipy.spatial.cKDTree(points)
+    else:
+        # limit the size of the distance matrices
+        nchunks = max(nchunks, int(np.ceil(grid.shape[0]*points.shape[0] / 1e7)))
+
+    # the bandwidth
+    if epsilon is None and function.lower() != "nearest":
+        epsilon = _median_distance(points)
 
     # split grid points in n chunks
     subgrids = np.array_split(grid, nchunks, 0)
     subgrids = [x for x in subgrids if x.size > 0]
+    i0 = np.cumsum([0] + [subgrid.shape[0] for subgrid in subgrids])
 
-    # loop subgrids
-    i0=0
-    for i,subgrid in enumerate(subgrids):
-
-        idelta = subgrid.shape[0]
+    # interpolate the chunk i
+    def worker(i):
+        subgrid = subgrids[i]
+        chunk = slice(i0[i], i0[i+1])
 
         if function.lower() == "nearest":
 
             # find indices of the nearest neighbors
             _, inds = tree.query(subgrid, k=1)
 
-            U[i0:(i0+idelta)] = u.flatten()[inds]
-            V[i0:(i0+idelta)] = v.flatten()[inds]
+            U[chunk] = u[inds]
+            V[chunk] = v[inds]
 
         else:
             if k == "all":
+                # all vectors are used, so no indices are needed
                 d = scipy.spatial.distance.cdist(points, subgrid, 'euclidean').transpose()
-                inds = np.arange(u.size)[None,:]*np.ones((subgrid.shape[0],u.size)).astype(int)
+                u_ = u[None,:]
+                v_ = v[None,:]
 
             else:
                 # find indices of the k-nearest neighbors
                 d, inds = tree.query(subgrid, k=k)
-
-            # the bandwidth
-            if epsilon is None:
-                dpoints = scipy.spatial.distance.pdist(points, 'euclidean')
-                epsilon = np.median(dpoints)
+                u_ = u[inds]
+                v_ = v[inds]
 
             # the interpolation weights
             if function.lower() == "inverse":
@@ -499,16 +624,28 @@ def _interpolate_sparse_vectors(x, y, u, v, domain_size, function="inverse",
             else:
                 raise ValueError("unknown radial fucntion %s" % function)
 
-            U[i0:(i0+idelta)] = np.sum(w * u.flatten()[inds], axis=1) / np.sum(w, axis=1)
-            V[i0:(i0+idelta)] = np.sum(w * v.flatten()[inds], axis=1) / np.sum(w, axis=1)
+            # the products are in C order to sum them in the same order with
+            # and without the indices
+            U[chunk] = np.sum(np.multiply(w, u_, order="C"), axis=1) / np.sum(w, axis=1)
+            V[chunk] = np.sum(np.multiply(w, v_, order="C"), axis=1) / np.sum(w, axis=1)
 
-        i0 += idelta
+    # loop subgrids
+    if num_workers > 1:
+        with concurrent.futures.ThreadPoolExecutor(num_workers) as executor:
+            list(executor.map(worker, range(len(subgrids))))
+    else:
+        for i in range(len(subgrids)):
+            worker(i)
 
     # reshape back to original size
-    U = U.reshape(domain_size[0], domain_size[1])
-    V = V.reshape(domain_size[0], domain_size[1])
+    U = U.reshape(len(ygrid), len(xgrid))
+    V = V.reshape(len(ygrid), len(xgrid))
     UV = np.stack([U, V])
 
+    if interp_step > 1:
+        UV = _upsample_bilinear(UV, xgrid, ygrid, domain_size)
+        X, Y = np.meshgrid(np.arange(domain_size[1]), np.arange(domain_size[0]))
+
     if testinterpolation:
         import matplotlib.pylab as plt
         step=15
@@ -520,3 +657,65 @@ def _interpolate_sparse_vectors(x, y, u, v, domain_size, function="inverse",
         plt.show()
 
     return X, Y, UV
+
+def _median_distance(points, max_points=2000):
+    """Compute the median distance between the given points. With more than
+    max_points points, the median is estimated from an evenly strided subset
+    of max_points points to limit the memory usage of the pairwise distances.
+
+    Parameters
+    ----------
+    points : array-like
+        Array of shape (n,2) containing the coordinates of the points.
+    max_points : int
+        The maximum number of points used for computing the distances.
+
+    Returns
+    -------
+    out : float
+        The median distance.
+
+    """
+    if points.shape[0] > max_points:
+        idx = np.linspace(0, points.shape[0] - 1, max_points).astype(int)
+        points = points[idx, :]
+
+    return np.median(scipy.spatial.distance.pdist(points, 'euclidean'))
+
+def _upsample_bilinear(F, xgrid, ygrid, domain_size):
+    """Bilinearly interpolate fields given on a coarse grid to all pixels of the
+    domain.
+
+    Parameters
+    ----------
+    F : array-like
+        Array of shape (k,len(ygrid),len(xgrid)) containing the fields.
+    xgrid : array-like
+        Increasing x-coordinates of the coarse grid, covering the domain.
+    ygrid : array-like
+        Increasing y-coordinates of the coarse grid, covering the domain.
+    domain_size : tuple
+        Size of the domain [px].
+
+    Returns
+    -------
+    out : array
+        Array of shape (k,domain_size[0],domain_size[1]) containing the
+        interpolated fields.
+
+    """
+    def weights(grid, n):
+        # the indices of the left grid points and the weights of the right ones
+        c = np.arange(n)
+        if len(grid) == 1:
+            return np.zeros(n, dtype=int), np.zeros(n, dtype=int), np.zeros(n)
+        i = np.clip(np.searchsorted(grid, c, side="right") - 1, 0, len(grid) - 2)
+        return i, i + 1, (c - grid[i]) / (grid[i+1] - grid[i])
+
+    i0, i1, wx = weights(xgrid, domain_size[1])
+    F = F[:, :, i0]*(1 - wx) + F[:, :, i1]*wx
+
+    i0, i1, wy = weights(ygrid, domain_size[0])
+    F = F[:, i0, :]*(1 - wy[:, None]) + F[:, i1, :]*wy[:, None]
+
+    return F
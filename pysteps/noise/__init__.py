@@ -1,2 +1,3 @@
 from .interface import get_method
 from . import utils
+from . import streams
@@ -23,28 +23,18 @@ where F (m, n) is a filter returned from an initialization method, and randstate
 and seed can be used to set the random generator and its seed. Additional
 keyword arguments can be included as a dictionary.
 The output of each generator method is a two-dimensional array containing the
-field of correlated noise cN of shape (m, n)."""
+field of correlated noise cN of shape (m, n). If randstate is a list of k
+random generators, one noise field is drawn from each of them and the output
+is a three-dimensional array of shape (k, m, n). The random generators can be
+numpy.random.RandomState or numpy.random.Generator objects, e.g. the streams
+returned by pysteps.noise.streams."""
 
 import numpy as np
 from scipy import optimize
 
 # TODO: Update the methods so that they allow inputs with non-square shapes.
 
-# Use the pyfftw interface if it is installed. If not, fall back to the fftpack
-# interface provided by SciPy, and finally to numpy if SciPy is not installed.
-try:
-    import pyfftw.interfaces.numpy_fft as fft
-    import pyfftw
-    # TODO: Caching and multithreading currently disabled because they give a
-    # segfault with dask.
-    #pyfftw.interfaces.cache.enable()
-    fft_kwargs = {"threads":1, "planner_effort":"FFTW_ESTIMATE"}
-except ImportError:
-    import scipy.fftpack as fft
-    fft_kwargs = {}
-except ImportError:
-    import numpy.fft as fft
-    fft_kwargs = {}
+from ..utils import fft as fft_utils
 
 def initialize_param_2d_fft_filter(X, **kwargs):
     """Takes a 2d input field and produces a fourier filter by using the Fast
@@ -70,6 +60,10 @@ def initialize_param_2d_fft_filter(X, **kwargs):
     doplot : bool
         Plot the fit.
         Default : False
+    fft_method : str or object
+        The FFT backend to use, given as a name or an object returned by
+        pysteps.utils.fft.get_backend.
+        Default : None (use the default backend)
 
     Returns
     -------
@@ -88,6 +82,7 @@ def initialize_param_2d_fft_filter(X, **kwargs):
     model    = kwargs.get('model', 'power-law')
     weighted = kwargs.get('weighted', True)
     doplot   = kwargs.get('doplot', False)
+    fft      = fft_utils.get_backend(kwargs.get('fft_method', None))
 
     M,N = X.shape
 
@@ -101,7 +96,7 @@ def initialize_param_2d_fft_filter(X, **kwargs):
     if model.lower() == 'power-law':
 
         # compute radially averaged PSD
-        psd = _rapsd(X*tapering)
+        psd = _rapsd(X*tapering, fft)
         L = max(M,N)
 
         # wavenumbers
@@ -167,6 +162,10 @@ def initialize_nonparam_2d_fft_filter(X, **kwargs):
     donorm : bool
        Option to normalize the real and imaginary parts.
        Default : False
+    fft_method : str or object
+       The FFT backend to use, given as a name or an object returned by
+       pysteps.utils.fft.get_backend.
+       Default : None (use the default backend)
 
     Returns
     -------
@@ -182,6 +181,7 @@ def initialize_nonparam_2d_fft_filter(X, **kwargs):
     # defaults
     win_type = kwargs.get('win_type', 'flat-hanning')
     donorm   = kwargs.get('donorm', False)
+    fft      = fft_utils.get_backend(kwargs.get('fft_method', None))
 
     X = X.copy()
     if win_type is not None:
@@ -189,7 +189,7 @@ def initialize_nonparam_2d_fft_filter(X, **kwargs):
         tapering = build_2D_tapering_function(X.shape, win_type)
     else:
         tapering = np.ones_like(X)
-    F = fft.fft2(X*tapering, **fft_kwargs)
+    F = fft.fft2(X*tapering)
 
     # normalize the real and imaginary parts
     if donorm:
@@ -198,7 +198,8 @@ def initialize_nonparam_2d_fft_filter(X, **kwargs):
 
     return np.abs(F)
 
-def generate_noise_2d_fft_filter(F, randstate=np.random, seed=None):
+def generate_noise_2d_fft_filter(F, randstate=np.random, seed=None,
+                                 fft_method=None, dtype=None):
     """Produces a field of correlated noise using global Fourier filtering.
 
     Parameters
@@ -207,15 +208,26 @@ def generate_noise_2d_fft_filter(F, randstate=np.random, seed=None):
         Two-dimensional array containing the input filter.
         It can be computed by related methods.
         All values are required to be finite.
-    randstate : mtrand.RandomState
+    randstate : mtrand.RandomState, numpy.random.Generator or list
         Optional random generator to use. If set to None, use numpy.random.
+        If a list of random generators is given, one noise field is generated
+        with each of them, and the Fourier filtering is applied to all fields
+        at once.
     seed : int
         Value to set a seed for the generator. None will not set the seed.
+    fft_method : str or object
+        The FFT backend to use, given as a name or an object returned by
+        pysteps.utils.fft.get_backend. None uses the default backend.
+    dtype : str or numpy.dtype
+        The floating point type of the output, e.g. 'float32' for single
+        precision. None uses the floating point type of F.
 
     Returns
     -------
     N : array-like
-        A two-dimensional numpy array of stationary correlated noise.
+        A two-dimensional numpy array of stationary correlated noise, or a
+        three-dimensional array of shape (k,m,n) if randstate is a list of k
+        random generators.
     """
 
     if len(F.shape) != 2:
@@ -223,18 +235,18 @@ def generate_noise_2d_fft_filter(F, randstate=np.random, seed=None):
     if np.any(~np.isfinite(F)):
       raise ValueError("F contains non-finite values")
 
-    # set the seed
-    if seed is not None:
-        randstate.seed(seed)
+    fft = fft_utils.get_backend(fft_method)
+    dtype = np.result_type(F.dtype, np.float32) if dtype is None else np.dtype(dtype)
 
     # produce fields of white noise
-    N = randstate.randn(F.shape[0], F.shape[1])
+    N = _generate_white_noise(randstate, seed, F.shape, dtype)
 
     # apply the global Fourier filter to impose a correlation structure
-    fN = fft.fft2(N, **fft_kwargs)
-    fN *= F
-    N = np.array(fft.ifft2(fN, **fft_kwargs).real)
-    N = (N - N.mean())/N.std()
+    fN = fft.fft2(N, axes=(-2, -1))
+    fN *= F.astype(dtype, copy=False)
+    N = np.array(fft.ifft2(fN, axes=(-2, -1)).real, dtype=dtype)
+    N = (N - N.mean(axis=(-2, -1), keepdims=True)) / \
+        N.std(axis=(-2, -1), keepdims=True)
 
     return N
 
@@ -262,6 +274,10 @@ def initialize_nonparam_2d_ssft_filter(X, **kwargs):
     war_thr : float [0,1]
         Threshold for the minimum fraction of rain needed for computing the FFT.
         Default : 0.1
+    fft_method : str or object
+        The FFT backend to use, given as a name or an object returned by
+        pysteps.utils.fft.get_backend.
+        Default : None (use the default backend)
 
     Returns
     -------
@@ -287,6 +303,7 @@ def initialize_nonparam_2d_ssft_filter(X, **kwargs):
     win_type = kwargs.get('win_type', 'flat-hanning')
     overlap  = kwargs.get('overlap', 0.3)
     war_thr  = kwargs.get('war_thr', 0.1)
+    fft_method = kwargs.get('fft_method', None)
 
     # make sure non-rainy pixels are set to zero
     min_value = np.min(X)
@@ -309,7 +326,8 @@ def initialize_nonparam_2d_ssft_filter(X, **kwargs):
     num_windows_x = np.ceil( float(dim_x) / win_size[1] ).astype(int)
 
     # domain fourier filter
-    F0 = initialize_nonparam_2d_fft_filter(X, win_type=win_type, donorm=True)
+    F0 = initialize_nonparam_2d_fft_filter(X, win_type=win_type, donorm=True,
+                                           fft_method=fft_method)
     # and allocate it to the final grid
     F = np.zeros((num_windows_y, num_windows_x, F0.shape[0], F0.shape[1]))
     F += F0[np.newaxis, np.newaxis, :, :]
@@ -332,7 +350,8 @@ def initialize_nonparam_2d_ssft_filter(X, **kwargs):
 
             if war > war_thr:
                 # the new filter
-                F[i, j, : ,:] = initialize_nonparam_2d_fft_filter(X*mask, win_type=None, donorm=True)
+                F[i, j, : ,:] = initialize_nonparam_2d_fft_filter(X*mask, win_type=None, donorm=True,
+                                                                  fft_method=fft_method)
 
     return F
 
@@ -358,6 +377,10 @@ def initialize_nonparam_2d_nested_filter(X, gridres=1.0, **kwargs):
     war_thr : float [0;1]
         Threshold for the minimum fraction of rain needed for computing the FFT.
         Default : 0.1
+    fft_method : str or object
+        The FFT backend to use, given as a name or an object returned by
+        pysteps.utils.fft.get_backend.
+        Default : None (use the default backend)
 
     Returns
     -------
@@ -378,6 +401,8 @@ def initialize_nonparam_2d_nested_filter(X, gridres=1.0, **kwargs):
     max_level = kwargs.get('max_level', 3)
     win_type  = kwargs.get('win_type', 'flat-hanning')
     war_thr   = kwargs.get('war_thr', 0.1)
+    fft_method = kwargs.get('fft_method', None)
+    fft       = fft_utils.get_backend(fft_method)
 
     # make sure non-rainy pixels are set to zero
     min_value = np.min(X)
@@ -403,7 +428,8 @@ def initialize_nonparam_2d_nested_filter(X, gridres=1.0, **kwargs):
     freq_grid = np.sqrt(fx**2 + fy**2)
 
     # domain fourier filter
-    F0 = initialize_nonparam_2d_fft_filter(X, win_type=win_type, donorm=True)
+    F0 = initialize_nonparam_2d_fft_filter(X, win_type=win_type, donorm=True,
+                                           fft_method=fft_method)
     # and allocate it to the final grid
     F = np.zeros((2**max_level, 2**max_level, F0.shape[0], F0.shape[1]))
     F += F0[np.newaxis, np.newaxis, :, :]
@@ -426,7 +452,8 @@ def initialize_nonparam_2d_nested_filter(X, gridres=1.0, **kwargs):
 
                 if war > war_thr:
                     # the new filter
-                    newfilter = initialize_nonparam_2d_fft_filter(X*mask, win_type=None, donorm=True)
+                    newfilter = initialize_nonparam_2d_fft_filter(X*mask, win_type=None, donorm=True,
+                                                                  fft_method=fft_method)
 
                     # compute logistic function to define weights as function of frequency
                     # k controls the shape of the weighting function
@@ -455,8 +482,10 @@ def generate_noise_2d_ssft_filter(F, randstate=np.random, seed=None, **kwargs):
     F : array-like
         Four-dimensional array containing the 2d fourier filters distributed over
         a 2d spatial grid.
-    randstate : mtrand.RandomState
+    randstate : mtrand.RandomState, numpy.random.Generator or list
         Optional random generator to use. If set to None, use numpy.random.
+        If a list of random generators is given, one noise field is generated
+        with each of them.
     seed : int
         Value to set a seed for the generator. None will not set the seed.
 
@@ -468,14 +497,28 @@ def generate_noise_2d_ssft_filter(F, randstate=np.random, seed=None, **kwargs):
     win_type : string ['hanning', 'flat-hanning']
         Type of window used for localization.
         Default : flat-hanning
+    fft_method : str or object
+        The FFT backend to use, given as a name or an object returned by
+        pysteps.utils.fft.get_backend.
+        Default : None (use the default backend)
+    dtype : str or numpy.dtype
+        The floating point type of the output, e.g. 'float32' for single
+        precision.
+        Default : None (use the floating point type of F)
 
     Returns
     -------
     N : array-like
-        A two-dimensional numpy array of non-stationary correlated noise.
+        A two-dimensional numpy array of non-stationary correlated noise, or a
+        three-dimensional array of shape (k,m,n) if randstate is a list of k
+        random generators.
 
     """
 
+    if isinstance(randstate, (list, tuple)):
+        return np.stack([generate_noise_2d_ssft_filter(F, randstate=rs, **kwargs)
+                         for rs in randstate])
+
     if len(F.shape) != 4:
         raise ValueError("the input is not four-dimensional array")
     if np.any(~np.isfinite(F)):
@@ -484,18 +527,17 @@ def generate_noise_2d_ssft_filter(F, randstate=np.random, seed=None, **kwargs):
     # defaults
     overlap  = kwargs.get('overlap', 0.2)
     win_type = kwargs.get('win_type', 'flat-hanning')
-
-    # set the seed
-    if seed is not None:
-        randstate.seed(seed)
+    fft      = fft_utils.get_backend(kwargs.get('fft_method', None))
+    dtype    = kwargs.get('dtype', None)
+    dtype    = np.result_type(F.dtype, np.float32) if dtype is None else np.dtype(dtype)
 
     dim_y = F.shape[2]
     dim_x = F.shape[3]
     dim = (dim_y, dim_x)
 
     # produce fields of white noise
-    N = randstate.randn(dim_y, dim_x)
-    fN = fft.fft2(N, **fft_kwargs)
+    N = _generate_white_noise(randstate, seed, dim, dtype)
+    fN = fft.fft2(N)
 
     # initialize variables
     cN = np.zeros(dim)
@@ -517,7 +559,7 @@ def generate_noise_2d_ssft_filter(F, randstate=np.random, seed=None, **kwargs):
             # apply fourier filtering with local filter
             lF = F[i,j,:,:]
             flN = fN * lF
-            flN = np.array(fft.ifft2(flN, **fft_kwargs).real)
+            flN = np.array(fft.ifft2(flN).real)
 
             # compute indices of local window
             idxi[0] = np.max( (i*win_size[0] - overlap*win_size[0], 0) ).astype(int)
@@ -534,7 +576,7 @@ def generate_noise_2d_ssft_filter(F, randstate=np.random, seed=None, **kwargs):
     cN[sM > 0] /= sM[sM > 0]
     cN = (cN - cN.mean())/cN.std()
 
-    return cN
+    return cN.astype(dtype, copy=False)
 
 def build_2D_tapering_function(win_size, win_type='flat-hanning'):
     """Produces two-dimensional tapering function for rectangular fields.
@@ -592,7 +634,34 @@ def build_2D_tapering_function(win_size, win_type='flat-hanning'):
 
     return w2d
 
-def _rapsd(X):
+def _generate_white_noise(randstate, seed, shape, dtype=np.float64):
+    """Draw a field of Gaussian white noise from the given random generator, or
+    a stack of fields if randstate is a list of random generators.
+    """
+    if isinstance(randstate, (list, tuple)):
+        if seed is not None:
+            raise ValueError("seed cannot be set when randstate is a list")
+        N = np.empty((len(randstate), shape[0], shape[1]), dtype=dtype)
+        for i,rs in enumerate(randstate):
+            N[i, :, :] = _randn(rs, shape)
+        return N
+
+    # set the seed
+    if seed is not None:
+        if isinstance(randstate, np.random.Generator):
+            raise ValueError("seed cannot be set for a numpy.random.Generator")
+        randstate.seed(seed)
+
+    return _randn(randstate, shape).astype(dtype, copy=False)
+
+def _randn(randstate, shape):
+    # the Generator interface has no randn
+    if isinstance(randstate, np.random.Generator):
+        return randstate.standard_normal((shape[0], shape[1]))
+    else:
+        return randstate.randn(shape[0], shape[1])
+
+def _rapsd(X, fft):
     """Compute radially averaged PSD of input field X.
     """
 
@@ -606,7 +675,7 @@ def _rapsd(X):
 
     R = np.sqrt(XC*XC + YC*YC).astype(int)
 
-    F = fft.fftshift(fft.fft2(X, **fft_kwargs))
+    F = fft.fftshift(fft.fft2(X))
     F = abs(F)**2
 
     L = max(X.shape[0], X.shape[1])
@@ -60,10 +60,11 @@ def initialize_bps(V, pixelsperkm, timestep, p_pert_par=None, p_pert_perp=None,
       Spatial resolution of the motion field (pixels/kilometer).
     timestep : float
       Time step for the motion vectors (minutes).
-    randstate : mtrand.RandomState
+    randstate : mtrand.RandomState or numpy.random.Generator
       Optional random generator to use. If set to None, use numpy.random.
     seed : int
-      Optional seed number for the random generator.
+      Optional seed number for the random generator. Cannot be used with a
+      numpy.random.Generator.
 
     Returns
     -------
@@ -93,6 +94,8 @@ def initialize_bps(V, pixelsperkm, timestep, p_pert_par=None, p_pert_perp=None,
     perturbator = {}
 
     if seed is not None:
+        if isinstance(randstate, np.random.Generator):
+            raise ValueError("seed cannot be set for a numpy.random.Generator")
         randstate.seed(seed)
 
     v_pert_x = randstate.laplace()
@@ -0,0 +1,89 @@
+"""Counter-based random streams for reproducible ensembles.
+
+The random numbers of an ensemble forecast are drawn from independent streams
+addressed by the tuple (seed, member, timestep, purpose). Each stream is a
+numpy.random.Generator using the counter-based Philox bit generator, which is
+initialized from a numpy.random.SeedSequence whose spawn key is derived from
+the address. Thus, the random numbers of an ensemble member at a given time
+step do not depend on the other members or time steps, or on the order in
+which they are computed. The members and time steps can then be computed in
+any order by any worker (a thread, a process or a node), and the results are
+identical to those of a serial computation.
+
+The following purposes are available:
+
++-------------------+----------------------------------------------------------+
+|     Name          |              Description                                 |
++===================+==========================================================+
+|  precip           | noise fields for perturbing the precipitation field      |
++-------------------+----------------------------------------------------------+
+|  motion           | perturbations of the motion field                        |
++-------------------+----------------------------------------------------------+
+|  noise_adjustment | noise fields for computing the noise adjustment factors  |
++-------------------+----------------------------------------------------------+
+
+The generators returned by this module can be given as the randstate argument
+of the noise generators in pysteps.noise.fftgenerators and pysteps.noise.motion.
+"""
+
+import numpy as np
+
+PURPOSES = ("precip", "motion", "noise_adjustment")
+
+def create_seed(seed=None):
+    """Return the seed of a set of random streams.
+
+    Parameters
+    ----------
+    seed : int
+        The seed, which is returned as such if it is not None. If None, a new
+        seed is drawn from the entropy source of the operating system. The
+        returned seed can be used for reproducing the streams.
+
+    Returns
+    -------
+    out : int
+        The seed.
+
+    """
+    if seed is None:
+        return np.random.SeedSequence().entropy
+    else:
+        return int(seed)
+
+def get_generator(seed, member=0, timestep=0, purpose="precip"):
+    """Return the random generator of the stream with the given address.
+
+    Parameters
+    ----------
+    seed : int
+        The seed of the streams, e.g. returned by create_seed.
+    member : int
+        Index of the ensemble member.
+    timestep : int
+        Index of the time step.
+    purpose : str
+        The purpose of the random numbers. See the module documentation.
+
+    Returns
+    -------
+    out : numpy.random.Generator
+        A generator using the Philox bit generator. Generators created with the
+        same arguments produce identical sequences of random numbers.
+
+    """
+    if seed is None:
+        raise ValueError("seed is None, use create_seed to draw a seed")
+    if purpose not in PURPOSES:
+        raise ValueError("unknown purpose %s, the available purposes are %s" % \
+                         (purpose, str(PURPOSES)))
+
+    ss = np.random.SeedSequence(seed, spawn_key=(PURPOSES.index(purpose),
+                                                 int(member), int(timestep)))
+
+    return np.random.Generator(np.random.Philox(ss))
+
+def get_generators(seed, members, timestep=0, purpose="precip"):
+    """Return a list containing the random generators of the given ensemble
+    members. See get_generator."""
+    return [get_generator(seed, j, timestep, purpose) for j in members]
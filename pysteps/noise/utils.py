@@ -6,24 +6,13 @@ try:
     dask_imported = True
 except ImportError:
     dask_imported = False
-# Use the pyfftw interface if it is installed. If not, fall back to the fftpack
-# interface provided by SciPy, and finally to numpy if SciPy is not installed.
-try:
-    import pyfftw.interfaces.numpy_fft as fft
-    import pyfftw
-    # TODO: Caching and multithreading currently disabled because they give a
-    # segfault with dask.
-    #pyfftw.interfaces.cache.enable()
-    fft_kwargs = {"threads":1, "planner_effort":"FFTW_ESTIMATE"}
-except ImportError:
-    import scipy.fftpack as fft
-    fft_kwargs = {}
-except ImportError:
-    import numpy.fft as fft
-    fft_kwargs = {}
+from ..utils import fft as fft_utils
+from ..utils import profiling
+from . import streams
 
 def compute_noise_stddev_adjs(R, R_thr_1, R_thr_2, F, decomp_method, num_iter,
-                              conditional=True, num_workers=None):
+                              conditional=True, num_workers=None,
+                              fft_method=None, seed=None, profiler=None):
     """Apply a scale-dependent adjustment factor to the noise fields used in STEPS.
 
     Simulates the effect of applying a precipitation mask to a Gaussian noise
@@ -60,6 +49,18 @@ def compute_noise_stddev_adjs(R, R_thr_1, R_thr_2, F, decomp_method, num_iter,
     num_workers : int
         The number of workers to use for parallel computation. Set to None to
         use all available CPUs. Applicable if dask is enabled.
+    fft_method : str or object
+        The FFT backend to use, given as a name or an object returned by
+        pysteps.utils.fft.get_backend. None uses the default backend.
+    seed : int
+        Optional seed for the random streams of the noise fields (see
+        pysteps.noise.streams). The k-th noise field is drawn from the stream
+        of member k, so the results do not depend on the order in which the
+        noise fields are computed. If None, a new seed is drawn.
+    profiler : str or object
+        The profiler sink that receives the span 'noise.stddev_adjs' and the
+        spans 'noise.stddev_adjs.realization' of the noise fields. See
+        pysteps.utils.profiling. None uses the default sink.
 
     Returns
     -------
@@ -69,6 +70,12 @@ def compute_noise_stddev_adjs(R, R_thr_1, R_thr_2, F, decomp_method, num_iter,
 
     """
 
+    fft  = fft_utils.get_backend(fft_method)
+    sink = profiling.get_sink(profiler)
+
+    sp_total = profiling.span(sink, "noise.stddev_adjs", num_iter=num_iter).start()
+    sp_total.add(R)
+
     MASK = R >= R_thr_1
 
     R = R.copy()
@@ -81,26 +88,26 @@ def compute_noise_stddev_adjs(R, R_thr_1, R_thr_2, F, decomp_method, num_iter,
     R -= mu
 
     MASK_ = MASK if conditional else None
-    decomp_R = decomp_method(R, F, MASK=MASK_)
+    decomp_R = decomp_method(R, F, MASK=MASK_, fft_method=fft)
 
     if not dask_imported:
         N_stds = []
     else:
         res = []
 
-    randstates = []
-    seed = None
-    for k in range(num_iter):
-        randstates.append(np.random.RandomState(seed=seed))
-        seed = np.random.randint(0, high=1e9)
+    seed = streams.create_seed(seed)
 
     R_fft = abs(fft.fft2(R))
 
     for k in range(num_iter):
-        def worker():
+        def worker(k):
+            sp = profiling.span(sink, "noise.stddev_adjs.realization", k=k).start()
+
             # generate Gaussian white noise field, multiply it with the standard
             # deviation of the observed field and apply the precipitation mask
-            N = randstates[k].randn(R.shape[0], R.shape[1])
+            randstate = streams.get_generator(seed, member=k,
+                                              purpose="noise_adjustment")
+            N = randstate.standard_normal(R.shape)
             N = np.real(fft.ifft2(fft.fft2(N) * R_fft))
             N = N / np.std(N) * sigma + mu
             N[~MASK] = R_thr_2
@@ -108,14 +115,16 @@ def compute_noise_stddev_adjs(R, R_thr_1, R_thr_2, F, decomp_method, num_iter,
             # subtract the mean and decompose the masked noise field into a
             # cascade
             N -= mu
-            decomp_N = decomp_method(N, F, MASK=MASK_)
+            decomp_N = decomp_method(N, F, MASK=MASK_, fft_method=fft)
+
+            sp.add(N).stop()
 
             return decomp_N["stds"]
 
         if dask_imported:
-            res.append(dask.delayed(worker)())
+            res.append(dask.delayed(worker)(k))
         else:
-            N_stds.append(worker())
+            N_stds.append(worker(k))
 
     if dask_imported:
         N_stds = dask.compute(*res, num_workers=num_workers)
@@ -123,4 +132,8 @@ def compute_noise_stddev_adjs(R, R_thr_1, R_thr_2, F, decomp_method, num_iter,
     # for each cascade level, compare the standard deviations between the
     # observed field and the masked noise field, which gives the correction
     # factors
-    return decomp_R["stds"] / np.mean(np.vstack(N_stds), axis=0)
+    stddev_adjs = decomp_R["stds"] / np.mean(np.vstack(N_stds), axis=0)
+
+    sp_total.stop()
+
+    return stddev_adjs
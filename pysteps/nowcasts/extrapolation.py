@@ -1,9 +1,12 @@
 """Implementations of deterministic nowcasting methods."""
 
-import time
+import numpy as np
 from .. import extrapolation
+from ..utils import profiling
+from . import utils
 
-def forecast(R, V, num_timesteps, extrap_method="semilagrangian", extrap_kwargs={}):
+def forecast(R, V, num_timesteps, extrap_method="semilagrangian", out=None,
+             profiler=None, extrap_kwargs={}):
     """Generate a nowcast by applying a simple advection-based extrapolation to
     the given precipitation field.
 
@@ -23,6 +26,14 @@ def forecast(R, V, num_timesteps, extrap_method="semilagrangian", extrap_kwargs=
     extrap_method : {'semilagrangian'}
       Name of the extrapolation method to use. See the documentation of
       pysteps.extrapolation.interface.
+    out : array-like or str
+      Optional array of shape (num_timesteps,m,n) into which the nowcast is
+      written, or the path of a file into which it is written as a
+      numpy.memmap. The extrapolated fields are written directly into the
+      output array. See pysteps.nowcasts.utils.create_output_array.
+    profiler : str or object
+      The profiler sink that receives the span 'extrapolation.forecast'. See
+      pysteps.utils.profiling. None uses the default sink.
     extrap_kwargs : dict
       Optional dictionary that is supplied as keyword arguments to the
       extrapolation method.
@@ -31,7 +42,8 @@ def forecast(R, V, num_timesteps, extrap_method="semilagrangian", extrap_kwargs=
     -------
     out : ndarray
       Three-dimensional array of shape (num_timesteps,m,n) containing a time
-      series of nowcast precipitation fields.
+      series of nowcast precipitation fields. If out is given, this is the
+      output array.
 
     See also
     --------
@@ -40,15 +52,27 @@ def forecast(R, V, num_timesteps, extrap_method="semilagrangian", extrap_kwargs=
     """
     _check_inputs(R, V)
 
+    sink = profiling.get_sink(profiler)
+
     print("Computing extrapolation nowcast from a %dx%d input grid... " % \
           (R.shape[0], R.shape[1]), end="")
 
-    starttime = time.time()
+    sp = profiling.span(sink, "extrapolation.forecast",
+                        num_timesteps=num_timesteps).start()
 
     extrap_method = extrapolation.get_method(extrap_method)
+    if out is not None:
+        out = utils.create_output_array(out, (num_timesteps,) + R.shape,
+                                        R.dtype)
+        extrap_kwargs = extrap_kwargs.copy()
+        extrap_kwargs["out"] = out
     R_f = extrap_method(R, V, num_timesteps, **extrap_kwargs)
+    if isinstance(R_f, np.memmap):
+        R_f.flush()
+
+    sp.add(R_f).stop()
 
-    print("%.2f seconds." % (time.time() - starttime))
+    print("%.2f seconds." % sp.duration)
 
     return R_f
 
@@ -1,14 +1,23 @@
 """Implementation of the STEPS method."""
 
+import concurrent.futures
+import multiprocessing
 import numpy as np
+import os
 import scipy.ndimage
+import shutil
 import sys
-import time
+import tempfile
+import threading
+import traceback
 from .. import extrapolation
+from ..extrapolation import semilagrangian
 from .. import cascade
 from .. import noise
+from .. import utils
 from ..postprocessing import probmatching
 from ..timeseries import autoregression, correlation
+from . import utils as nowcast_utils
 try:
     import dask
     dask_imported = True
@@ -17,12 +26,18 @@ except ImportError:
 
 def forecast(R, V, n_timesteps, n_ens_members, n_cascade_levels, R_thr=None,
              kmperpixel=None, timestep=None, extrap_method="semilagrangian",
-             decomp_method="fft", bandpass_filter_method="gaussian",
+             precompute_trajectory=False, decomp_method="fft",
+             bandpass_filter_method="gaussian",
              noise_method="nonparametric", noise_stddev_adj=False, ar_order=2,
              vel_pert_method=None, conditional=False, use_precip_mask=True,
              use_probmatching=True, mask_method="incremental", callback=None,
-             return_output=True, seed=None, num_workers=None, extrap_kwargs={},
-             filter_kwargs={}, noise_kwargs={}, vel_pert_kwargs={}):
+             return_output=True, out=None, timestamps=None, cycle_cache=None,
+             checkpoint=None,
+             checkpoint_interval=1, resume=None, seed=None, num_workers=None,
+             parallel_method="dask", batch_members=False, noise_prefetch=0,
+             fft_method=None, domain="spatial", dtype="float64", profiler=None,
+             extrap_kwargs={}, filter_kwargs={}, noise_kwargs={},
+             vel_pert_kwargs={}):
     """Generate a nowcast ensemble by using the Short-Term Ensemble Prediction
     System (STEPS) method.
 
@@ -57,6 +72,18 @@ def forecast(R, V, n_timesteps, n_ens_members, n_cascade_levels, R_thr=None,
     extrap_method : {'semilagrangian'}
       Name of the extrapolation method to use. See the documentation of
       pysteps.extrapolation.interface.
+    precompute_trajectory : bool
+      If True, the extrapolation method is 'semilagrangian' and vel_pert_method
+      is None, the ensemble members are advected along the same trajectory,
+      which is computed once for all time steps with
+      pysteps.extrapolation.semilagrangian.compute_trajectory before the first
+      time step. This avoids recomputing the displacements for each member
+      and time step, but the displacements and the interpolation indices of
+      all time steps are kept in memory, which takes
+      n_timesteps*(2*s+8)*m*n bytes on 64-bit platforms, where s is the size
+      of the floating point type given by dtype (e.g. about 0.6 GB for 36
+      time steps of a 1000x1000 grid in single precision). Otherwise, the displacements are
+      computed one time step at a time.
     decomp_method : {'fft'}
       Name of the cascade decomposition method to use. See the documentation
       of pysteps.cascade.interface.
@@ -86,7 +113,9 @@ def forecast(R, V, n_timesteps, n_ens_members, n_cascade_levels, R_thr=None,
       to the most recently observed precipitation intensity field, 'sprog' = use the
       smoothed forecast field from S-PROG, where the AR(p) model has been applied,
       'incremental' = iteratively buffer the mask with a certain rate (currently
-      it is 1 km/min)
+      it is 1 km/min). The buffering is computed from a distance transform, so
+      its cost does not depend on the buffer size, and the masks of the
+      ensemble members are stored as packed bits.
     use_probmatching : bool
       If True, apply probability matching to the forecast field in order to
       preserve the distribution of the most recently observed precipitation
@@ -101,11 +130,142 @@ def forecast(R, V, n_timesteps, n_ens_members, n_cascade_levels, R_thr=None,
       Set to False to disable returning the outputs as numpy arrays. This can
       save memory if the intermediate results are written to output files using
       the callback function.
+    out : array-like or str
+      Optional array of shape (n_ens_members,n_timesteps,m,n) into which the
+      nowcast is written, or the path of a file into which it is written as a
+      numpy.memmap. The extrapolated fields of each time step are written
+      directly into the output array without intermediate copies, which allows
+      writing ensembles that do not fit into memory into a disk-backed buffer.
+      See pysteps.nowcasts.utils.create_output_array. When resuming from a
+      checkpoint and out is the path of an existing file, the file is opened
+      for updating, and the time steps computed before the checkpoint are
+      kept. If n_timesteps has been increased, the file is first extended
+      along the time axis.
+    timestamps : list
+      Timestamps of the input fields R, e.g. as datetime.datetime objects. The
+      timestamps can be any hashable objects. Required if cycle_cache is
+      given.
+    cycle_cache : dict
+      Optional dictionary for reusing the cascade decompositions of the input
+      fields in the next forecast cycles. The decompositions of the input
+      fields in their original positions are stored into cycle_cache with keys
+      containing the timestamp, the grid size, the precision and the filter
+      and decomposition parameters. The decompositions found in the cache are
+      not recomputed, and they are transformed into the Lagrangian coordinates
+      by advecting their cascade levels with the current motion field.
+      Passing the same dictionary to the forecasts of subsequent update cycles
+      thus leaves only the most recent field to be decomposed. The
+      decompositions of the fields that have left the input window are
+      removed from the cache. Note that advecting the cascade levels instead
+      of the fields is an approximation that changes the temporal
+      autocorrelations of the levels, and thus the AR(p) parameters and the
+      forecast, compared to the forecast without the cache. For the fields not
+      found in the cache, the advected fields are decomposed as without the
+      cache, so the first forecast with an empty cache is unchanged, but it
+      needs one additional decomposition for each previous field. Also, the
+      statistics of a cached decomposition are computed with the conditional
+      mask of the cycle in which it was stored.
+    checkpoint : str
+      Optional path of a file into which the complete state of the forecast
+      is written in the npz format after every checkpoint_interval time steps
+      and after the last time step. The state consists of the cascades of the
+      AR(p) models, the cascade statistics, the AR(p) parameters, the
+      displacements and masks of the ensemble members, the noise generator
+      and the seed of the random streams. The file is replaced
+      atomically, so an interrupted run always leaves a valid checkpoint.
+    checkpoint_interval : int
+      The number of time steps between checkpoints.
+    resume : str
+      Optional path of a checkpoint file written by a previous run. If given,
+      the forecast continues from the time step following the checkpoint
+      instead of starting from the beginning. The inputs R and V and the other
+      arguments must be the same as in the run that wrote the checkpoint,
+      except that n_timesteps can be increased to extend the forecast to
+      longer lead times. The outputs of the time steps before the checkpoint
+      are not recomputed: they are set to nan in a newly allocated output
+      array.
     seed : int
-      Optional seed number for the random generators.
+      Optional seed number for the random generators. The noise fields and
+      motion perturbations of each ensemble member and time step are drawn
+      from separate random streams addressed by the seed, the member, the time
+      step and the purpose of the random numbers (see pysteps.noise.streams).
+      Thus, the results do not depend on the order in which the members are
+      computed or on the number or type of the parallel workers. If None, a
+      new seed is drawn.
     num_workers : int
       The number of workers to use for parallel computation. Set to None to use
-      all available CPUs. Applicable if dask is enabled.
+      all available CPUs. Applicable if dask is enabled or parallel_method is
+      'processes'.
+    parallel_method : {'dask', 'processes'}
+      The method for computing the ensemble members in parallel. With 'dask',
+      the members are computed with dask in the threads of the main process
+      if dask is available. With 'processes', num_workers persistent worker
+      processes are started, and each of them iterates a fixed group of
+      members for the whole forecast. The read-only inputs (e.g. the filter,
+      the AR(p) parameters, the motion field, the noise filter and the sorted
+      target values of the probability matching) and the states of the
+      members are shared with the workers through memory-mapped files, which
+      are placed in /dev/shm if available, and only the forecast fields of
+      each time step are passed back. This avoids the global
+      interpreter lock and scales to a large number of cores. The inputs and
+      the extrap_kwargs must then be picklable, and FFT backends are
+      re-created by name in the workers. batch_members is not used with
+      'processes', as each worker iterates its members in one batch. The
+      results are the same with both methods: in particular, the probability
+      matching of each member uses the observed field as a read-only target,
+      so it does not depend on which members were matched before.
+    batch_members : bool
+      If True, keep the ensemble members in a single batched array and apply
+      the noise generation, cascade decomposition, AR(p) update, recomposition
+      and masking to all members at once instead of iterating each member in
+      a separate worker. This removes the per-member overhead for large
+      ensembles. The parallelization over members with dask is then disabled.
+    noise_prefetch : int
+      If greater than zero, the noise cascades are generated in background
+      threads up to noise_prefetch time steps ahead of the time step being
+      computed, so that the noise generation overlaps with the AR(p) update,
+      probability matching and advection. With dask, there is one background
+      thread per worker (at most one per ensemble member, or one if
+      batch_members is True). With parallel_method='processes', each worker
+      process has its own background thread. The prefetched cascades take
+      noise_prefetch*n_ens_members*n_cascade_levels fields of memory in
+      addition to those of the current time step. The results do not depend
+      on noise_prefetch.
+    fft_method : str or object
+      The FFT backend to use for the cascade decompositions and the noise
+      generators, given as a name or an object returned by
+      pysteps.utils.fft.get_backend. The number of threads used by each FFT is
+      set with pysteps.utils.fft.set_num_threads. When dask is used, keep
+      num_workers times the number of FFT threads at most equal to the number
+      of available cores. With noise_prefetch, the background threads run
+      their FFTs alongside those of the workers, so up to twice as many FFT
+      threads can be active.
+    domain : {'spatial', 'spectral'}
+      If 'spatial', the cascades are iterated in the spatial domain, which
+      requires one inverse FFT per cascade level for each noise field. If
+      'spectral', the cascades are kept as rfft2 half-spectra, the AR(p) model
+      is applied to the spectra, and the levels are summed in the spectral
+      domain so that only one inverse FFT is needed per member and time step.
+      Requires the 'fft' decomposition method.
+    dtype : {'float64', 'float32'}
+      The floating point precision of the computations. With 'float32', the
+      input fields, cascades, noise fields, displacements and outputs are
+      stored in single precision and the FFTs are computed in single
+      precision (complex64), which halves the memory footprint.
+    profiler : str or object
+      The profiler sink that receives the durations of the stages of the
+      nowcast as spans. See pysteps.utils.profiling. None uses the default
+      sink, which discards the spans unless it has been changed with
+      pysteps.utils.profiling.set_default_sink. The spans of the
+      initialization are 'steps.lagrangian_transform', 'steps.decomposition',
+      'steps.ar_estimation', 'steps.noise_init', 'steps.noise_adjustment' and
+      'steps.trajectory' (if precompute_trajectory is True). Each time step t
+      gives the span 'steps.timestep', and the spans
+      'steps.noise', 'steps.ar', 'steps.recomposition', 'steps.masking',
+      'steps.probmatching' and 'steps.advection' of the computation of each
+      group of ensemble members, which contain the items t and members. The
+      spans computed in worker processes are forwarded to the sink by the
+      main process. Writing a checkpoint gives the span 'steps.checkpoint'.
     extrap_kwargs : dict
       Optional dictionary that is supplied as keyword arguments to the
       extrapolation method.
@@ -124,18 +284,112 @@ def forecast(R, V, n_timesteps, n_ens_members, n_cascade_levels, R_thr=None,
     out : ndarray
       If return_output is True, a four-dimensional array of shape
       (n_ens_members,n_timesteps,m,n) containing a time series of forecast
-      precipitation fields for each ensemble member. Otherwise, a None value
-      is returned.
+      precipitation fields for each ensemble member. If out is given, this is
+      the output array. Otherwise, a None value is returned.
 
     See also
     --------
-    pysteps.extrapolation.interface, pysteps.cascade.interface,
+    iter_forecast, pysteps.extrapolation.interface, pysteps.cascade.interface,
     pysteps.noise.interface, pysteps.noise.utils.compute_noise_stddev_adjs
 
     References
     ----------
     :cite:`Seed2003`, :cite:`BPS2006`, :cite:`SPN2013`
 
+    """
+    if return_output or out is not None:
+        M,N = R.shape[1:]
+        out = _create_output_array(out, (n_ens_members, n_timesteps, M, N),
+                                   dtype, resume)
+
+    for t,R_f_ in iter_forecast(R, V, n_timesteps, n_ens_members,
+                                n_cascade_levels, R_thr=R_thr,
+                                kmperpixel=kmperpixel, timestep=timestep,
+                                extrap_method=extrap_method,
+                                precompute_trajectory=precompute_trajectory,
+                                decomp_method=decomp_method,
+                                bandpass_filter_method=bandpass_filter_method,
+                                noise_method=noise_method,
+                                noise_stddev_adj=noise_stddev_adj,
+                                ar_order=ar_order,
+                                vel_pert_method=vel_pert_method,
+                                conditional=conditional,
+                                use_precip_mask=use_precip_mask,
+                                use_probmatching=use_probmatching,
+                                mask_method=mask_method, out=out,
+                                timestamps=timestamps, cycle_cache=cycle_cache,
+                                checkpoint=checkpoint,
+                                checkpoint_interval=checkpoint_interval,
+                                resume=resume, seed=seed,
+                                num_workers=num_workers,
+                                parallel_method=parallel_method,
+                                batch_members=batch_members,
+                                noise_prefetch=noise_prefetch,
+                                fft_method=fft_method, domain=domain,
+                                dtype=dtype, profiler=profiler,
+                                extrap_kwargs=extrap_kwargs,
+                                filter_kwargs=filter_kwargs,
+                                noise_kwargs=noise_kwargs,
+                                vel_pert_kwargs=vel_pert_kwargs):
+        if callback is not None:
+            callback(R_f_)
+
+        if checkpoint is not None and isinstance(out, np.memmap):
+            # write the outputs to disk before the next checkpoint
+            out.flush()
+
+    if isinstance(out, np.memmap):
+        out.flush()
+
+    if return_output:
+        if n_ens_members == 1:
+            return out[0]
+        else:
+            return out
+    else:
+        return None
+
+def iter_forecast(R, V, n_timesteps, n_ens_members, n_cascade_levels,
+                  R_thr=None, kmperpixel=None, timestep=None,
+                  extrap_method="semilagrangian", precompute_trajectory=False,
+                  decomp_method="fft",
+                  bandpass_filter_method="gaussian",
+                  noise_method="nonparametric", noise_stddev_adj=False,
+                  ar_order=2, vel_pert_method=None, conditional=False,
+                  use_precip_mask=True, use_probmatching=True,
+                  mask_method="incremental", out=None, timestamps=None,
+                  cycle_cache=None, checkpoint=None,
+                  checkpoint_interval=1, resume=None, seed=None, num_workers=None,
+                  parallel_method="dask", batch_members=False, noise_prefetch=0,
+                  fft_method=None, domain="spatial", dtype="float64",
+                  profiler=None, extrap_kwargs={}, filter_kwargs={},
+                  noise_kwargs={}, vel_pert_kwargs={}):
+    """Generate a STEPS nowcast ensemble one time step at a time. This is a
+    generator that computes the next time step only when it is requested by
+    the consumer, and it keeps no references to the time steps that it has
+    already yielded. Thus, the memory needed for the outputs is one time step
+    of the ensemble instead of the whole forecast, and a slow consumer (e.g.
+    an exporter writing the fields into files) automatically throttles the
+    computation. The computation of the nowcast starts when the first time
+    step is requested.
+
+    The arguments are the same as in forecast, except that callback and
+    return_output are not used. If out is given, the forecast fields are also
+    written into it, and the yielded arrays are views to out.
+
+    Yields
+    ------
+    out : tuple
+      A tuple (t,R_f) for each time step, where t is the zero-based index of
+      the time step and R_f is a three-dimensional array of shape
+      (n_ens_members,m,n) containing the forecast precipitation fields for
+      that time step. The array is not reused by the generator, so the
+      consumer may keep it.
+
+    See also
+    --------
+    forecast
+
     """
     _check_inputs(R, V, ar_order)
 
@@ -145,9 +399,27 @@ def forecast(R, V, n_timesteps, n_ens_members, n_cascade_levels, R_thr=None,
     if np.any(~np.isfinite(V)):
         raise ValueError("V contains non-finite values")
 
+    if np.dtype(dtype) not in [np.float32, np.float64]:
+        raise ValueError("unsupported dtype %s: must be 'float32' or 'float64'" % str(dtype))
+
+    if domain not in ["spatial", "spectral"]:
+        raise ValueError("unknown domain %s: must be 'spatial' or 'spectral'" % domain)
+
     if mask_method not in ["obs", "sprog", "incremental"]:
         raise ValueError("unknown mask method %s: must be 'obs', 'sprog' or 'incremental'" % mask_method)
 
+    if cycle_cache is not None and timestamps is None:
+        raise ValueError("cycle_cache is given but timestamps=None")
+
+    if cycle_cache is not None and len(timestamps) != R.shape[0]:
+        raise ValueError("the number of timestamps does not match the number of input fields")
+
+    if parallel_method not in ["dask", "processes"]:
+        raise ValueError("unknown parallel method %s: must be 'dask' or 'processes'" % parallel_method)
+
+    if noise_prefetch < 0:
+        raise ValueError("noise_prefetch must be non-negative")
+
     if conditional and R_thr is None:
         raise Exception("conditional=True but R_thr is not set")
 
@@ -191,6 +463,9 @@ def forecast(R, V, n_timesteps, n_ens_members, n_cascade_levels, R_thr=None,
     print("precipitation mask:     %s" % ("yes" if use_precip_mask else "no"))
     print("mask method:            %s" % mask_method)
     print("probability matching:   %s" % ("yes" if use_probmatching else "no"))
+    print("cascade domain:         %s" % domain)
+    print("precision:              %s" % np.dtype(dtype).name)
+    print("parallelization:        %s" % parallel_method)
     print("")
 
     print("Parameters:")
@@ -211,124 +486,227 @@ def forecast(R, V, n_timesteps, n_ens_members, n_cascade_levels, R_thr=None,
         print("conditional precip. intensity threshold: %g" % R_thr)
 
     M,N = R.shape[1:]
+    sink = utils.profiling.get_sink(profiler)
+    # the worker processes get the methods by their names
+    method_names = {"extrap_method":extrap_method,
+                    "decomp_method":decomp_method}
     extrap_method = extrapolation.get_method(extrap_method)
-    R = R[-(ar_order + 1):, :, :].copy()
-
-    if conditional or use_probmatching:
-        MASK_thr = np.logical_and.reduce([R[i, :, :] >= R_thr for i in range(R.shape[0])])
-    else:
-        MASK_thr = None
-
-    # advect the previous precipitation fields to the same position with the
-    # most recent one (i.e. transform them into the Lagrangian coordinates)
-    extrap_kwargs = extrap_kwargs.copy()
-    res = []
-    f = lambda R,i: extrap_method(R[i, :, :], V, ar_order-i, "min", **extrap_kwargs)[-1]
-    for i in range(ar_order):
-        if not dask_imported:
-            R[i, :, :] = f(R, i)
-        else:
-            res.append(dask.delayed(f)(R, i))
-
-    if dask_imported:
-        R = np.stack(list(dask.compute(*res, num_workers=num_workers)) + [R[-1, :, :]])
+    fft = utils.fft.get_backend(fft_method)
+    dtype  = np.dtype(dtype)
+    cdtype = np.result_type(dtype, np.complex64)
+    R = R[-(ar_order + 1):, :, :].astype(dtype)
+    V = V.astype(dtype, copy=False)
 
     # initialize the band-pass filter
     filter_method = cascade.get_method(bandpass_filter_method)
     filter = filter_method((M, N), n_cascade_levels, **filter_kwargs)
 
-    # compute the cascade decompositions of the input precipitation fields
     decomp_method = cascade.get_method(decomp_method)
-    R_d = []
-    for i in range(ar_order+1):
-        R_ = decomp_method(R[i, :, :], filter, MASK=MASK_thr)
-        R_d.append(R_)
-
-    # normalize the cascades and rearrange them into a four-dimensional array
-    # of shape (n_cascade_levels,ar_order+1,m,n) for the autoregressive model
-    R_c,mu,sigma = _stack_cascades(R_d, n_cascade_levels)
-    R_d = None
 
-    # compute lag-l temporal autocorrelation coefficients for each cascade level
-    GAMMA = np.empty((n_cascade_levels, ar_order))
-    for i in range(n_cascade_levels):
-        R_c_ = np.stack([R_c[i, j, :, :] for j in range(ar_order+1)])
-        GAMMA[i, :] = correlation.temporal_autocorrelation(R_c_, MASK=MASK_thr)
-    R_c_ = None
+    extrap_kwargs = extrap_kwargs.copy()
 
-    _print_corrcoefs(GAMMA)
+    if resume is None:
+        t0 = 0
 
-    if ar_order == 2:
-        # adjust the lag-2 correlation coefficient to ensure that the AR(p)
-        # process is stationary
-        for i in range(n_cascade_levels):
-            GAMMA[i, 1] = autoregression.adjust_lag2_corrcoef(GAMMA[i, 0], GAMMA[i, 1])
+        if conditional or use_probmatching:
+            MASK_thr = np.logical_and.reduce([R[i, :, :] >= R_thr for i in range(R.shape[0])])
+        else:
+            MASK_thr = None
+
+        if cycle_cache is None:
+            # advect the previous precipitation fields to the same position with the
+            # most recent one (i.e. transform them into the Lagrangian coordinates)
+            with utils.profiling.span(sink, "steps.lagrangian_transform") as sp:
+                res = []
+                f = lambda R,i: extrap_method(R[i, :, :], V, ar_order-i, "min",
+                                              return_final_step=True,
+                                              **extrap_kwargs)[-1]
+                for i in range(ar_order):
+                    if not dask_imported:
+                        R[i, :, :] = f(R, i)
+                    else:
+                        res.append(dask.delayed(f)(R, i))
+
+                if dask_imported:
+                    R = np.stack(list(dask.compute(*res, num_workers=num_workers)) + [R[-1, :, :]])
+                sp.add(R)
+            R_min = np.min(R)
+
+            # compute the cascade decompositions of the input precipitation fields
+            with utils.profiling.span(sink, "steps.decomposition") as sp:
+                R_d = []
+                for i in range(ar_order+1):
+                    R_ = decomp_method(R[i, :, :], filter, MASK=MASK_thr, fft_method=fft)
+                    R_d.append(R_)
+                sp.add(R, *[R_["cascade_levels"] for R_ in R_d])
+        else:
+            # take the cascade decompositions of the input fields from the
+            # cache and advect them to the position of the most recent one
+            cache_key = ((M, N), dtype.name, method_names["decomp_method"],
+                         bandpass_filter_method, n_cascade_levels,
+                         tuple(sorted(filter_kwargs.items())),
+                         R_thr if MASK_thr is not None else None)
+            R_d,R_min = _get_cached_cascades(R, V, timestamps[-(ar_order + 1):],
+                                             cycle_cache, cache_key, filter,
+                                             decomp_method, extrap_method,
+                                             extrap_kwargs, MASK_thr, fft, sink)
+
+        with utils.profiling.span(sink, "steps.ar_estimation") as sp:
+            # normalize the cascades and rearrange them into a four-dimensional array
+            # of shape (n_cascade_levels,ar_order+1,m,n) for the autoregressive model
+            R_c,mu,sigma = _stack_cascades(R_d, n_cascade_levels)
+            R_c   = R_c.astype(dtype, copy=False)
+            mu    = mu.astype(dtype)
+            sigma = sigma.astype(dtype)
+            R_d = None
+
+            # compute lag-l temporal autocorrelation coefficients for each cascade level
+            GAMMA = np.empty((n_cascade_levels, ar_order))
+            for i in range(n_cascade_levels):
+                R_c_ = np.stack([R_c[i, j, :, :] for j in range(ar_order+1)])
+                GAMMA[i, :] = correlation.temporal_autocorrelation(R_c_, MASK=MASK_thr)
+            R_c_ = None
+
+            if ar_order == 2:
+                # adjust the lag-2 correlation coefficient to ensure that the AR(p)
+                # process is stationary
+                GAMMA_ = GAMMA.copy()
+                for i in range(n_cascade_levels):
+                    GAMMA_[i, 1] = autoregression.adjust_lag2_corrcoef(GAMMA[i, 0], GAMMA[i, 1])
+            else:
+                GAMMA_ = GAMMA
 
-    # estimate the parameters of the AR(p) model from the autocorrelation
-    # coefficients
-    PHI = np.empty((n_cascade_levels, ar_order+1))
-    for i in range(n_cascade_levels):
-        PHI[i, :] = autoregression.estimate_ar_params_yw(GAMMA[i, :])
+            # estimate the parameters of the AR(p) model from the autocorrelation
+            # coefficients
+            PHI = np.empty((n_cascade_levels, ar_order+1))
+            for i in range(n_cascade_levels):
+                PHI[i, :] = autoregression.estimate_ar_params_yw(GAMMA_[i, :])
+            sp.add(R_c)
 
-    _print_ar_params(PHI, False)
+        _print_corrcoefs(GAMMA)
 
-    # discard all except the p-1 last cascades because they are not needed for
-    # the AR(p) model
-    R_c = R_c[:, -ar_order:, :, :]
+        _print_ar_params(PHI, False)
 
-    # stack the cascades into a five-dimensional array containing all ensemble
-    # members
-    R_c = np.stack([R_c.copy() for i in range(n_ens_members)])
+        # discard all except the p-1 last cascades because they are not needed for
+        # the AR(p) model
+        R_c = R_c[:, -ar_order:, :, :]
 
-    # initialize the random generators
-    if noise_method is not None:
-        randgen_prec   = []
-        randgen_motion = []
-        np.random.seed(seed)
-        for j in range(n_ens_members):
-            rs = np.random.RandomState(seed)
-            randgen_prec.append(rs)
-            seed = rs.randint(0, high=1e9)
-            rs = np.random.RandomState(seed)
-            randgen_motion.append(rs)
-            seed = rs.randint(0, high=1e9)
+        if domain == "spectral":
+            # the AR(p) model is linear, so it can be applied directly to the
+            # spectra of the normalized cascade levels
+            R_c = fft.rfft2(R_c, axes=(-2, -1)).astype(cdtype, copy=False)
 
-    R_min = np.min(R)
+        # stack the cascades into a five-dimensional array containing all ensemble
+        # members. The initial cascades are shared by all members through a
+        # broadcast view and replicated with a single allocation, since every
+        # member writes its own state from the first time step on.
+        R_c = np.broadcast_to(R_c, (n_ens_members,) + R_c.shape).copy()
+    else:
+        # restore the state of the forecast from the checkpoint
+        state = _load_checkpoint(resume)
+        _check_checkpoint(state, n_ens_members, n_cascade_levels, ar_order,
+                          (M, N), domain, dtype, noise_method,
+                          vel_pert_method, use_precip_mask, mask_method)
+        t0    = int(state["t"])
+        R_c   = state["R_c"]
+        mu    = state["mu"]
+        sigma = state["sigma"]
+        PHI   = state["PHI"]
+
+        R_min = np.min(R)
+
+        print("Resuming from time step %d." % (t0+1))
+
+        _print_ar_params(PHI, False)
+
+    # the cascades of each group of ensemble members iterated by one worker
+    # call are stored as AR(p) states that are updated in place
+    if parallel_method == "processes":
+        # each worker process iterates a fixed group of members for the whole
+        # forecast
+        n_procs = min(num_workers if num_workers is not None else os.cpu_count(),
+                      n_ens_members)
+        member_groups = [[int(j) for j in js] for js in
+                         np.array_split(np.arange(n_ens_members), n_procs)]
+    elif batch_members:
+        member_groups = [list(range(n_ens_members))]
+    else:
+        member_groups = [[j] for j in range(n_ens_members)]
+    ar_states = [autoregression.initialize_ar_state(R_c[js[0]:js[-1]+1], copy=False)
+                 for js in member_groups]
+    if resume is not None:
+        for ar_state in ar_states:
+            ar_state["newest"] = int(state["ar_newest"])
+
+    # the seed of the random streams of the members
+    if resume is None:
+        seed = noise.streams.create_seed(seed)
+    else:
+        seed = int(str(state["seed"]))
 
     if noise_method is not None:
         # get methods for perturbations
         init_noise, generate_noise = noise.get_method(noise_method)
 
+    if noise_method is not None and resume is None:
         # initialize the perturbation generator for the precipitation field
-        pp = init_noise(R[-1, :, :], **noise_kwargs)
+        with utils.profiling.span(sink, "steps.noise_init") as sp:
+            pp = init_noise(R[-1, :, :], fft_method=fft, **noise_kwargs)
+            sp.add(pp)
 
         if noise_stddev_adj:
             print("Computing noise adjustment factors... ", end="")
             sys.stdout.flush()
-            starttime = time.time()
 
-            noise_std_coeffs = noise.utils.compute_noise_stddev_adjs(R[-1, :, :],
-                R_thr, R_min, filter, decomp_method, 10, conditional=True,
-                num_workers=num_workers)
+            with utils.profiling.span(sink, "steps.noise_adjustment") as sp:
+                noise_std_coeffs = noise.utils.compute_noise_stddev_adjs(R[-1, :, :],
+                    R_thr, R_min, filter, decomp_method, 10, conditional=True,
+                    num_workers=num_workers, fft_method=fft, seed=seed,
+                    profiler=sink)
 
-            print("%.2f seconds." % (time.time() - starttime))
+            print("%.2f seconds." % sp.duration)
         else:
             noise_std_coeffs = np.ones(n_cascade_levels)
+    elif noise_method is not None:
+        pp = state["pp"]
+        noise_std_coeffs = state["noise_std_coeffs"]
 
     if vel_pert_method is not None:
         init_vel_noise, generate_vel_noise = noise.get_method(vel_pert_method)
 
-        # initialize the perturbation generators for the motion field
+    if vel_pert_method is not None:
+        # initialize the perturbation generators for the motion field. They
+        # are determined by the random streams, so they are not stored in
+        # the checkpoints.
         vps = []
         for j in range(n_ens_members):
-            kwargs = {"randstate":randgen_motion[j],
+            kwargs = {"randstate":noise.streams.get_generator(seed, j, purpose="motion"),
                       "p_pert_par":vp_par,
                       "p_pert_perp":vp_perp}
             vp_ = init_vel_noise(V, 1./kmperpixel, timestep, **kwargs)
             vps.append(vp_)
 
-    D = [None for j in range(n_ens_members)]
-    R_f = [[] for j in range(n_ens_members)]
+    # without perturbations of the motion field, all members can be advected
+    # along the same trajectory, which is then computed once for all time steps
+    if precompute_trajectory and vel_pert_method is None and \
+       str(method_names["extrap_method"]).lower() == "semilagrangian":
+        with utils.profiling.span(sink, "steps.trajectory") as sp:
+            trajectory = semilagrangian.compute_trajectory(V, n_timesteps,
+                                                           return_indices=True,
+                                                           **extrap_kwargs)
+            sp.add(trajectory["D"], trajectory["indices"])
+    else:
+        trajectory = None
+
+    # the displacements are not used before the first time step
+    if resume is None:
+        D = np.zeros((n_ens_members, 2, M, N), dtype=dtype)
+    else:
+        D = state["D"]
+
+    if out is not None:
+        out = _create_output_array(out, (n_ens_members, n_timesteps, M, N),
+                                   dtype, resume)
 
     if use_precip_mask:
         if mask_method == "obs":
@@ -342,150 +720,300 @@ def forecast(R, V, n_timesteps, n_ens_members, n_cascade_levels, R_thr=None,
             # compute the wet area ratio and the precipitation mask
             MASK_prec = R[-1, :, :] >= R_thr
             war = 1.0*np.sum(MASK_prec) / (R.shape[1]*R.shape[2])
-            R_m = R_c[0, :, :, :].copy()
+            if resume is None:
+                R_m = autoregression.initialize_ar_state(R_c[0, :, :, :, :])
+            else:
+                R_m = autoregression.initialize_ar_state(state["R_m"], copy=False)
+                R_m["newest"] = int(state["R_m_newest"])
         elif mask_method == "incremental":
-            # initialize precip mask for each member
-            MASK_prec_ = R[-1, :, :] >= R_thr
-            MASK_prec = [MASK_prec_.copy() for j in range(n_ens_members)]
-            # initialize the structuring element
-            struct = scipy.ndimage.generate_binary_structure(2, 1)
-            # iterate it to expand it nxn
+            # initialize precip mask for each member, the masks are stored as
+            # bits packed along the last axis
+            if resume is None:
+                MASK_prec_ = R[-1, :, :] >= R_thr
+                MASK_prec = np.stack([MASK_prec_.copy() for j in range(n_ens_members)])
+            else:
+                MASK_prec = state["MASK_prec"]
+            if MASK_prec.dtype == bool:
+                MASK_prec = np.packbits(MASK_prec, axis=-1)
+            # the radius of the buffer, which corresponds to a structuring
+            # element of size nxn (at least 3x3)
             n = timestep/kmperpixel
-            struct = scipy.ndimage.iterate_structure(struct, int((n - 1)/2.))
-
-    R = R[-1, :, :]
-
-    print("Starting nowcast computation.")
-
-    # iterate each time step
-    for t in range(n_timesteps):
-        print("Computing nowcast for time step %d... " % (t+1), end="")
-        sys.stdout.flush()
-        starttime = time.time()
+            mask_radius = max(int((n - 1)/2.), 1)
+
+    if use_probmatching:
+        # sort the target distribution of the probability matching once
+        matcher = probmatching.nonparam_match_init(R[-1, :, :])
+
+    if resume is not None:
+        state = None
+
+    # the arguments of the computation of a group of ensemble members
+    ctx = {"dtype":dtype, "shape":(M, N), "fft":fft, "filter":filter,
+           "domain":domain, "decomp_method":decomp_method,
+           "extrap_method":extrap_method, "extrap_kwargs":extrap_kwargs,
+           "trajectory":trajectory,
+           "noise_method":noise_method, "vel_pert_method":vel_pert_method,
+           "timestep":timestep, "PHI":PHI, "mu":mu, "sigma":sigma, "V":V,
+           "D":D, "R_thr":R_thr, "use_precip_mask":use_precip_mask,
+           "mask_method":mask_method, "use_probmatching":use_probmatching,
+           "matcher":matcher if use_probmatching else None,
+           "MASK_prec":MASK_prec if use_precip_mask else None, "profiler":sink,
+           "mask_radius":mask_radius if use_precip_mask and mask_method == "incremental" else None}
+    if noise_method is not None:
+        ctx.update({"generate_noise":generate_noise, "pp":pp,
+                    "seed":seed,
+                    "noise_std_coeffs":noise_std_coeffs})
+    if vel_pert_method is not None:
+        ctx.update({"generate_vel_noise":generate_vel_noise, "vps":vps})
+
+    # collect the state of the forecast after t time steps for writing a
+    # checkpoint
+    def get_checkpoint_state(t):
+        state = {"t":t, "n_ens_members":n_ens_members,
+                 "n_cascade_levels":n_cascade_levels, "ar_order":ar_order,
+                 "shape":np.array((M, N)), "domain":domain,
+                 "dtype":dtype.name, "noise_method":str(noise_method),
+                 "vel_pert_method":str(vel_pert_method),
+                 "mask_method":mask_method if use_precip_mask else "None"}
+
+        state["R_c"]       = R_c
+        state["ar_newest"] = (ar_order - 1 + t) % ar_order
+        state["mu"]        = mu
+        state["sigma"]     = sigma
+        state["PHI"]       = PHI
+        state["D"]         = D
+
+        # the random streams are determined by the seed, which can be larger
+        # than the largest integer type of numpy
+        state["seed"] = str(seed)
+
+        if noise_method is not None:
+            state["pp"] = pp
+            state["noise_std_coeffs"] = noise_std_coeffs
 
         if use_precip_mask and mask_method == "sprog":
-            for i in range(n_cascade_levels):
-                # use a separate AR(p) model for the non-perturbed forecast,
-                # from which the mask is obtained
-                R_m[i, :, :, :] = \
-                    autoregression.iterate_ar_model(R_m[i, :, :, :], PHI[i, :])
-
-            R_m_ = _recompose_cascade(R_m, mu, sigma)
-
-            # obtain the CDF from the non-perturbed forecast that is
-            # scale-filtered by the AR(p) model
-            R_s = R_m_.flatten()
-
-            # compute the threshold value R_pct_thr corresponding to the
-            # same fraction of precipitation pixels (forecast values above
-            # R_min) as in the most recently observed precipitation field
-            R_s.sort(kind="quicksort")
-            x = 1.0*np.arange(1, len(R_s)+1)[::-1] / len(R_s)
-            i = np.argmin(abs(x - war))
-            # handle ties
-            if R_s[i] == R_s[i + 1]:
-                i = np.where(R_s == R_s[i])[0][-1] + 1
-            R_pct_thr = R_s[i]
-
-            # determine a mask using the above threshold value to preserve the
-            # wet-area ratio
-            MASK_prec = R_m_ < R_pct_thr
-
-        # iterate each ensemble member
-        def worker(j):
-            if noise_method is not None:
-                # generate noise field
-                EPS = generate_noise(pp, randstate=randgen_prec[j])
-                # decompose the noise field into a cascade
-                EPS = decomp_method(EPS, filter)
-            else:
-                EPS = None
+            state["R_m"]        = R_m["X"]
+            state["R_m_newest"] = R_m["newest"]
+        elif use_precip_mask and mask_method == "incremental":
+            state["MASK_prec"] = MASK_prec
 
-            # iterate the AR(p) model for each cascade level
-            for i in range(n_cascade_levels):
-                # normalize the noise cascade
-                if EPS is not None:
-                    EPS_ = (EPS["cascade_levels"][i, :, :] - EPS["means"][i]) / EPS["stds"][i]
-                    EPS_ *= noise_std_coeffs[i]
-                else:
-                    EPS_ = None
-                # apply AR(p) process to cascade level
-                R_c[j, i, :, :, :] = \
-                    autoregression.iterate_ar_model(R_c[j, i, :, :, :],
-                                                    PHI[i, :], EPS=EPS_)
-
-            EPS  = None
-            EPS_ = None
-
-            # compute the recomposed precipitation field(s) from the cascades
-            # obtained from the AR(p) model(s)
-            R_c_ = _recompose_cascade(R_c[j, :, :, :], mu, sigma)
-
-            if use_precip_mask:
-                # apply the precipitation mask to prevent generation of new
-                # precipitation into areas where it was not originally
-                # observed
-                if mask_method == "obs":
-                    R_c_[~MASK_prec] = R_c_.min()
-                elif mask_method == "incremental":
-                    R_c_[~MASK_prec[j]] = R_c_.min()
-                elif mask_method == "sprog":
-                    R_c_[MASK_prec] = R_c_.min()
-
-            if use_probmatching:
-                ## adjust the conditional CDF of the forecast (precipitation
-                ## intensity above the threshold R_thr) to match the most
-                ## recently observed precipitation field
-                R_c_ = probmatching.nonparam_match_empirical_cdf(R_c_, R)
-
-            if use_precip_mask and mask_method == "incremental":
-                MASK_prec_ = R_c_ >= R_thr
-                MASK_prec_ = scipy.ndimage.morphology.binary_dilation(MASK_prec_, struct)
-                MASK_prec[j] = MASK_prec_
+        return state
 
-            # compute the perturbed motion field
-            if vel_pert_method is not None:
-                V_ = V + generate_vel_noise(vps[j], t*timestep)
-            else:
-                V_ = V
+    print("Starting nowcast computation.")
 
-            # advect the recomposed precipitation field to obtain the forecast
-            # for time step t
-            extrap_kwargs.update({"D_prev":D[j], "return_displacement":True})
-            R_f_,D_ = extrap_method(R_c_, V_, 1, **extrap_kwargs)
-            D[j] = D_
-            R_f_ = R_f_[0]
+    if parallel_method == "processes":
+        # the arrays used by the worker processes are memory-mapped from files
+        # in a temporary directory, which is in shared memory if available
+        tmpdir = tempfile.mkdtemp(prefix="pysteps_",
+                                  dir="/dev/shm" if os.path.isdir("/dev/shm") else None)
+
+        # create a memory-mapped copy of X and add it to the given list of
+        # shared arrays with the mode for opening it in the workers
+        def share(shared, key, X, mode="r"):
+            filename = os.path.join(tmpdir, "%d.npy" % len(os.listdir(tmpdir)))
+            X_ = np.lib.format.open_memmap(filename, mode="w+", dtype=X.dtype,
+                                           shape=X.shape)
+            X_[:] = X
+            shared[key] = (filename, mode)
+            return X_
+
+        shared            = {}
+        shared_filter     = {}
+        shared_trajectory = {}
+        shared_matcher    = {}
+
+        # the cascades, displacements, masks and outputs are written by the
+        # workers, each of them into the slices of its own members
+        R_c        = share(shared, "R_c", R_c, mode="r+")
+        D          = share(shared, "D", D, mode="r+")
+        R_f_shared = share(shared, "R_f", np.zeros((n_ens_members, M, N),
+                                                   dtype=dtype), mode="r+")
+        if use_precip_mask:
+            MASK_prec = share(shared, "MASK_prec", MASK_prec,
+                              mode="r" if mask_method == "obs" else "r+")
+        for key in ["PHI", "mu", "sigma", "V"]:
+            share(shared, key, ctx[key])
+        if noise_method is not None:
+            share(shared, "noise_std_coeffs", noise_std_coeffs)
+            if isinstance(pp, np.ndarray):
+                share(shared, "pp", pp)
+        for key,value in filter.items():
+            if isinstance(value, np.ndarray):
+                share(shared_filter, key, value)
+        if trajectory is not None:
+            for key,value in trajectory.items():
+                if isinstance(value, np.ndarray):
+                    share(shared_trajectory, key, value)
+        if use_probmatching:
+            # the sorted target values of the probability matching
+            for key,value in matcher.items():
+                if isinstance(value, np.ndarray):
+                    share(shared_matcher, key, value)
+
+        # the rest of the context is pickled and sent to the workers
+        ctx_ = {key:value for key,value in ctx.items() if key not in shared}
+        ctx_.update(method_names)
+        ctx_["fft"]    = fft.name
+        ctx_["filter"] = {key:value for key,value in filter.items()
+                          if key not in shared_filter}
+        if trajectory is not None:
+            ctx_["trajectory"] = {key:value for key,value in trajectory.items()
+                                  if key not in shared_trajectory}
+        if use_probmatching:
+            ctx_["matcher"] = {key:value for key,value in matcher.items()
+                               if key not in shared_matcher}
+        for key in ["generate_noise", "generate_vel_noise"]:
+            ctx_.pop(key, None)
+        # the sink is not necessarily picklable, so the workers record the
+        # spans and send them to the main process
+        ctx_["profiler"] = not isinstance(sink, utils.profiling.NullSink)
+
+        mp = multiprocessing.get_context()
+        worker_conns = []
+        worker_procs = []
+        for js in member_groups:
+            config = {"ctx":ctx_.copy(), "members":js,
+                      "ar_newest":(ar_order - 1 + t0) % ar_order,
+                      "t0":t0, "n_timesteps":n_timesteps,
+                      "noise_prefetch":noise_prefetch,
+                      "shared":shared, "shared_filter":shared_filter,
+                      "shared_trajectory":shared_trajectory,
+                      "shared_matcher":shared_matcher}
+            if vel_pert_method is not None:
+                config["ctx"]["vps"] = {j:vps[j] for j in js}
+            conn,conn_child = mp.Pipe()
+            proc = mp.Process(target=_member_worker, args=(conn_child, config),
+                              daemon=True)
+            proc.start()
+            worker_conns.append(conn)
+            worker_procs.append(proc)
+
+    prefetcher = None
+    try:
+        if parallel_method == "processes":
+            # wait until the workers are initialized
+            _receive_from_workers(worker_conns)
+        elif noise_method is not None and noise_prefetch > 0:
+            # one thread per group of members computed concurrently
+            n_threads = min(num_workers if num_workers is not None else os.cpu_count(),
+                            len(member_groups))
+            prefetcher = _NoisePrefetcher(ctx, member_groups, t0, n_timesteps,
+                                          noise_prefetch, n_threads=n_threads)
+
+        # iterate each time step
+        for t in range(t0, n_timesteps):
+            print("Computing nowcast for time step %d... " % (t+1), end="")
+            sys.stdout.flush()
 
-            return R_f_
+            with utils.profiling.span(sink, "steps.timestep", t=t) as sp_t:
+                if use_precip_mask and mask_method == "sprog":
+                    with utils.profiling.span(sink, "steps.masking", t=t) as sp:
+                        # use a separate AR(p) model for the non-perturbed
+                        # forecast, from which the mask is obtained
+                        autoregression.iterate_ar_state(R_m, PHI)
+
+                        R_m_ = _recompose_cascade(autoregression.get_ar_state_fields(R_m, 0),
+                                                  mu, sigma, domain, fft, (M, N))
+
+                        # compute the threshold value R_pct_thr corresponding to
+                        # the same fraction of precipitation pixels (forecast
+                        # values above R_min) as in the most recently observed
+                        # precipitation field from the non-perturbed forecast
+                        # that is scale-filtered by the AR(p) model
+                        R_pct_thr = _get_wet_area_threshold(R_m_, war)
+
+                        # determine a mask using the above threshold value to
+                        # preserve the wet-area ratio
+                        MASK_prec[:] = R_m_ < R_pct_thr
+                        sp.add(R_m_)
+
+                # iterate the given group of ensemble members
+                def worker(g):
+                    js  = member_groups[g]
+                    js_ = slice(js[0], js[-1]+1)
+                    EPS = prefetcher.get(t, g) if prefetcher is not None else None
+                    return _iterate_members(t, js, ar_states[g], ctx,
+                                            out=out[js_, t, :, :] if out is not None else None,
+                                            EPS=EPS)
+
+                if parallel_method == "processes":
+                    for conn in worker_conns:
+                        conn.send(t)
+                    # the spans of the workers are forwarded to the sink
+                    for span in _receive_from_workers(worker_conns):
+                        sink.record(span)
+                    if out is not None:
+                        out[:, t, :, :] = R_f_shared
+                    else:
+                        R_f_ = R_f_shared.copy()
+                elif batch_members:
+                    R_f_ = worker(0)
+                else:
+                    res = []
+                    for j in range(n_ens_members):
+                        if not dask_imported or n_ens_members == 1:
+                            res.append(worker(j))
+                        else:
+                            res.append(dask.delayed(worker)(j))
 
-        res = []
-        for j in range(n_ens_members):
-            if not dask_imported or n_ens_members == 1:
-                res.append(worker(j))
-            else:
-                res.append(dask.delayed(worker)(j))
+                    R_f_ = dask.compute(*res, num_workers=num_workers) \
+                        if dask_imported and n_ens_members > 1 else res
+                    R_f_ = np.concatenate(R_f_) if out is None else None
+                    res = None
 
-        R_f_ = dask.compute(*res, num_workers=num_workers) \
-            if dask_imported and n_ens_members > 1 else res
-        res = None
+                if out is not None:
+                    R_f_ = out[:, t, :, :]
+                sp_t.add(R_f_)
 
-        print("%.2f seconds." % (time.time() - starttime))
+            print("%.2f seconds." % sp_t.duration)
 
-        if callback is not None:
-            callback(np.stack(R_f_))
+            yield t,R_f_
             R_f_ = None
 
-        if return_output:
-            for j in range(n_ens_members):
-                R_f[j].append(R_f_[j])
-
-    if return_output:
-        if n_ens_members == 1:
-            return np.stack(R_f[0])
+            if checkpoint is not None and \
+               ((t + 1 - t0) % checkpoint_interval == 0 or t == n_timesteps - 1):
+                with utils.profiling.span(sink, "steps.checkpoint", t=t):
+                    _save_checkpoint(checkpoint, get_checkpoint_state(t + 1))
+    finally:
+        if prefetcher is not None:
+            prefetcher.close()
+        if parallel_method == "processes":
+            _stop_workers(worker_conns, worker_procs)
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+def _buffer_masks(MASK, radius):
+    # buffer the masks of shape (k,m,n) by the given radius. This is
+    # equivalent to a binary dilation of each mask with a diamond-shaped
+    # structuring element, but the cost of the city-block distance transform
+    # does not depend on the radius. The metric does not connect the masks,
+    # so they are transformed in one call. The distance is -1 in masks having
+    # no precipitation.
+    metric = np.zeros((3, 3, 3), dtype=bool)
+    metric[1] = scipy.ndimage.generate_binary_structure(2, 1)
+    dist = scipy.ndimage.distance_transform_cdt(~MASK, metric=metric)
+
+    return np.logical_and(dist >= 0, dist <= radius)
+
+def _check_checkpoint(state, n_ens_members, n_cascade_levels, ar_order, shape,
+                      domain, dtype, noise_method, vel_pert_method,
+                      use_precip_mask, mask_method):
+    expected = {"n_ens_members":n_ens_members,
+                "n_cascade_levels":n_cascade_levels, "ar_order":ar_order,
+                "shape":shape, "domain":domain, "dtype":np.dtype(dtype).name,
+                "noise_method":str(noise_method),
+                "vel_pert_method":str(vel_pert_method),
+                "mask_method":mask_method if use_precip_mask else "None"}
+
+    for key,value in expected.items():
+        if key == "shape":
+            value_ = tuple(int(v) for v in state[key])
+        elif isinstance(value, str):
+            value_ = str(state[key])
         else:
-            return np.stack([np.stack(R_f[j]) for j in range(n_ens_members)])
-    else:
-        return None
+            value_ = int(state[key])
+        if value_ != value:
+            raise ValueError("the checkpoint is not compatible with the arguments: %s=%s in the checkpoint, but %s was given" % \
+                             (key, str(value_), str(value)))
 
 def _check_inputs(R, V, ar_order):
     if len(R.shape) != 3:
@@ -498,6 +1026,126 @@ def _check_inputs(R, V, ar_order):
         raise ValueError("dimension mismatch between R and V: shape(R)=%s, shape(V)=%s" % \
                          (str(R.shape), str(V.shape)))
 
+def _create_output_array(out, shape, dtype, resume):
+    if resume is not None and isinstance(out, str) and os.path.exists(out):
+        _grow_output_file(out, shape)
+        return nowcast_utils.create_output_array(out, shape, dtype, mode="r+")
+    elif resume is not None and out is None:
+        # the time steps before the checkpoint are not computed
+        return np.full(shape, np.nan, dtype=dtype)
+    else:
+        return nowcast_utils.create_output_array(out, shape, dtype)
+
+# extend the output file of a previous run along the time axis when the
+# forecast is resumed with a larger n_timesteps, the new time steps are set to
+# nan until they are computed
+def _grow_output_file(path, shape):
+    out = np.load(path, mmap_mode="r")
+    if out.ndim != len(shape) or out.shape[0] != shape[0] or \
+       out.shape[2:] != tuple(shape[2:]) or out.shape[1] > shape[1]:
+        raise ValueError("out has shape %s, which cannot be extended to %s" % \
+                         (str(out.shape), str(tuple(shape))))
+    if out.shape[1] == shape[1]:
+        return
+
+    path_tmp = path + ".tmp"
+    out_new = np.lib.format.open_memmap(path_tmp, mode="w+", dtype=out.dtype,
+                                        shape=tuple(shape))
+    for j in range(shape[0]):
+        out_new[j, :out.shape[1]] = out[j]
+        out_new[j, out.shape[1]:] = np.nan
+    out_new.flush()
+    del out, out_new
+    os.replace(path_tmp, path)
+
+def _get_cached_cascades(R, V, timestamps, cache, cache_key, filter,
+                         decomp_method, extrap_method, extrap_kwargs, MASK,
+                         fft, sink):
+    ar_order = R.shape[0] - 1
+
+    def advect(R_, i):
+        return extrap_method(R_, V, ar_order-i, "min", return_final_step=True,
+                             **extrap_kwargs)[-1]
+
+    R_d   = []
+    R_min = []
+    keys  = []
+    for i in range(ar_order+1):
+        key = (timestamps[i],) + cache_key
+        keys.append(key)
+        if key in cache:
+            R_,R_min_ = cache[key]
+            if i < ar_order:
+                # advect the cascade levels of the cached decomposition, which
+                # is not modified
+                with utils.profiling.span(sink, "steps.lagrangian_transform",
+                                          frame=i) as sp:
+                    R_ = R_.copy()
+                    R_["cascade_levels"] = advect(R_["cascade_levels"], i)
+                    sp.add(R_["cascade_levels"])
+        else:
+            # store the decomposition of the field in its original position
+            # for the next cycles
+            with utils.profiling.span(sink, "steps.decomposition", frame=i) as sp:
+                R_ = decomp_method(R[i, :, :], filter, MASK=MASK, fft_method=fft)
+                sp.add(R_["cascade_levels"])
+            R_min_ = np.min(R[i, :, :])
+            cache[key] = (R_, R_min_)
+
+            if i < ar_order:
+                # in this cycle, decompose the advected field as without the
+                # cache
+                with utils.profiling.span(sink, "steps.lagrangian_transform",
+                                          frame=i) as sp:
+                    R__ = advect(R[i, :, :], i)
+                    sp.add(R__)
+                R_min_ = np.min(R__)
+                with utils.profiling.span(sink, "steps.decomposition",
+                                          frame=i) as sp:
+                    R_ = decomp_method(R__, filter, MASK=MASK, fft_method=fft)
+                    sp.add(R_["cascade_levels"])
+        R_d.append(R_)
+        R_min.append(R_min_)
+
+    # drop the decompositions of the fields that have left the window
+    for key in list(cache.keys()):
+        if key not in keys:
+            del cache[key]
+
+    return R_d,min(R_min)
+
+def _get_wet_area_threshold(R, war):
+    # return the threshold value such that the fraction of the values of R
+    # above it is as close as possible to the wet area ratio war. The index i
+    # of the threshold in the sorted values is the one minimizing
+    # |(n-i)/n-war|, which is found by evaluating the integers around
+    # n*(1-war), and the value is selected with a partial sort.
+    R = R.ravel()
+    n = R.size
+
+    i0 = int(n * (1.0 - war))
+    candidates = [i for i in range(i0-1, i0+3) if i >= 0 and i < n]
+    i = min(candidates, key=lambda i: abs(1.0*(n-i)/n - war))
+
+    if i == n - 1:
+        return np.max(R)
+
+    R_s = np.partition(R, (i, i+1))
+    R_pct_thr = R_s[i]
+
+    # handle ties: use the smallest value that is greater than the tied ones,
+    # which is found from the values above the selected ones
+    if R_s[i+1] == R_pct_thr:
+        R_s = R_s[i+2:]
+        R_s = R_s[R_s > R_pct_thr]
+        R_pct_thr = R_s.min() if R_s.size > 0 else np.inf
+
+    return R_pct_thr
+
+def _load_checkpoint(filename):
+    with np.load(filename) as f:
+        return {key:f[key] for key in f.files}
+
 def _print_ar_params(PHI, include_perturb_term):
     print("****************************************")
     print("* AR(p) parameters for cascade levels: *")
@@ -552,6 +1200,14 @@ def _print_corrcoefs(GAMMA):
         print(fmt_str % ((k+1,) + tuple(GAMMA[k, :])))
         print(hline_str)
 
+def _save_checkpoint(filename, state):
+    # write into a temporary file first so that an interrupted write does not
+    # destroy the previous checkpoint
+    tmpfilename = filename + ".tmp"
+    with open(tmpfilename, "wb") as f:
+        np.savez(f, **state)
+    os.replace(tmpfilename, filename)
+
 def _stack_cascades(R_d, n_levels):
   R_c   = []
   mu    = np.empty(n_levels)
@@ -573,8 +1229,258 @@ def _stack_cascades(R_d, n_levels):
 
   return np.stack(R_c),mu,sigma
 
-def _recompose_cascade(R, mu, sigma):
-    R_rc = [(R[i, -1, :, :] * sigma[i]) + mu[i] for i in range(len(mu))]
-    R_rc = np.sum(np.stack(R_rc), axis=0)
+def _generate_noise_cascades(t, js, ctx):
+    # generate the noise cascades of time step t for the group of ensemble
+    # members js. They only depend on the random streams of the members, so
+    # they can be computed in advance.
+    with utils.profiling.span(ctx["profiler"], "steps.noise", t=t,
+                              members=list(js)) as sp:
+        # generate noise fields
+        EPS = ctx["generate_noise"](ctx["pp"],
+                                    randstate=noise.streams.get_generators(ctx["seed"], js, t),
+                                    fft_method=ctx["fft"], dtype=ctx["dtype"])
+        # decompose the noise fields into normalized cascades
+        EPS = ctx["decomp_method"](EPS, ctx["filter"], fft_method=ctx["fft"],
+                                   output_domain=ctx["domain"], normalize=True)
+        EPS = EPS["cascade_levels"]
+
+        # adjust the standard deviations of the noise cascades
+        EPS *= ctx["noise_std_coeffs"].astype(ctx["dtype"])[:, None, None]
+        sp.add(EPS)
+
+    return EPS
+
+class _NoisePrefetcher(object):
+    # computes the noise cascades of the groups of ensemble members in
+    # n_threads background threads up to n_steps time steps ahead of the time
+    # step requested with get. The cascades are kept until they are requested,
+    # so the queue holds at most n_steps+1 time steps for each group.
+    def __init__(self, ctx, member_groups, t0, n_timesteps, n_steps,
+                 n_threads=1):
+        self.ctx           = ctx
+        self.member_groups = member_groups
+        self.n_timesteps   = n_timesteps
+        self.n_steps       = n_steps
+        self.executor      = concurrent.futures.ThreadPoolExecutor(max_workers=n_threads)
+        self.futures       = {}
+        self.submitted     = [t0 - 1 for js in member_groups]
+        self.lock          = threading.Lock()
+
+    def get(self, t, g):
+        # return the noise cascades of time step t for the member group g
+        with self.lock:
+            t_last = min(t + self.n_steps, self.n_timesteps - 1)
+            for t_ in range(self.submitted[g] + 1, t_last + 1):
+                self.futures[(t_, g)] = self.executor.submit(
+                    _generate_noise_cascades, t_, self.member_groups[g],
+                    self.ctx)
+            self.submitted[g] = max(self.submitted[g], t_last)
+            future = self.futures.pop((t, g))
+
+        return future.result()
+
+    def close(self):
+        with self.lock:
+            for future in self.futures.values():
+                future.cancel()
+            self.futures = {}
+        self.executor.shutdown(wait=True)
+
+def _iterate_members(t, js, ar_state, ctx, out=None, EPS=None):
+    # compute time step t for the group of ensemble members js, whose cascades
+    # are stored in ar_state, and return the forecast fields or write them
+    # into out. The noise cascades are generated unless they are given in EPS.
+    dtype = ctx["dtype"]
+    js_   = slice(js[0], js[-1]+1)
+    sink  = ctx["profiler"]
+
+    # the spans of the computations contain the time step and the members
+    def span(name, members=js):
+        return utils.profiling.span(sink, name, t=t, members=list(members))
+
+    if ctx["noise_method"] is not None and EPS is None:
+        EPS = _generate_noise_cascades(t, js, ctx)
+
+    with span("steps.ar") as sp:
+        # apply the AR(p) models to all cascade levels in place
+        autoregression.iterate_ar_state(ar_state, ctx["PHI"], EPS=EPS)
+        sp.add(ar_state["X"])
+
+    EPS = None
+
+    # compute the recomposed precipitation field(s) from the cascades
+    # obtained from the AR(p) model(s)
+    with span("steps.recomposition") as sp:
+        R_c_ = _recompose_cascade(autoregression.get_ar_state_fields(ar_state, 0),
+                                  ctx["mu"], ctx["sigma"], ctx["domain"],
+                                  ctx["fft"], ctx["shape"])
+        sp.add(R_c_)
+
+    use_precip_mask = ctx["use_precip_mask"]
+    mask_method     = ctx["mask_method"]
+    MASK_prec       = ctx["MASK_prec"]
+
+    if use_precip_mask:
+        with span("steps.masking") as sp:
+            # apply the precipitation mask to prevent generation of new
+            # precipitation into areas where it was not originally
+            # observed
+            R_c_min = R_c_.min(axis=(1, 2))[:, None, None]
+            if mask_method == "obs":
+                R_c_ = np.where(MASK_prec, R_c_, R_c_min)
+            elif mask_method == "incremental":
+                MASK_prec_ = np.unpackbits(MASK_prec[js_], axis=-1,
+                                           count=ctx["shape"][1]).view(bool)
+                R_c_ = np.where(MASK_prec_, R_c_, R_c_min)
+            elif mask_method == "sprog":
+                R_c_ = np.where(MASK_prec, R_c_min, R_c_)
+            sp.add(R_c_)
+
+    if ctx["use_probmatching"]:
+        with span("steps.probmatching") as sp:
+            ## adjust the conditional CDF of the forecast (precipitation
+            ## intensity above the threshold R_thr) to match the most
+            ## recently observed precipitation field
+            R_c_ = probmatching.nonparam_match_compute(ctx["matcher"], R_c_)
+            sp.add(R_c_)
+
+    if use_precip_mask and mask_method == "incremental":
+        with span("steps.masking") as sp:
+            # update the masks of the members by buffering the forecast
+            # precipitation areas
+            MASK_prec_ = _buffer_masks(R_c_ >= ctx["R_thr"], ctx["mask_radius"])
+            MASK_prec[js_] = np.packbits(MASK_prec_, axis=-1)
+            sp.add(MASK_prec_)
+
+    D = ctx["D"]
+    V = ctx["V"]
+
+    R_f_ = []
+    for jj,j in enumerate(js):
+        R_c__ = R_c_[jj, :, :]
+
+        with span("steps.advection", [j]) as sp:
+            # compute the perturbed motion field
+            if ctx["vel_pert_method"] is not None:
+                V_ = (V + ctx["generate_vel_noise"](ctx["vps"][j], t*ctx["timestep"])).astype(dtype, copy=False)
+            else:
+                V_ = V
+
+            # advect the recomposed precipitation field to obtain the forecast
+            # for time step t
+            extrap_kwargs_ = ctx["extrap_kwargs"].copy()
+            if ctx["trajectory"] is not None:
+                extrap_kwargs_.update({"trajectory":ctx["trajectory"],
+                                       "trajectory_offset":t})
+            else:
+                extrap_kwargs_["D_prev"] = D[j] if t > 0 else None
+            extrap_kwargs_["return_displacement"] = True
+            if out is not None:
+                extrap_kwargs_["out"] = out[jj:jj+1, :, :]
+            R_f__,D_ = ctx["extrap_method"](R_c__, V_, 1, **extrap_kwargs_)
+            D[j] = D_
+            sp.add(R_f__)
+        R_f_.append(R_f__[0])
+
+    return np.stack(R_f_) if out is None else None
+
+def _member_worker(conn, config):
+    # a persistent worker process that iterates a fixed group of ensemble
+    # members. The arrays shared with the main process are memory-mapped from
+    # the files listed in the configuration. The worker receives the index of
+    # the time step to compute, writes the forecast fields into the shared
+    # output array and replies a tuple (error,spans), where error is None or
+    # the traceback if an error occurred and spans is the list of spans
+    # recorded during the time step.
+    try:
+        ctx = config["ctx"]
+        for key,(filename,mode) in config["shared"].items():
+            ctx[key] = np.load(filename, mmap_mode=mode)
+        for key,(filename,mode) in config["shared_filter"].items():
+            ctx["filter"][key] = np.load(filename, mmap_mode=mode)
+        for key,(filename,mode) in config["shared_trajectory"].items():
+            ctx["trajectory"][key] = np.load(filename, mmap_mode=mode)
+        for key,(filename,mode) in config["shared_matcher"].items():
+            ctx["matcher"][key] = np.load(filename, mmap_mode=mode)
+        ctx["profiler"] = utils.profiling.RecordingSink() if ctx["profiler"] \
+            else utils.profiling.NullSink()
+
+        ctx["fft"] = utils.fft.get_backend(ctx["fft"])
+        ctx["extrap_method"] = extrapolation.get_method(ctx["extrap_method"])
+        ctx["decomp_method"] = cascade.get_method(ctx["decomp_method"])
+        if ctx["noise_method"] is not None:
+            ctx["generate_noise"] = noise.get_method(ctx["noise_method"])[1]
+        if ctx["vel_pert_method"] is not None:
+            ctx["generate_vel_noise"] = noise.get_method(ctx["vel_pert_method"])[1]
+
+        js  = config["members"]
+        js_ = slice(js[0], js[-1]+1)
+        ar_state = autoregression.initialize_ar_state(ctx["R_c"][js_],
+                                                      copy=False)
+        ar_state["newest"] = config["ar_newest"]
+        R_f = ctx["R_f"][js_]
+        if ctx["noise_method"] is not None and config["noise_prefetch"] > 0:
+            prefetcher = _NoisePrefetcher(ctx, [js], config["t0"],
+                                          config["n_timesteps"],
+                                          config["noise_prefetch"])
+        else:
+            prefetcher = None
+        conn.send((None, []))
+    except Exception:
+        conn.send((traceback.format_exc(), []))
+        return
+
+    try:
+        while True:
+            t = conn.recv()
+            if t is None:
+                break
+            try:
+                EPS = prefetcher.get(t, 0) if prefetcher is not None else None
+                _iterate_members(t, js, ar_state, ctx, out=R_f, EPS=EPS)
+                spans = []
+                if isinstance(ctx["profiler"], utils.profiling.RecordingSink):
+                    spans,ctx["profiler"].spans = ctx["profiler"].spans,[]
+                conn.send((None, spans))
+            except Exception:
+                conn.send((traceback.format_exc(), []))
+    finally:
+        if prefetcher is not None:
+            prefetcher.close()
+
+def _receive_from_workers(conns):
+    # wait for the replies of the workers and return the spans recorded by
+    # them
+    replies = [conn.recv() for conn in conns]
+    for e,_ in replies:
+        if e is not None:
+            raise RuntimeError("an error occurred in a worker process:\n%s" % e)
+
+    return [span for _,spans in replies for span in spans]
+
+def _stop_workers(conns, procs):
+    for conn in conns:
+        try:
+            conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+    for proc in procs:
+        proc.join(timeout=10)
+        if proc.is_alive():
+            proc.terminate()
+
+def _recompose_cascade(R, mu, sigma, domain="spatial", fft=None, shape=None):
+    # R contains the newest fields of the cascade levels with shape (...,k,m,n)
+    if domain == "spatial":
+        R_rc = [(R[..., i, :, :] * sigma[i]) + mu[i] for i in range(len(mu))]
+        R_rc = np.sum(np.stack(R_rc), axis=0)
+    else:
+        # sum the spectra of the cascade levels and add the means to the
+        # zero-frequency component, so that only one inverse FFT is needed
+        R_rc = R[..., 0, :, :] * sigma[0]
+        for i in range(1, len(mu)):
+            R_rc += R[..., i, :, :] * sigma[i]
+        R_rc[..., 0, 0] += np.sum(mu) * shape[0] * shape[1]
+        R_rc = fft.irfft2(R_rc, s=shape, axes=(-2, -1))
 
     return R_rc
@@ -0,0 +1,42 @@
+"""Utility functions for the nowcasting methods."""
+
+import numpy as np
+
+def create_output_array(out, shape, dtype, mode="w+"):
+    """Return an array for writing the output of a nowcast.
+
+    Parameters
+    ----------
+    out : array-like or str
+      If None, a new array is allocated. If a string, it is interpreted as the
+      path of a file, and a numpy.memmap stored in the .npy format is created
+      into it (the file can be reopened with numpy.load by using mmap_mode).
+      Otherwise, out is assumed to be an array with the given shape, and it is
+      returned as such.
+    shape : tuple
+      The shape of the output, e.g. (n_ens_members,n_timesteps,m,n).
+    dtype : str or numpy.dtype
+      The data type of a new array or memmap. Not used if out is an array.
+    mode : {'w+', 'r+'}
+      The mode for opening a memmap if out is a string: 'w+' creates a new
+      file, overwriting an existing one, and 'r+' opens an existing file
+      for updating. The shape of an existing file must match the given shape.
+
+    Returns
+    -------
+    out : ndarray
+      The output array.
+
+    """
+    if out is None:
+        return np.empty(shape, dtype=dtype)
+    elif isinstance(out, str) and mode == "w+":
+        return np.lib.format.open_memmap(out, mode="w+", dtype=dtype,
+                                         shape=shape)
+    else:
+        if isinstance(out, str):
+            out = np.lib.format.open_memmap(out, mode=mode)
+        if out.shape != tuple(shape):
+            raise ValueError("out has shape %s, but %s is expected" % \
+                             (str(out.shape), str(tuple(shape))))
+        return out
@@ -35,7 +35,12 @@ def compute_empirical_cdf(bin_edges, hist):
 def nonparam_match_empirical_cdf(R, R_trg):
     """Matches the empirical CDF of the initial array with the empirical CDF
     of a target array. Initial ranks are conserved, but empirical distribution
-    matches the target one. Zero-pixels in initial array are conserved.
+    matches the target one. Zero-pixels in initial array are conserved. The
+    target array is not modified.
+
+    When several arrays are matched with the same target, it is more efficient
+    to sort the target only once by using nonparam_match_init and
+    nonparam_match_compute.
 
     Parameters
     ----------
@@ -52,50 +57,90 @@ def nonparam_match_empirical_cdf(R, R_trg):
     """
     if R.size != R_trg.size:
         raise ValueError("the input arrays must have the same size")
-    if np.any(~np.isfinite(R)) or np.any(~np.isfinite(R_trg)):
-      raise ValueError("input contains non-finite values")
 
+    return nonparam_match_compute(nonparam_match_init(R_trg), R)
 
-    # zeros in initial image
-    zvalue = R.min()
-    idxzeros = R == zvalue
+def nonparam_match_init(R_trg):
+    """Initialize a matcher object for matching the empirical CDFs of arrays
+    with the empirical CDF of a target array. The target values are sorted
+    once, and the matcher can be applied to any number of arrays with
+    nonparam_match_compute.
 
-    # zeros in target image
-    zvalue_trg = R_trg.min()
-    idxzeros_trg = R_trg == zvalue
+    Parameters
+    ----------
+    R_trg : array_like
+        The target array whose CDF is to be matched. The array is copied.
 
-    if np.sum(R_trg > zvalue_trg) > np.sum(R > zvalue):
-        # adjust the fraction of rain in target distribution if the number of zeros
-        # is greater than in the initial array
-        # TODO: this needs more testing
-        war = np.sum(R > zvalue)/R.size
-        p = np.percentile(R_trg, 100*(1 - war))
-        R_trg[R_trg < p] = zvalue_trg
+    Returns
+    -------
+    out : dict
+        The matcher object containing the sorted target values ('ranked'),
+        the minimum value of the target ('zvalue'), the fraction of the target
+        values greater than the minimum ('war') and the size of the target
+        ('size').
 
-    # flatten the arrays
-    arrayshape = R.shape
-    R_trg = R_trg.flatten()
-    R = R.flatten()
+    """
+    if np.any(~np.isfinite(R_trg)):
+        raise ValueError("input contains non-finite values")
 
-    # rank target values
-    order = R_trg.argsort()
-    ranked = R_trg[order]
+    matcher = {}
 
-    # rank initial values order
-    orderin = R.argsort()
-    ranks = np.empty(len(R), int)
-    ranks[orderin] = np.arange(len(R))
+    matcher["ranked"] = np.sort(R_trg, axis=None)
+    matcher["zvalue"] = matcher["ranked"][0]
+    matcher["size"]   = matcher["ranked"].size
+    matcher["war"]    = np.sum(matcher["ranked"] > matcher["zvalue"]) / matcher["size"]
 
-    # get ranked values from target and rearrange with inital order
-    R = ranked[ranks]
+    return matcher
 
-    # reshape as original array
-    R = R.reshape(arrayshape)
+def nonparam_match_compute(matcher, R):
+    """Match the empirical CDF of the given array(s) with the empirical CDF of
+    the target array of a matcher object. Initial ranks are conserved, but
+    empirical distribution matches the target one. Zero-pixels (i.e. the
+    pixels having the minimum value) in initial array are conserved.
 
-    # readding original zeros
-    R[idxzeros] = zvalue_trg
+    Parameters
+    ----------
+    matcher : dict
+        A matcher object returned by nonparam_match_init.
+    R : array_like
+        The initial array whose CDF is to be changed, having the same size as
+        the target array. Alternatively, an array whose first dimension is the
+        number of arrays to match, e.g. an array of shape (k,m,n) containing
+        the fields of k ensemble members. The arrays are matched separately.
 
-    return R
+    Returns
+    -------
+    out : ndarray
+        The new array(s) with the same shape as R.
+
+    """
+    n = matcher["size"]
+    if R.size == n:
+        R_ = R.reshape(1, n)
+    elif R.ndim > 1 and R[0].size == n:
+        R_ = R.reshape(R.shape[0], n)
+    else:
+        raise ValueError("the size of R does not match the size of the target array")
+    if np.any(~np.isfinite(R_)):
+        raise ValueError("input contains non-finite values")
+
+    ranked = matcher["ranked"]
+    out = np.empty(R_.shape, dtype=ranked.dtype)
+
+    for i in range(R_.shape[0]):
+        # the zeros are set to the minimum of the target, so only the values
+        # above the minimum need to be ranked. Their ranks are the largest
+        # ones, so they are matched with the largest target values. For the
+        # same reason, the adjustment of the fraction of rain in the target
+        # distribution would not change the result.
+        zvalue = R_[i].min()
+        idxwet = np.flatnonzero(R_[i] > zvalue)
+        order = R_[i][idxwet].argsort()
+
+        out[i, :] = matcher["zvalue"]
+        out[i, idxwet[order]] = ranked[n-len(idxwet):]
+
+    return out.reshape(R.shape)
 
 # TODO: What is this?
 def nonparam_match_empirical_cdf_masked():
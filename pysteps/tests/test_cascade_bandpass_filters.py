@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pytest
+
+from pysteps.cascade.bandpass_filters import (filter_gaussian, filter_uniform,
+                                              get_weights_2d)
+from pysteps.cascade.decomposition import decomposition_fft, recompose_fft
+
+
+@pytest.mark.parametrize("shape", [(48, 60), (49, 61), (64, 64)])
+@pytest.mark.parametrize("filter_method", [filter_gaussian, filter_uniform])
+def test_compact_filter(filter_method, shape):
+    """Test that the weights of a compact filter equal those of the dense
+    filter."""
+    filter = filter_method(shape, 6)
+    filter_c = filter_method(shape, 6, compact=True)
+
+    assert "weights_2d" not in filter_c
+    assert np.allclose(filter_c["weights_1d"], filter["weights_1d"])
+    for k in range(filter["weights_2d"].shape[0]):
+        W = filter["weights_2d"][k]
+        assert np.allclose(get_weights_2d(filter, k), W)
+        assert np.allclose(get_weights_2d(filter_c, k), W)
+
+        W_h = np.fft.ifftshift(W)[:, :shape[1]//2+1]
+        assert np.allclose(get_weights_2d(filter, k, half_spectrum=True), W_h)
+        assert np.allclose(get_weights_2d(filter_c, k, half_spectrum=True), W_h)
+
+
+@pytest.mark.parametrize("output_domain", ["spatial", "spectral"])
+def test_compact_filter_decomposition(output_domain):
+    """Test that the decomposition with a compact filter equals the one with
+    the dense filter and reproduces the input."""
+    X = np.random.RandomState(42).rand(48, 61)
+    filter = filter_gaussian(X.shape, 6)
+    filter_c = filter_gaussian(X.shape, 6, compact=True)
+
+    decomp = decomposition_fft(X, filter, output_domain=output_domain)
+    decomp_c = decomposition_fft(X, filter_c, output_domain=output_domain)
+
+    assert np.allclose(decomp_c["cascade_levels"], decomp["cascade_levels"])
+    assert np.allclose(decomp_c["stds"], decomp["stds"])
+    assert np.allclose(recompose_fft(decomp_c, shape=X.shape), X)
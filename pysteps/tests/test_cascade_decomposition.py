@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pytest
+
+from pysteps.cascade.bandpass_filters import filter_gaussian
+from pysteps.cascade.decomposition import decomposition_fft, recompose_fft
+
+
+def _synthetic_field(shape=(48, 60)):
+    return np.random.RandomState(42).rand(*shape)
+
+
+@pytest.mark.parametrize("shape", [(48, 60), (48, 61)])
+def test_decomposition_spectral(shape):
+    """Test that the spectral-domain cascade equals the spatial-domain one and
+    that both reproduce the input."""
+    X = _synthetic_field(shape)
+    filter = filter_gaussian(shape, 6)
+
+    decomp = decomposition_fft(X, filter)
+    decomp_s = decomposition_fft(X, filter, output_domain="spectral")
+
+    assert decomp_s["domain"] == "spectral"
+    assert decomp_s["cascade_levels"].shape == (6, shape[0], shape[1]//2+1)
+    levels = np.fft.irfft2(decomp_s["cascade_levels"], s=shape)
+    assert np.allclose(levels, decomp["cascade_levels"])
+
+    # the statistics computed from the spectra with Parseval's theorem
+    assert np.allclose(decomp_s["means"], decomp["means"])
+    assert np.allclose(decomp_s["stds"], decomp["stds"])
+
+    assert np.allclose(recompose_fft(decomp), X)
+    assert np.allclose(recompose_fft(decomp_s, shape=shape), X)
+
+
+@pytest.mark.parametrize("output_domain", ["spatial", "spectral"])
+def test_decomposition_normalized(output_domain):
+    """Test the normalized cascades and their recomposition."""
+    X = _synthetic_field()
+    filter = filter_gaussian(X.shape, 6)
+    MASK = X > 0.3
+
+    decomp = decomposition_fft(X, filter, MASK=MASK)
+    decomp_n = decomposition_fft(X, filter, MASK=MASK, normalize=True,
+                                 output_domain=output_domain)
+    assert np.allclose(decomp_n["means"], decomp["means"])
+    assert np.allclose(decomp_n["stds"], decomp["stds"])
+
+    levels = decomp_n["cascade_levels"]
+    if output_domain == "spectral":
+        levels = np.fft.irfft2(levels, s=X.shape)
+    for k in range(6):
+        X_ = (decomp["cascade_levels"][k] - decomp["means"][k]) / decomp["stds"][k]
+        assert np.allclose(levels[k], X_)
+
+    assert np.allclose(recompose_fft(decomp_n, shape=X.shape), X)
+
+
+def test_decomposition_batched():
+    """Test that a stack of fields is decomposed as the individual fields."""
+    X = np.stack([_synthetic_field(), _synthetic_field()[::-1]])
+    filter = filter_gaussian(X.shape[1:], 5)
+
+    for output_domain in ["spatial", "spectral"]:
+        decomp = decomposition_fft(X, filter, output_domain=output_domain)
+        for i in range(2):
+            decomp_ = decomposition_fft(X[i], filter,
+                                        output_domain=output_domain)
+            assert np.allclose(decomp["cascade_levels"][i],
+                               decomp_["cascade_levels"])
+            assert np.allclose(decomp["stds"][i], decomp_["stds"])
+        assert np.allclose(recompose_fft(decomp, shape=X.shape[1:]), X)
+
+
+@pytest.mark.parametrize("output_domain", ["spatial", "spectral"])
+def test_decomposition_float32(output_domain):
+    """Test that single-precision inputs give single-precision cascades that
+    are close to the double-precision ones."""
+    X = _synthetic_field()
+    filter = filter_gaussian(X.shape, 6)
+
+    decomp = decomposition_fft(X, filter, output_domain=output_domain)
+    decomp_32 = decomposition_fft(X.astype(np.float32), filter,
+                                  output_domain=output_domain)
+
+    dtype = np.float32 if output_domain == "spatial" else np.complex64
+    assert decomp_32["cascade_levels"].dtype == dtype
+    assert np.allclose(decomp_32["cascade_levels"], decomp["cascade_levels"],
+                       rtol=0.0, atol=1e-4)
+    X_r = recompose_fft(decomp_32, shape=X.shape)
+    assert X_r.dtype == np.float32
+    assert np.allclose(X_r, X, rtol=0.0, atol=1e-5)
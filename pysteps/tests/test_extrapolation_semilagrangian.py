@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pytest
+
+from pysteps.extrapolation import semilagrangian
+
+
+def _synthetic_inputs(shape=(32, 40)):
+    rs = np.random.RandomState(42)
+    R = rs.rand(*shape)
+    Y, X = np.meshgrid(np.arange(shape[0]), np.arange(shape[1]), indexing="ij")
+    # a rotating motion field
+    V = np.stack([-(Y - shape[0]/2.0) / 8.0, (X - shape[1]/2.0) / 8.0])
+
+    return R, V
+
+
+@pytest.mark.parametrize("return_indices", [False, True])
+def test_compute_trajectory(return_indices):
+    """Test that the extrapolation along a precomputed trajectory equals the
+    extrapolation computing the displacements."""
+    R, V = _synthetic_inputs()
+
+    R_e, D = semilagrangian.extrapolate(R, V, 5, return_displacement=True)
+
+    trajectory = semilagrangian.compute_trajectory(V, 8,
+                                                   return_indices=return_indices)
+    assert trajectory["D"].shape == (8, 2) + R.shape
+    R_e_t, D_t = semilagrangian.extrapolate(R, V, 5, trajectory=trajectory,
+                                            return_displacement=True)
+
+    assert np.array_equal(R_e, R_e_t, equal_nan=True)
+    assert np.array_equal(D, D_t)
+
+    # continue the extrapolation from the displacement after five time steps
+    R_e = semilagrangian.extrapolate(R, V, 3, D_prev=D)
+    R_e_t = semilagrangian.extrapolate(R, V, 3, trajectory=trajectory,
+                                       trajectory_offset=5)
+    assert np.allclose(R_e, R_e_t, equal_nan=True)
+
+    with pytest.raises(ValueError):
+        semilagrangian.extrapolate(R, V, 4, trajectory=trajectory,
+                                   trajectory_offset=5)
+
+
+def test_extrapolate_batch():
+    """Test that extrapolating a stack of fields equals extrapolating each
+    field separately, and that the final step equals the last one of the full
+    extrapolation."""
+    R, V = _synthetic_inputs()
+    R = np.stack([R, 1.0 - R, R**2])
+
+    R_e, D = semilagrangian.extrapolate(R, V, 4, return_displacement=True)
+    assert R_e.shape == (4,) + R.shape
+
+    for i in range(R.shape[0]):
+        R_e_, D_ = semilagrangian.extrapolate(R[i], V, 4,
+                                              return_displacement=True)
+        assert np.array_equal(R_e[:, i], R_e_, equal_nan=True)
+        assert np.array_equal(D, D_)
+
+    R_f, D_f = semilagrangian.extrapolate(R, V, 4, return_final_step=True,
+                                          return_displacement=True)
+    assert R_f.shape == (1,) + R.shape
+    assert np.array_equal(R_f[0], R_e[-1], equal_nan=True)
+    assert np.array_equal(D_f, D)
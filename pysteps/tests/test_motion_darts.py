@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+from numpy.linalg import svd
+import pytest
+from scipy.ndimage import gaussian_filter, shift
+
+from pysteps.motion import darts
+
+
+def _synthetic_inputs(num_frames=5, shape=(64, 72), speed=(1.0, 2.0)):
+    # a smooth rain field translated by speed pixels per time step
+    rs = np.random.RandomState(42)
+    R_ = gaussian_filter(rs.rand(*shape), 4)
+    return np.stack([shift(R_, (speed[0]*i, speed[1]*i), mode="wrap")
+                     for i in range(num_frames)])
+
+
+def _DARTS_old(Z, N_x, N_y, N_t, M_x, M_y):
+    # the implementation of DARTS that assembled the system in loops over the
+    # rows, used the full FFT and solved the normal equations with the SVD
+    Z = np.moveaxis(Z, (0, 1, 2), (2, 0, 1))
+
+    T_x = Z.shape[1]
+    T_y = Z.shape[0]
+    T_t = Z.shape[2]
+
+    Z = np.fft.fftn(Z)
+
+    m = (2*N_x+1)*(2*N_y+1)*(2*N_t+1)
+    n = (2*M_x+1)*(2*M_y+1)
+
+    y = np.zeros(m, dtype=complex)
+    k_t,k_y,k_x = np.unravel_index(np.arange(m), (2*N_t+1, 2*N_y+1, 2*N_x+1))
+    for i in range(m):
+        y[i] = (k_t[i] - N_t) * Z[k_y[i] - N_y, k_x[i] - N_x, k_t[i] - N_t]
+
+    A = np.zeros((m, n), dtype=complex)
+    B = np.zeros((m, n), dtype=complex)
+
+    c1 = -1.0*T_t / (T_x * T_y)
+    kp_y,kp_x = np.unravel_index(np.arange(n), (2*M_y+1, 2*M_x+1))
+    for i in range(m):
+        i_ = k_y[i] - N_y - (kp_y - M_y)
+        j_ = k_x[i] - N_x - (kp_x - M_x)
+        Z_ = Z[i_, j_, k_t[i] - N_t]
+        A[i, :] = c1 / T_y * i_ * Z_
+        B[i, :] = c1 / T_x * j_ * Z_
+
+    M = np.hstack([A, B])
+    M_ct = M.conjugate().T
+    U,s,V = svd(np.dot(M_ct, M), full_matrices=False)
+    mask = s > 0.01*s[0]
+    s = 1.0 / s[mask]
+    MM_inv = np.dot(np.dot(V[:len(s), :].conjugate().T, np.diag(s)),
+                    U[:, :len(s)].conjugate().T)
+    x = np.dot(MM_inv, np.dot(M_ct, y))
+
+    h,w = 2*M_y+1,2*M_x+1
+    U = np.zeros((h, w), dtype=complex)
+    V = np.zeros((h, w), dtype=complex)
+    i,j = np.unravel_index(np.arange(h*w), (h, w))
+    V[i, j] = x[0:h*w]
+    U[i, j] = x[h*w:2*h*w]
+
+    k_x,k_y = np.meshgrid(np.arange(-M_x, M_x+1), np.arange(-M_y, M_y+1))
+    U = np.real(np.fft.ifft2(darts._fill(U, T_y, T_x, k_x, k_y)))
+    V = np.real(np.fft.ifft2(darts._fill(V, T_y, T_x, k_x, k_y)))
+
+    return np.stack([U, V])
+
+
+@pytest.mark.parametrize("fft_method", ["numpy", "scipy"])
+def test_darts(fft_method):
+    """Test that DARTS gives the same motion field as the old implementation
+    assembling the system in loops."""
+    Z = _synthetic_inputs()
+    kwargs = {"N_x":10, "N_y":8, "N_t":2, "M_x":2, "M_y":1}
+
+    UV = darts.DARTS(Z, fft_method=fft_method, verbose=False, **kwargs)
+    UV_old = _DARTS_old(Z, **kwargs)
+
+    assert UV.shape == (2,) + Z.shape[1:]
+    assert np.allclose(UV, UV_old, rtol=0.0,
+                       atol=1e-10*np.max(np.abs(UV_old)))
+
+
+def test_darts_cache():
+    """Test that the motion fields computed with the cached FFTs and the
+    sliding DFT in a rolling window equal the ones computed without them."""
+    num_frames = 5
+    num_cycles = 8
+    Z = _synthetic_inputs(num_frames=num_frames+num_cycles-1)
+    kwargs = {"N_x":10, "N_y":8, "N_t":2, "M_x":2, "M_y":1, "verbose":False}
+
+    cache = {}
+    for c in range(num_cycles):
+        Z_ = Z[c:c+num_frames]
+        timestamps = list(range(c, c+num_frames))
+        UV = darts.DARTS(Z_, cache=cache, timestamps=timestamps, **kwargs)
+        UV_ = darts.DARTS(Z_, **kwargs)
+
+        assert np.allclose(UV, UV_, rtol=0.0,
+                           atol=1e-10*np.max(np.abs(UV_)))
+        # the images of the window and the spectrum
+        assert len(cache) == num_frames + 1
+        # the temporal DFT is recomputed after num_frames sliding updates
+        assert cache[("spectrum", Z_.shape[1:])][2] == c % (num_frames+1)
+
+    # the same window again uses the cached spectrum
+    UV_c = darts.DARTS(Z_, cache=cache, timestamps=timestamps, **kwargs)
+    assert np.array_equal(UV_c, UV)
+
+    with pytest.raises(ValueError):
+        darts.DARTS(Z_, cache=cache, **kwargs)
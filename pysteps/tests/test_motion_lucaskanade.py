@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pytest
+import scipy.spatial
+from scipy.ndimage import gaussian_filter, shift
+
+pytest.importorskip("cv2")
+
+from pysteps.motion import lucaskanade
+from pysteps.utils import profiling
+
+
+def _synthetic_inputs(num_frames=4, shape=(100, 120), speed=(1.0, 2.0)):
+    # a smooth rain field translated by speed pixels per time step
+    rs = np.random.RandomState(42)
+    R_ = np.maximum(gaussian_filter(rs.rand(*shape), 4) - 0.5, 0.0) * 100.0
+    return np.stack([shift(R_, (speed[0]*i, speed[1]*i), mode="wrap")
+                     for i in range(num_frames)])
+
+
+def test_dense_lucaskanade_num_workers():
+    """Test that tracking the frame pairs in threads gives the same motion
+    field as tracking them sequentially."""
+    R = _synthetic_inputs()
+
+    UV = lucaskanade.dense_lucaskanade(R, verbose=False)
+    UV_ = lucaskanade.dense_lucaskanade(R, num_workers=3, verbose=False)
+
+    assert np.all(np.isfinite(UV))
+    assert np.array_equal(UV, UV_)
+
+
+def test_dense_lucaskanade_cache():
+    """Test that the motion fields computed with the cache of the frame pairs
+    in a rolling window equal the ones computed without it, and that only the
+    newest pair is tracked."""
+    num_frames = 3
+    R = _synthetic_inputs(num_frames=num_frames+2)
+
+    cache = {}
+    for c in range(3):
+        sink = profiling.get_sink("recording")
+        timestamps = list(range(c, c+num_frames))
+        UV = lucaskanade.dense_lucaskanade(R[c:c+num_frames], cache=cache,
+                                           timestamps=timestamps,
+                                           profiler=sink, verbose=False)
+        UV_ = lucaskanade.dense_lucaskanade(R[c:c+num_frames], verbose=False)
+        assert np.array_equal(UV, UV_)
+
+        pairs = [span["pair"] for span in sink.spans
+                 if span["name"] == "lucaskanade.tracking"]
+        assert pairs == (list(range(num_frames-1)) if c == 0
+                         else [num_frames-2])
+        assert len(cache) == num_frames - 1
+
+    with pytest.raises(ValueError):
+        lucaskanade.dense_lucaskanade(R, cache=cache, verbose=False)
+
+
+def _declustering_old(x, y, u, v, decl_grid, min_nr_samples):
+    # the implementation of _declustering that looped over the grid cells
+    x = x[:,None]
+    y = y[:,None]
+    u = u[:,None]
+    v = v[:,None]
+
+    xT = np.floor(x/float(decl_grid))
+    yT = np.floor(y/float(decl_grid))
+
+    xy = np.hstack((xT,yT)).squeeze()
+    xyb = np.ascontiguousarray(xy).view(np.dtype((np.void, xy.dtype.itemsize*xy.shape[1])))
+    _,idx = np.unique(xyb, return_index=True)
+    unique_xy = xy[idx]
+
+    xN=[]; yN=[]; uN=[]; vN=[]
+    for i in range(unique_xy.shape[0]):
+        idx = np.logical_and(xT==unique_xy[i,0], yT==unique_xy[i,1])
+        npoints = np.sum(idx)
+        if npoints >= min_nr_samples:
+            xN.append(np.median(x[idx]))
+            yN.append(np.median(y[idx]))
+            uN.append(np.median(u[idx]))
+            vN.append(np.median(v[idx]))
+
+    return np.array(xN), np.array(yN), np.array(uN), np.array(vN)
+
+
+@pytest.mark.parametrize("min_nr_samples", [1, 2, 4])
+def test_declustering(min_nr_samples):
+    """Test that the vectorized declustering gives the same vectors as the old
+    implementation looping over the grid cells."""
+    rs = np.random.RandomState(42)
+    x = rs.rand(500) * 120
+    y = rs.rand(500) * 100
+    u = rs.randn(500)
+    v = rs.randn(500)
+
+    vectors = lucaskanade._declustering(x, y, u, v, 20, min_nr_samples)
+    vectors_old = _declustering_old(x, y, u, v, 20, min_nr_samples)
+
+    for X, X_old in zip(vectors, vectors_old):
+        assert np.allclose(X, X_old, rtol=0.0, atol=1e-12)
+
+    # the columns of stacked sparse vectors are accepted
+    vectors = lucaskanade._declustering(x[:,None], y[:,None], u[:,None],
+                                        v[:,None], 20, min_nr_samples)
+    for X, X_old in zip(vectors, vectors_old):
+        assert np.allclose(X, X_old, rtol=0.0, atol=1e-12)
+
+
+def _interpolate_sparse_vectors_old(x, y, u, v, domain_size, function, k):
+    # the implementation of _interpolate_sparse_vectors that computed all the
+    # pairwise distances of the sparse vectors for the bandwidth
+    points = np.column_stack((x, y))
+
+    X, Y = np.meshgrid(np.arange(domain_size[1]), np.arange(domain_size[0]))
+    grid = np.column_stack((X.ravel(), Y.ravel()))
+
+    if function == "nearest":
+        _, inds = scipy.spatial.cKDTree(points).query(grid, k=1)
+        U = u[inds]
+        V = v[inds]
+    else:
+        if k == "all":
+            d = scipy.spatial.distance.cdist(points, grid, 'euclidean').transpose()
+            inds = np.arange(u.size)[None,:]*np.ones((grid.shape[0],u.size)).astype(int)
+        else:
+            d, inds = scipy.spatial.cKDTree(points).query(grid, k=k)
+
+        epsilon = np.median(scipy.spatial.distance.pdist(points, 'euclidean'))
+
+        if function == "inverse":
+            w = 1.0/np.sqrt((d/epsilon)**2 + 1)
+        else:
+            w = np.exp(-0.5*(d/epsilon)**2)
+
+        U = np.sum(w * u[inds], axis=1) / np.sum(w, axis=1)
+        V = np.sum(w * v[inds], axis=1) / np.sum(w, axis=1)
+
+    return np.stack([U.reshape(domain_size), V.reshape(domain_size)])
+
+
+@pytest.mark.parametrize("function, k", [("nearest", 20), ("inverse", 20),
+                                         ("gaussian", 20), ("inverse", "all")])
+def test_interpolate_sparse_vectors(function, k):
+    """Test that the interpolation gives the same motion field as the old
+    implementation, also when the chunks are interpolated in threads, and
+    that the coarse interpolation equals it at the coarse grid points."""
+    rs = np.random.RandomState(42)
+    domain_size = (50, 60)
+    x = rs.rand(300) * domain_size[1]
+    y = rs.rand(300) * domain_size[0]
+    u = rs.randn(300)
+    v = rs.randn(300)
+
+    UV_old = _interpolate_sparse_vectors_old(x, y, u, v, domain_size,
+                                             function, k)
+
+    _, _, UV = lucaskanade._interpolate_sparse_vectors(
+        x, y, u, v, domain_size, function=function, k=k)
+    assert np.allclose(UV, UV_old, rtol=0.0, atol=1e-12)
+
+    _, _, UV_ = lucaskanade._interpolate_sparse_vectors(
+        x, y, u, v, domain_size, function=function, k=k, num_workers=3)
+    assert np.array_equal(UV, UV_)
+
+    X, Y, UV_ = lucaskanade._interpolate_sparse_vectors(
+        x, y, u, v, domain_size, function=function, k=k, interp_step=4)
+    assert UV_.shape == UV.shape
+    assert X.shape == domain_size
+    idx = np.ix_(range(0, 50, 4), range(0, 60, 4))
+    assert np.allclose(UV_[0][idx], UV[0][idx], rtol=0.0, atol=1e-12)
+    assert np.allclose(UV_[1][idx], UV[1][idx], rtol=0.0, atol=1e-12)
+
+
+def test_median_distance():
+    """Test that the median distance of the points is computed from all the
+    points when there are at most max_points of them."""
+    points = np.random.RandomState(42).rand(500, 2)
+    assert lucaskanade._median_distance(points) == \
+        np.median(scipy.spatial.distance.pdist(points))
+    assert np.isclose(lucaskanade._median_distance(points, max_points=200),
+                      np.median(scipy.spatial.distance.pdist(points)),
+                      rtol=0.1)
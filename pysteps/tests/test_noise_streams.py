@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pytest
+
+from pysteps import noise
+from pysteps.noise import streams
+
+
+def test_same_address():
+    """Test that the same stream address gives the same random numbers."""
+    seed = streams.create_seed(42)
+    assert seed == 42
+
+    X = streams.get_generator(seed, 3, 5, "precip").standard_normal(100)
+    X_ = streams.get_generator(seed, 3, 5, "precip").standard_normal(100)
+    assert np.array_equal(X, X_)
+
+    X_ = [g.standard_normal(100) for g in
+          streams.get_generators(seed, [2, 3], 5, "precip")]
+    assert np.array_equal(X, X_[1])
+
+
+def test_different_addresses():
+    """Test that the streams of different addresses differ."""
+    seed = streams.create_seed(42)
+    X = streams.get_generator(seed, 3, 5, "precip").standard_normal(100)
+    for address in [(43, 3, 5, "precip"), (42, 4, 5, "precip"),
+                    (42, 3, 6, "precip"), (42, 3, 5, "motion"),
+                    (42, 5, 3, "precip")]:
+        X_ = streams.get_generator(*address).standard_normal(100)
+        assert not np.array_equal(X, X_)
+
+    assert streams.create_seed() != streams.create_seed()
+    with pytest.raises(ValueError):
+        streams.get_generator(None)
+    with pytest.raises(ValueError):
+        streams.get_generator(seed, purpose="unknown")
+
+
+def test_noise_generator_streams():
+    """Test that the noise fields drawn from the same stream are equal."""
+    R = np.random.RandomState(42).rand(32, 32)
+    init_noise, generate_noise = noise.get_method("nonparametric")
+    F = init_noise(R, win_type="hanning")
+
+    N = generate_noise(F, randstate=streams.get_generator(42, 1, 2))
+    N_ = generate_noise(F, randstate=streams.get_generator(42, 1, 2))
+    assert np.array_equal(N, N_)
+
+    N_ = generate_noise(F, randstate=streams.get_generators(42, [0, 1], 2))
+    assert np.allclose(N_[1], N)
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+from pysteps.nowcasts import extrapolation
+
+
+def test_extrapolation_out(tmp_path):
+    """Test writing the extrapolation nowcast into a preallocated array and a
+    memory-mapped file."""
+    R = np.random.RandomState(42).rand(32, 40)
+    V = np.ones((2, 32, 40))
+
+    R_f = extrapolation.forecast(R, V, 4)
+
+    out = np.empty((4, 32, 40))
+    assert extrapolation.forecast(R, V, 4, out=out) is out
+    assert np.array_equal(out, R_f, equal_nan=True)
+
+    filename = str(tmp_path / "out.npy")
+    extrapolation.forecast(R, V, 4, out=filename)
+    assert np.array_equal(np.load(filename), R_f, equal_nan=True)
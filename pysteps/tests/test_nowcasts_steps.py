@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pytest
+from scipy.ndimage import gaussian_filter, shift
+
+from pysteps.nowcasts import steps
+from pysteps.utils import profiling
+
+
+def _synthetic_inputs(ar_order=2, shape=(64, 64), speed=2.0):
+    # a smooth rain field translated by speed pixels per time step in the x
+    # direction, in dBR units
+    rs = np.random.RandomState(42)
+    R_ = gaussian_filter(rs.rand(*shape), 3) * 10.0
+    R = np.stack([shift(R_, (0, speed*i), mode="wrap")
+                  for i in range(ar_order+1)])
+    R = np.log10(np.maximum(R, 0.1))
+
+    V = np.zeros((2,) + shape)
+    V[0, :, :] = speed
+
+    return R, V
+
+
+def test_steps_cycle_cache():
+    """Test that the cycle cache does not change a deterministic forecast when
+    the cache is empty."""
+    R, V = _synthetic_inputs()
+    kwargs = {"R_thr":-1.0, "kmperpixel":1.0, "timestep":5,
+              "noise_method":None, "mask_method":"obs", "seed":42}
+
+    R_f = steps.forecast(R, V, 3, 1, 4, **kwargs)
+
+    cycle_cache = {}
+    timestamps = list(range(R.shape[0]))
+    R_f_c = steps.forecast(R, V, 3, 1, 4, cycle_cache=cycle_cache,
+                           timestamps=timestamps, **kwargs)
+    assert np.allclose(R_f, R_f_c, rtol=0.0, atol=1e-10, equal_nan=True)
+    assert len(cycle_cache) == R.shape[0]
+
+
+def test_steps_cycle_cache_rolling():
+    """Test that only the most recent field is decomposed in the subsequent
+    cycles."""
+    ar_order = 2
+    n_cycles = 4
+    R, V = _synthetic_inputs(ar_order=ar_order+n_cycles-1)
+    kwargs = {"R_thr":-1.0, "kmperpixel":1.0, "timestep":5,
+              "noise_method":None, "mask_method":"obs", "seed":42}
+
+    cycle_cache = {}
+    for c in range(n_cycles):
+        sink = profiling.get_sink("recording")
+        steps.forecast(R[c:c+ar_order+1], V, 2, 1, 4, ar_order=ar_order,
+                       cycle_cache=cycle_cache,
+                       timestamps=list(range(c, c+ar_order+1)),
+                       profiler=sink, **kwargs)
+        frames = [span["frame"] for span in sink.spans
+                  if span["name"] == "steps.decomposition"]
+        if c == 0:
+            # the previous fields are decomposed in their original and
+            # advected positions
+            assert sorted(frames) == [0, 0, 1, 1, 2]
+        else:
+            assert frames == [ar_order]
+        assert sorted(key[0] for key in cycle_cache.keys()) == \
+            list(range(c, c+ar_order+1))
+
+
+def test_steps_precompute_trajectory():
+    """Test that the precomputed trajectory gives the same forecast."""
+    R, V = _synthetic_inputs()
+    kwargs = {"R_thr":-1.0, "kmperpixel":1.0, "timestep":5,
+              "noise_method":None, "mask_method":"obs", "seed":42}
+
+    R_f = steps.forecast(R, V, 3, 1, 4, **kwargs)
+    R_f_t = steps.forecast(R, V, 3, 1, 4, precompute_trajectory=True, **kwargs)
+    assert np.array_equal(R_f, R_f_t, equal_nan=True)
+
+
+def test_steps_worker_processes():
+    """Test that the worker processes give the same forecast as the serial
+    computation."""
+    R, V = _synthetic_inputs()
+    kwargs = {"R_thr":-1.0, "kmperpixel":1.0, "timestep":5,
+              "noise_method":"nonparametric",
+              "noise_kwargs":{"win_type":"hanning"},
+              "mask_method":"incremental", "seed":42}
+
+    R_f = steps.forecast(R, V, 3, 3, 4, num_workers=1, **kwargs)
+    R_f_p = steps.forecast(R, V, 3, 3, 4, num_workers=2,
+                           parallel_method="processes", **kwargs)
+    assert np.array_equal(R_f, R_f_p, equal_nan=True)
+
+
+def test_steps_spectral_domain():
+    """Test that iterating the cascades as spectra gives the same forecast as
+    iterating them in the spatial domain."""
+    R, V = _synthetic_inputs()
+    kwargs = {"R_thr":-1.0, "kmperpixel":1.0, "timestep":5,
+              "noise_method":"nonparametric",
+              "noise_kwargs":{"win_type":"hanning"},
+              "mask_method":"incremental", "seed":42}
+
+    R_f = steps.forecast(R, V, 3, 2, 4, **kwargs)
+    R_f_s = steps.forecast(R, V, 3, 2, 4, domain="spectral", **kwargs)
+    assert np.allclose(R_f, R_f_s, equal_nan=True)
+
+
+def test_steps_float32():
+    """Test that the single-precision forecast is close to the
+    double-precision one."""
+    R, V = _synthetic_inputs()
+    kwargs = {"R_thr":-1.0, "kmperpixel":1.0, "timestep":5,
+              "noise_method":None, "mask_method":"obs", "seed":42}
+
+    R_f = steps.forecast(R, V, 3, 1, 4, **kwargs)
+    R_f_32 = steps.forecast(R, V, 3, 1, 4, dtype="float32", **kwargs)
+    assert R_f_32.dtype == np.float32
+    # the probability matching can swap the ranks of nearly equal values
+    assert np.allclose(R_f, R_f_32, rtol=0.0, atol=1e-3, equal_nan=True)
+
+
+def test_steps_iter_forecast():
+    """Test that the generator yields the time steps of forecast."""
+    R, V = _synthetic_inputs()
+    kwargs = {"R_thr":-1.0, "kmperpixel":1.0, "timestep":5,
+              "noise_method":"nonparametric",
+              "noise_kwargs":{"win_type":"hanning"},
+              "mask_method":"incremental", "seed":42}
+
+    R_f = steps.forecast(R, V, 3, 2, 4, **kwargs)
+
+    n = 0
+    for t, R_f_ in steps.iter_forecast(R, V, 3, 2, 4, **kwargs):
+        assert t == n
+        assert R_f_.shape == (2,) + R.shape[1:]
+        assert np.array_equal(R_f_, R_f[:, t], equal_nan=True)
+        n += 1
+    assert n == 3
+
+
+def test_steps_out(tmp_path):
+    """Test writing the forecast into a preallocated array and a memory-mapped
+    file."""
+    R, V = _synthetic_inputs()
+    kwargs = {"R_thr":-1.0, "kmperpixel":1.0, "timestep":5,
+              "noise_method":"nonparametric",
+              "noise_kwargs":{"win_type":"hanning"},
+              "mask_method":"incremental", "seed":42}
+
+    R_f = steps.forecast(R, V, 3, 2, 4, **kwargs)
+
+    out = np.empty((2, 3) + R.shape[1:])
+    R_f_o = steps.forecast(R, V, 3, 2, 4, out=out, **kwargs)
+    assert R_f_o is out
+    assert np.array_equal(out, R_f, equal_nan=True)
+
+    filename = str(tmp_path / "out.npy")
+    steps.forecast(R, V, 3, 2, 4, out=filename, return_output=False,
+                   **kwargs)
+    assert np.array_equal(np.load(filename), R_f, equal_nan=True)
+
+    with pytest.raises(ValueError):
+        steps.forecast(R, V, 3, 2, 4, out=np.empty((2, 2) + R.shape[1:]),
+                       **kwargs)
+
+
+@pytest.mark.parametrize("mask_method", ["incremental", "sprog"])
+def test_steps_checkpoint(tmp_path, mask_method):
+    """Test that resuming a forecast from a checkpoint gives the same time
+    steps as the uninterrupted forecast."""
+    R, V = _synthetic_inputs()
+    kwargs = {"R_thr":-1.0, "kmperpixel":1.0, "timestep":5,
+              "noise_method":"nonparametric",
+              "noise_kwargs":{"win_type":"hanning"},
+              "mask_method":mask_method, "seed":42}
+
+    R_f = steps.forecast(R, V, 4, 2, 4, **kwargs)
+
+    # write the checkpoint after two time steps and continue the forecast to
+    # four time steps into the same output file
+    checkpoint = str(tmp_path / "checkpoint.npz")
+    out = str(tmp_path / "out.npy")
+    steps.forecast(R, V, 2, 2, 4, checkpoint=checkpoint, out=out,
+                   return_output=False, **kwargs)
+    R_f_r = steps.forecast(R, V, 4, 2, 4, resume=checkpoint, out=out,
+                           **kwargs)
+
+    assert np.array_equal(R_f_r, R_f, equal_nan=True)
+    assert np.array_equal(np.load(out), R_f, equal_nan=True)
+
+    # the time steps before the checkpoint are not computed
+    R_f_r = steps.forecast(R, V, 4, 2, 4, resume=checkpoint, **kwargs)
+    assert np.all(np.isnan(R_f_r[:, :2]))
+    assert np.array_equal(R_f_r[:, 2:], R_f[:, 2:], equal_nan=True)
+
+
+def test_steps_member_streams():
+    """Test that the members do not depend on the number of members or on
+    whether they are computed in a batch."""
+    R, V = _synthetic_inputs()
+    kwargs = {"R_thr":-1.0, "kmperpixel":1.0, "timestep":5,
+              "noise_kwargs":{"win_type":"hanning"}, "mask_method":"incremental",
+              "seed":42}
+
+    R_f = steps.forecast(R, V, 2, 2, 4, **kwargs)
+    R_f_3 = steps.forecast(R, V, 2, 3, 4, **kwargs)
+    R_f_b = steps.forecast(R, V, 2, 3, 4, batch_members=True, **kwargs)
+
+    assert np.allclose(R_f, R_f_3[:2], equal_nan=True)
+    assert np.allclose(R_f_3, R_f_b, equal_nan=True)
+
+
+@pytest.mark.parametrize("batch_members", [False, True])
+def test_steps_noise_prefetch(batch_members):
+    """Test that prefetching the noise cascades in the background does not
+    change the forecast."""
+    R, V = _synthetic_inputs()
+    kwargs = {"R_thr":-1.0, "kmperpixel":1.0, "timestep":5,
+              "noise_kwargs":{"win_type":"hanning"}, "mask_method":"incremental",
+              "seed":42, "batch_members":batch_members}
+
+    R_f = steps.forecast(R, V, 3, 2, 4, **kwargs)
+    R_f_p = steps.forecast(R, V, 3, 2, 4, noise_prefetch=2, **kwargs)
+
+    assert np.array_equal(R_f, R_f_p, equal_nan=True)
+
+
+def _get_wet_area_threshold_old(R, war):
+    # the sort-based implementation used by the S-PROG mask
+    R_s = R.flatten()
+    R_s.sort(kind="quicksort")
+    x = 1.0*np.arange(1, len(R_s)+1)[::-1] / len(R_s)
+    i = np.argmin(abs(x - war))
+    if R_s[i] == R_s[i + 1]:
+        i = np.where(R_s == R_s[i])[0][-1] + 1
+    return R_s[i]
+
+
+@pytest.mark.parametrize("war", [0.05, 0.25, 0.5, 0.77, 0.9])
+def test_wet_area_threshold(war):
+    """Test that the selection-based threshold of the S-PROG mask is the same
+    as the one obtained by sorting the field."""
+    rs = np.random.RandomState(42)
+    R = rs.randn(33, 47)
+    assert steps._get_wet_area_threshold(R, war) == \
+        _get_wet_area_threshold_old(R, war)
+
+    # ties around the threshold
+    R = np.round(R, 1)
+    assert steps._get_wet_area_threshold(R, war) == \
+        _get_wet_area_threshold_old(R, war)
+
+
+@pytest.mark.parametrize("radius", [1, 2, 5])
+def test_buffer_masks(radius):
+    """Test that buffering the masks with the distance transform is the same
+    as the binary dilation with the iterated structuring element."""
+    from scipy.ndimage import (binary_dilation, generate_binary_structure,
+                               iterate_structure)
+
+    rs = np.random.RandomState(42)
+    MASK = rs.rand(3, 40, 50) > 0.995
+    MASK[1, :, :] = False
+    MASK[2, 0, 0] = True
+
+    struct = iterate_structure(generate_binary_structure(2, 1), radius)
+    MASK_b = steps._buffer_masks(MASK, radius)
+
+    for j in range(MASK.shape[0]):
+        assert np.array_equal(MASK_b[j], binary_dilation(MASK[j], struct))
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pytest
+
+from pysteps.postprocessing import probmatching
+
+
+def _nonparam_match_empirical_cdf_old(R, R_trg):
+    # the implementation of nonparam_match_empirical_cdf that sorted the
+    # target array at each call
+    R_trg = R_trg.copy()
+
+    zvalue = R.min()
+    idxzeros = R == zvalue
+
+    zvalue_trg = R_trg.min()
+
+    if np.sum(R_trg > zvalue_trg) > np.sum(R > zvalue):
+        war = np.sum(R > zvalue)/R.size
+        p = np.percentile(R_trg, 100*(1 - war))
+        R_trg[R_trg < p] = zvalue_trg
+
+    arrayshape = R.shape
+    R_trg = R_trg.flatten()
+    R = R.flatten()
+
+    order = R_trg.argsort()
+    ranked = R_trg[order]
+
+    orderin = R.argsort()
+    ranks = np.empty(len(R), int)
+    ranks[orderin] = np.arange(len(R))
+
+    R = ranked[ranks]
+    R = R.reshape(arrayshape)
+    R[idxzeros] = zvalue_trg
+
+    return R
+
+
+@pytest.mark.parametrize("wet_fraction", [0.3, 0.5, 0.7, 1.0])
+def test_nonparam_match(wet_fraction):
+    """Test that the matcher gives the same arrays as the old implementation
+    that sorted the target array at each call."""
+    rs = np.random.RandomState(42)
+    R_trg = np.maximum(rs.rand(20, 30) - 0.5, 0.0)
+    R = np.maximum(rs.rand(3, 20, 30) - 1.0 + wet_fraction, 0.0)
+    R_trg_ = R_trg.copy()
+
+    matcher = probmatching.nonparam_match_init(R_trg)
+    R_m = probmatching.nonparam_match_compute(matcher, R)
+
+    for i in range(R.shape[0]):
+        R_m_old = _nonparam_match_empirical_cdf_old(R[i], R_trg)
+        assert np.array_equal(R_m[i], R_m_old)
+        assert np.array_equal(probmatching.nonparam_match_compute(matcher, R[i]),
+                              R_m_old)
+        assert np.array_equal(
+            probmatching.nonparam_match_empirical_cdf(R[i], R_trg), R_m_old)
+
+    # the target array is not modified
+    assert np.array_equal(R_trg, R_trg_)
+
+
+def test_nonparam_match_errors():
+    """Test that the matcher rejects arrays with a different size or with
+    non-finite values."""
+    matcher = probmatching.nonparam_match_init(np.zeros((4, 5)))
+    with pytest.raises(ValueError):
+        probmatching.nonparam_match_compute(matcher, np.zeros((4, 6)))
+    with pytest.raises(ValueError):
+        probmatching.nonparam_match_compute(matcher, np.full((4, 5), np.nan))
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pytest
+
+from pysteps.timeseries import autoregression
+
+
+@pytest.mark.parametrize("p", [1, 2, 3])
+def test_ar_state(p):
+    """Test that iterating the in-place AR(p) state gives the same fields as
+    iterate_ar_model."""
+    rs = np.random.RandomState(42)
+    X = rs.rand(p, 8, 10)
+    phi = np.append(rs.rand(p) / p, 0.5)
+
+    state = autoregression.initialize_ar_state(X)
+    X_ = X.copy()
+    for t in range(5):
+        EPS = rs.randn(8, 10)
+        X_ = autoregression.iterate_ar_model(X_, phi, EPS=EPS)
+        autoregression.iterate_ar_state(state, phi, EPS=EPS)
+
+        assert np.allclose(autoregression.get_ar_state_fields(state), X_)
+        assert np.allclose(autoregression.get_ar_state_fields(state, lag=0),
+                           X_[-1])
+
+    # the input is copied by default
+    assert state["X"] is not X
+
+
+def test_ar_state_levels():
+    """Test the iteration of the AR(p) models of several cascade levels of
+    several members in one call."""
+    rs = np.random.RandomState(42)
+    X = rs.rand(3, 4, 2, 8, 10)
+    X_ = X.copy()
+    phi = np.hstack([rs.rand(4, 2) / 2, np.full((4, 1), 0.5)])
+    EPS = rs.randn(3, 4, 8, 10)
+
+    state = autoregression.initialize_ar_state(X, copy=False)
+    autoregression.iterate_ar_state(state, phi, EPS=EPS)
+
+    # the state uses the input array as its buffer
+    assert state["X"] is X
+
+    for i in range(4):
+        X__ = autoregression.iterate_ar_model(X_[:, i], phi[i], EPS=EPS[:, i])
+        assert np.allclose(autoregression.get_ar_state_fields(state)[:, i], X__)
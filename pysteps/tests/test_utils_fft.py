@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pytest
+
+from pysteps.utils import fft
+
+
+def _backends():
+    names = ["numpy", "scipy"]
+    try:
+        import pyfftw
+        names.append("pyfftw")
+    except ImportError:
+        pass
+    return names
+
+
+@pytest.mark.parametrize("name", _backends())
+def test_backend_transforms(name):
+    """Test that the transforms of the backend equal those of numpy.fft."""
+    X = np.random.RandomState(42).rand(3, 16, 12)
+    backend = fft.get_backend(name)
+
+    assert np.allclose(backend.fft2(X), np.fft.fft2(X))
+    assert np.allclose(backend.ifft2(X), np.fft.ifft2(X))
+    assert np.allclose(backend.rfft2(X), np.fft.rfft2(X))
+    assert np.allclose(backend.irfft2(np.fft.rfft2(X), s=X.shape[1:]), X)
+    assert np.allclose(backend.fftn(X, axes=(0,)), np.fft.fftn(X, axes=(0,)))
+    assert np.allclose(backend.ifftn(X), np.fft.ifftn(X))
+
+    # the input is not modified
+    F = np.fft.rfft2(X)
+    F_ = F.copy()
+    backend.irfft2(F, s=X.shape[1:])
+    assert np.array_equal(F, F_)
+
+    # the transforms computed with cached plans give the same results
+    assert np.allclose(backend.fft2(X[0]), np.fft.fft2(X[0]))
+    assert np.allclose(backend.fft2(X[0]), np.fft.fft2(X[0]))
+
+
+def test_named_backends():
+    """Test that the backends given by name are created once."""
+    assert fft.get_backend("numpy") is fft.get_backend("NumPy")
+    assert fft.get_backend(fft.get_backend("scipy")) is fft.get_backend("scipy")
+    assert fft.get_backend(None) is fft.get_backend(None)
+    with pytest.raises(ValueError):
+        fft.get_backend("unknown")
+
+    fft.register_backend("test", fft.get_numpy)
+    try:
+        backend = fft.get_backend("test")
+        assert fft.get_backend("test") is backend
+        fft.register_backend("test", fft.get_numpy)
+        assert fft.get_backend("test") is not backend
+    finally:
+        fft._backends.pop("test")
+
+
+def test_num_threads():
+    """Test setting the number of threads."""
+    n = fft.get_num_threads()
+    fft.set_num_threads(2)
+    try:
+        assert fft.get_num_threads() == 2
+        X = np.random.RandomState(42).rand(16, 16)
+        assert np.allclose(fft.get_backend("scipy").fft2(X), np.fft.fft2(X))
+    finally:
+        fft.set_num_threads(n)
+    with pytest.raises(ValueError):
+        fft.set_num_threads(0)
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+import io
+import json
+
+import numpy as np
+import pytest
+
+from pysteps import motion
+from pysteps.utils import profiling
+
+
+def _synthetic_fields(n=4, shape=(64, 64)):
+    # a Gaussian blob moving one pixel per time step in the x direction
+    Y, X = np.meshgrid(np.arange(shape[0]), np.arange(shape[1]), indexing="ij")
+    return np.stack([np.exp(-((X - 20.0 - t)**2 + (Y - 32.0)**2) / 50.0)
+                     for t in range(n)])
+
+
+def test_recording_sink():
+    """Test that the spans are recorded with their items and sizes."""
+    sink = profiling.get_sink("recording")
+    X = np.zeros((3, 4))
+    with profiling.span(sink, "outer", t=1) as sp:
+        sp.add(X, "not an array")
+        sp_ = profiling.span(sink, "inner").start()
+        sp_.stop()
+
+    assert [span["name"] for span in sink.spans] == ["inner", "outer"]
+    assert sink.spans[1]["t"] == 1
+    assert sink.spans[1]["shapes"] == [(3, 4)]
+    assert sink.spans[1]["nbytes"] == X.nbytes
+    assert sp.duration >= sp_.duration
+    assert sink.summary()["outer"][0] == 1
+
+
+def test_jsonl_sink():
+    """Test that the jsonl sink writes one JSON object per span."""
+    file = io.StringIO()
+    sink = profiling.get_sink("jsonl", file=file)
+    with profiling.span(sink, "a", t=np.int64(2)) as sp:
+        sp.add(np.zeros(5))
+
+    span = json.loads(file.getvalue())
+    assert span["name"] == "a"
+    assert span["t"] == 2
+    assert span["shapes"] == [[5]]
+
+
+def test_sink_by_name():
+    """Test the sinks created by name and the default sink."""
+    assert isinstance(profiling.get_sink(None), profiling.NullSink)
+    with pytest.raises(ValueError):
+        profiling.get_sink("unknown")
+    with pytest.raises(ValueError):
+        profiling.get_sink("jsonl")
+
+    sink = profiling.get_sink("recording")
+    profiling.set_default_sink(sink)
+    try:
+        with profiling.span(None, "a"):
+            pass
+    finally:
+        profiling.set_default_sink(None)
+    assert [span["name"] for span in sink.spans] == ["a"]
+
+
+def test_darts_spans():
+    """Test that the stages of DARTS are reported and do not change the
+    result."""
+    Z = _synthetic_fields(n=5)
+    kwargs = {"N_x":10, "N_y":10, "N_t":2, "verbose":False}
+
+    V = motion.get_method("darts")(Z, **kwargs)
+    sink = profiling.get_sink("recording")
+    V_p = motion.get_method("darts")(Z, profiler=sink, **kwargs)
+
+    assert np.array_equal(V, V_p)
+    assert [span["name"] for span in sink.spans] == \
+        ["darts.fft", "darts.y_vector", "darts.h_matrix", "darts.solve",
+         "darts"]
@@ -82,32 +82,152 @@ def iterate_ar_model(X, phi, EPS=None):
     Parameters
     ----------
     X : array_like
-      Three-dimensional array of shape (p,w,h) containing a time series of p
-      two-dimensional fields of shape (w,h). The fields are assumed to be in
-      ascending order by time, and the timesteps are assumed to be regular.
+      Array of shape (...,p,w,h) containing a time series of p two-dimensional
+      fields of shape (w,h). The fields are assumed to be in ascending order by
+      time, and the timesteps are assumed to be regular. Any leading dimensions
+      (e.g. ensemble members) are treated as independent time series that are
+      iterated simultaneously.
     phi : array_like
       Array of length p+1 specifying the parameters of the AR(p) model. The
       parameters are in ascending order by increasing time lag, and the last
       element is the parameter corresponding to the innovation term EPS.
     EPS : array_like
-      Optional perturbation field for the AR(p) process. If EPS is None, the
-      innovation term is not added.
+      Optional perturbation field for the AR(p) process. The shape of EPS must
+      be (...,w,h) with the same leading dimensions as X, or (w,h). If EPS is
+      None, the innovation term is not added.
+
+    Returns
+    -------
+    out : ndarray
+      Array of the same shape and data type as X, where the oldest field has
+      been dropped and the new field has been appended as the last element of
+      the time series.
 
     """
-    if X.shape[0] != len(phi)-1:
-      raise ValueError("dimension mismatch between X and phi: X.shape[0]=%d, len(phi)=%d" % (X.shape[0], len(phi)))
+    if len(X.shape) < 3:
+        raise ValueError("X must have at least three dimensions")
+
+    if X.shape[-3] != len(phi)-1:
+      raise ValueError("dimension mismatch between X and phi: X.shape[-3]=%d, len(phi)=%d" % (X.shape[-3], len(phi)))
 
-    if EPS is not None and EPS.shape != (X.shape[1], X.shape[2]):
+    if EPS is not None and EPS.shape != X.shape[:-3] + X.shape[-2:] and \
+       EPS.shape != X.shape[-2:]:
         raise ValueError("dimension mismatch between X and EPS: X.shape=%s, EPS.shape=%s" % (str(X.shape), str(EPS.shape)))
 
-    X_new = 0.0
+    # cast the parameters to the precision of X so that single-precision
+    # inputs are not promoted to double precision
+    phi = np.asarray(phi, dtype=np.result_type(X.real.dtype, np.float32))
 
     p = len(phi) - 1
 
-    for i in range(p):
-        X_new += phi[i] * X[-(i+1), :, :]
+    X_new = phi[0] * X[..., -1, :, :]
+    for i in range(1, p):
+        X_new += phi[i] * X[..., -(i+1), :, :]
 
     if EPS is not None:
         X_new += phi[-1] * EPS
 
-    return np.stack(list(X[1:, :, :]) + [X_new])
+    return np.concatenate([X[..., 1:, :, :], X_new[..., None, :, :]], axis=-3)
+
+def initialize_ar_state(X, copy=True):
+    """Initialize the state of an AR(p) model that is updated in place. The p
+    time lags are stored in a ring buffer, and each iteration overwrites the
+    oldest field with the new one instead of building a new array.
+
+    Parameters
+    ----------
+    X : array_like
+      Array of shape (...,p,w,h) containing a time series of p two-dimensional
+      fields of shape (w,h) in ascending order by time. Any leading dimensions
+      (e.g. ensemble members and cascade levels) are treated as independent
+      time series that are iterated simultaneously.
+    copy : bool
+      If False, the state uses X as its buffer, and X is modified by
+      iterate_ar_state.
+
+    Returns
+    -------
+    out : dict
+      The AR(p) state that can be supplied to iterate_ar_state and
+      get_ar_state_fields.
+
+    """
+    if len(X.shape) < 3:
+        raise ValueError("X must have at least three dimensions")
+
+    state = {}
+
+    state["X"]      = X.copy() if copy else X
+    state["newest"] = X.shape[-3] - 1
+    state["tmp"]    = None
+
+    return state
+
+def iterate_ar_state(state, phi, EPS=None):
+    """Apply an AR(p) model to the given state in place.
+
+    Parameters
+    ----------
+    state : dict
+      An AR(p) state returned by initialize_ar_state.
+    phi : array_like
+      Array of shape (...,p+1) specifying the parameters of the AR(p) model in
+      ascending order by increasing time lag, the last element being the
+      parameter corresponding to the innovation term EPS. The leading
+      dimensions of phi, if any, must match the trailing leading dimensions of
+      the state (e.g. a separate model for each cascade level).
+    EPS : array_like
+      Optional perturbation field for the AR(p) process. The shape of EPS must
+      be broadcastable to (...,w,h), where ... are the leading dimensions of
+      the state. If EPS is None, the innovation term is not added.
+
+    """
+    X = state["X"]
+    p = X.shape[-3]
+
+    phi = np.asarray(phi, dtype=np.result_type(X.real.dtype, np.float32))
+    if phi.shape[-1] != p+1:
+        raise ValueError("dimension mismatch between the state and phi: p=%d, phi.shape[-1]=%d" % (p, phi.shape[-1]))
+    phi = phi[..., None, None]
+
+    if state["tmp"] is None:
+        state["tmp"] = np.empty(X.shape[:-3] + X.shape[-2:], dtype=X.dtype)
+    tmp = state["tmp"]
+
+    # the oldest field is overwritten by the new one
+    i_new = (state["newest"] + 1) % p
+    X_new = X[..., i_new, :, :]
+
+    X_new *= phi[..., p-1, :, :]
+    for i in range(p-1):
+        np.multiply(X[..., (state["newest"]-i) % p, :, :], phi[..., i, :, :],
+                    out=tmp)
+        X_new += tmp
+
+    if EPS is not None:
+        np.multiply(EPS, phi[..., p, :, :], out=tmp)
+        X_new += tmp
+
+    state["newest"] = i_new
+
+def get_ar_state_fields(state, lag=None):
+    """Return the fields of the given AR(p) state.
+
+    Parameters
+    ----------
+    state : dict
+      An AR(p) state returned by initialize_ar_state.
+    lag : int
+      If given, return a view of the field at this time lag (0 = newest) with
+      shape (...,w,h). Otherwise return a copy of all fields in ascending order
+      by time with shape (...,p,w,h).
+
+    """
+    X = state["X"]
+    p = X.shape[-3]
+
+    if lag is not None:
+        return X[..., (state["newest"]-lag) % p, :, :]
+    else:
+        idx = [(state["newest"]-p+1+i) % p for i in range(p)]
+        return X[..., idx, :, :]
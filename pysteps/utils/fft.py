@@ -0,0 +1,258 @@
+"""Interface to the FFT libraries used in pysteps.
+
+The methods in this module return an FFT backend, i.e. an object that
+implements the following subset of the numpy.fft interface:
+
+  fft2, ifft2, rfft2, irfft2, fftn, ifftn, fftshift, ifftshift, fftfreq,
+  rfftfreq
+
+The available backends are 'numpy' (numpy.fft), 'scipy' (scipy.fft) and
+'pyfftw' (FFTW builders with plan caching). A backend can be obtained by name
+with get_backend or pysteps.utils.get_method, and the methods using FFTs in
+pysteps accept a backend object or its name as the fft_method argument. If no
+backend is specified, the first available one of 'pyfftw', 'scipy' and 'numpy'
+is used.
+
+Thread budget
+-------------
+The number of threads used by a single transform is set with set_num_threads
+and defaults to one. The transforms are often run concurrently, e.g. one per
+ensemble member when STEPS is parallelized with dask, and the total number of
+threads in use is then the number of concurrent workers multiplied by the
+number of threads per transform. This product should not exceed the number of
+available cores. As a rule of thumb, use num_workers*num_threads = number of
+cores, and prefer more threads per transform when the number of concurrent
+workers is small. The thread count is read when a transform is called, so it
+can be changed between runs without re-creating the backend.
+
+Plan caching
+------------
+The pyfftw backend plans each transform once for a given input shape, data
+type, axes and thread count and reuses the plan for subsequent calls. FFTW
+plans are not safe to execute concurrently, so the plans are cached separately
+for each thread and the planning itself is serialized with a lock. The FFTW
+wisdom accumulated by the planner can be persisted to disk with save_wisdom
+and restored with load_wisdom, or automatically by giving the wisdom_file
+argument to get_pyfftw. This makes the more expensive planner efforts (e.g.
+'FFTW_MEASURE') affordable across runs.
+"""
+
+import atexit
+import os
+import pickle
+import threading
+from types import SimpleNamespace
+import numpy as np
+
+_num_threads = 1
+_default_backend = None
+# the backends created by name, keyed by the name and the keyword arguments
+_named_backends = {}
+_planner_lock = threading.Lock()
+# the wisdom files for which saving at exit has been registered
+_wisdom_files = set()
+
+def get_num_threads():
+    """Return the number of threads used by a single FFT."""
+    return _num_threads
+
+def set_num_threads(n):
+    """Set the number of threads used by a single FFT. See the module
+    documentation for the thread budget.
+
+    Parameters
+    ----------
+    n : int
+        The number of threads. Must be at least one.
+
+    """
+    global _num_threads
+
+    if n < 1:
+        raise ValueError("the number of threads must be at least one")
+
+    _num_threads = int(n)
+
+def get_numpy(**kwargs):
+    """Return an FFT backend using numpy.fft. The transforms are always
+    single-threaded."""
+    import numpy.fft as numpy_fft
+
+    return _get_backend_namespace("numpy", numpy_fft.fft2, numpy_fft.ifft2,
+                                  numpy_fft.rfft2, numpy_fft.irfft2,
+                                  numpy_fft.fftn, numpy_fft.ifftn)
+
+def get_scipy(**kwargs):
+    """Return an FFT backend using scipy.fft. The number of workers used by
+    each transform is determined by get_num_threads."""
+    import scipy.fft as scipy_fft
+
+    def wrap(func):
+        def f(X, *args, **kwargs):
+            return func(X, *args, workers=_num_threads, **kwargs)
+        return f
+
+    return _get_backend_namespace("scipy", wrap(scipy_fft.fft2),
+                                  wrap(scipy_fft.ifft2), wrap(scipy_fft.rfft2),
+                                  wrap(scipy_fft.irfft2), wrap(scipy_fft.fftn),
+                                  wrap(scipy_fft.ifftn))
+
+def get_pyfftw(planner_effort="FFTW_ESTIMATE", wisdom_file=None, **kwargs):
+    """Return an FFT backend using the pyfftw builders. The plans are cached
+    for each thread, input shape, data type, axes and number of threads.
+
+    Parameters
+    ----------
+    planner_effort : str
+        The FFTW planner effort: 'FFTW_ESTIMATE', 'FFTW_MEASURE',
+        'FFTW_PATIENT' or 'FFTW_EXHAUSTIVE'.
+    wisdom_file : str
+        Optional file for persisting the FFTW wisdom. If the file exists, the
+        wisdom is loaded from it, and the accumulated wisdom is written into it
+        when the interpreter exits.
+
+    """
+    import pyfftw
+    import pyfftw.builders
+
+    if wisdom_file is not None:
+        if os.path.exists(wisdom_file):
+            load_wisdom(wisdom_file)
+        if os.path.abspath(wisdom_file) not in _wisdom_files:
+            _wisdom_files.add(os.path.abspath(wisdom_file))
+            atexit.register(save_wisdom, wisdom_file)
+
+    cache = threading.local()
+
+    def get_plan(name, X, axes, s):
+        if not hasattr(cache, "plans"):
+            cache.plans = {}
+
+        key = (name, X.shape, X.dtype.str, axes, s, _num_threads)
+        plan = cache.plans.get(key, None)
+        if plan is None:
+            builder = getattr(pyfftw.builders, name)
+            with _planner_lock:
+                if s is None:
+                    plan = builder(X, axes=axes, threads=_num_threads,
+                                   planner_effort=planner_effort)
+                else:
+                    plan = builder(X, s=s, axes=axes, threads=_num_threads,
+                                   planner_effort=planner_effort)
+            cache.plans[key] = plan
+
+        return plan
+
+    def wrap(name, default_axes):
+        # the multidimensional complex-to-real transforms of FFTW overwrite
+        # their input, so the input of irfft2 is copied
+        destroys_input = name == "irfft2"
+
+        def f(X, s=None, axes=default_axes):
+            X = np.array(X, copy=True) if destroys_input else np.asarray(X)
+            if axes is not None:
+                axes = tuple(axes)
+            if s is not None:
+                s = tuple(s)
+            # the plan reuses its output array, so the result is copied
+            return get_plan(name, X, axes, s)(X).copy()
+        return f
+
+    return _get_backend_namespace("pyfftw", wrap("fft2", (-2, -1)),
+                                  wrap("ifft2", (-2, -1)),
+                                  wrap("rfft2", (-2, -1)),
+                                  wrap("irfft2", (-2, -1)),
+                                  wrap("fftn", None), wrap("ifftn", None))
+
+def get_backend(fft_method=None, **kwargs):
+    """Return an FFT backend.
+
+    Parameters
+    ----------
+    fft_method : str or object
+        The name of the backend ('numpy', 'scipy' or 'pyfftw'), or a backend
+        object, which is returned as such. If None, return the default backend,
+        which is the first available one of 'pyfftw', 'scipy' and 'numpy'.
+
+    Other Parameters
+    ----------------
+    Keyword arguments passed to the backend initializer (e.g. get_pyfftw)
+    when the backend is given by name. The backend is created once for each
+    name and keyword arguments, and the same object is returned by the
+    subsequent calls, so that e.g. the plans of the pyfftw backend are reused.
+
+    Returns
+    -------
+    out : object
+        An FFT backend implementing the interface described in the module
+        documentation.
+
+    """
+    global _default_backend
+
+    if fft_method is None:
+        if _default_backend is None:
+            for name in ["pyfftw", "scipy", "numpy"]:
+                try:
+                    _default_backend = _backends[name]()
+                    break
+                except ImportError:
+                    pass
+        return _default_backend
+    elif isinstance(fft_method, str):
+        name = fft_method.lower()
+        if name not in _backends:
+            raise ValueError("unknown FFT method %s, the available methods are %s" % \
+                             (fft_method, str(list(_backends.keys()))))
+        key = (name, frozenset(kwargs.items()))
+        backend = _named_backends.get(key, None)
+        if backend is None:
+            backend = _backends[name](**kwargs)
+            _named_backends[key] = backend
+        return backend
+    else:
+        return fft_method
+
+def register_backend(name, initializer):
+    """Register an FFT backend so that it can be obtained by name with
+    get_backend.
+
+    Parameters
+    ----------
+    name : str
+        Name of the backend.
+    initializer : function
+        A function that takes keyword arguments and returns a backend
+        implementing the interface described in the module documentation.
+
+    """
+    _backends[name.lower()] = initializer
+
+    # the backends created with the previous initializer are not used
+    for key in list(_named_backends.keys()):
+        if key[0] == name.lower():
+            del _named_backends[key]
+
+def load_wisdom(filename):
+    """Load FFTW wisdom from the given file written by save_wisdom."""
+    import pyfftw
+
+    with open(filename, "rb") as f:
+        pyfftw.import_wisdom(pickle.load(f))
+
+def save_wisdom(filename):
+    """Write the FFTW wisdom accumulated in this process into the given file."""
+    import pyfftw
+
+    with _planner_lock:
+        wisdom = pyfftw.export_wisdom()
+    with open(filename, "wb") as f:
+        pickle.dump(wisdom, f)
+
+def _get_backend_namespace(name, fft2, ifft2, rfft2, irfft2, fftn, ifftn):
+    return SimpleNamespace(name=name, fft2=fft2, ifft2=ifft2, rfft2=rfft2,
+                           irfft2=irfft2, fftn=fftn, ifftn=ifftn,
+                           fftshift=np.fft.fftshift, ifftshift=np.fft.ifftshift,
+                           fftfreq=np.fft.fftfreq, rfftfreq=np.fft.rfftfreq)
+
+_backends = {"numpy":get_numpy, "scipy":get_scipy, "pyfftw":get_pyfftw}
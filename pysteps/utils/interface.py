@@ -2,10 +2,12 @@
 from . import conversion
 from . import transformation
 from . import dimension
+from . import fft
 
-def get_method(name):
-    """Return a callable function for the bandpass filter or decomposition method
-    corresponding to the given name.\n\
+def get_method(name, **kwargs):
+    """Return a callable function for the utility method corresponding to the
+    given name. For the FFT methods, return an FFT backend object initialized
+    with the given keyword arguments (see pysteps.utils.fft).\n\
 
     Conversion methods:
 
@@ -44,6 +46,18 @@ def get_method(name):
     |  upscale          | upscale the field                                      |
     +-------------------+--------------------------------------------------------+
 
+    FFT methods:
+
+    +-------------------+--------------------------------------------------------+
+    |     Name          |              Description                               |
+    +===================+========================================================+
+    |  numpy            | numpy.fft                                              |
+    +-------------------+--------------------------------------------------------+
+    |  scipy            | scipy.fft with multithreading                          |
+    +-------------------+--------------------------------------------------------+
+    |  pyfftw           | FFTW with plan caching and multithreading              |
+    +-------------------+--------------------------------------------------------+
+
     """
 
     if name is None:
@@ -51,6 +65,9 @@ def get_method(name):
 
     name = name.lower()
 
+    if name in ["numpy", "scipy", "pyfftw"]:
+        return fft.get_backend(name, **kwargs)
+
     def donothing(R, metadata, *args, **kwargs):
         return R.copy(), metadata.copy()
 
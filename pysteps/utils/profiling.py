@@ -0,0 +1,358 @@
+"""Instrumentation of the computations in pysteps.
+
+The methods of pysteps that consist of several stages (e.g. the STEPS nowcast,
+the extrapolation nowcast, the optical flow methods and the computation of the
+noise adjustment factors) report the time spent in each stage as named spans
+to a profiler sink. The sink is given as the profiler argument of the method,
+or it is set globally with set_default_sink. This allows finding performance
+regressions and tuning deployments without modifying the library code.
+
+A span is a dictionary with the following key-value pairs:
+
++-------------------+----------------------------------------------------------+
+|        Key        |                      Value                               |
++===================+==========================================================+
+|  name             | name of the span, e.g. 'steps.noise'                     |
++-------------------+----------------------------------------------------------+
+|  start            | start time of the span in seconds since the epoch        |
++-------------------+----------------------------------------------------------+
+|  duration         | duration of the span in seconds                          |
++-------------------+----------------------------------------------------------+
+|  shapes           | list of the shapes of the arrays processed in the span   |
++-------------------+----------------------------------------------------------+
+|  nbytes           | total size of the arrays processed in the span (bytes)   |
++-------------------+----------------------------------------------------------+
+
+In addition, a span can contain method-specific items, e.g. the time step t
+and the ensemble members of the STEPS nowcast.
+
+A sink is an object with the methods enter(name), which is called when a span
+starts, and record(span), which is called with the completed span. The
+following sinks are available:
+
++-------------------+----------------------------------------------------------+
+|     Name          |              Description                                 |
++===================+==========================================================+
+|  null             | discard the spans (the default)                          |
++-------------------+----------------------------------------------------------+
+|  logging          | write the spans into a logger of the logging module      |
++-------------------+----------------------------------------------------------+
+|  jsonl            | write the spans into a file as JSON lines                |
++-------------------+----------------------------------------------------------+
+|  cprofile         | run cProfile during the spans                            |
++-------------------+----------------------------------------------------------+
+|  recording        | store the spans into a list                              |
++-------------------+----------------------------------------------------------+
+
+The sinks can be called from several threads, e.g. when the members of a
+STEPS ensemble are computed with dask.
+
+A method given a sink by name creates the sink once per call with the default
+arguments. Only the null and logging sinks are useful this way. The jsonl sink
+needs the file argument, and the spans of the cprofile and recording sinks are
+read back from the sink object, so these must be created with get_sink (or
+their constructor) and passed as objects.
+"""
+
+import cProfile
+import json
+import logging
+import pstats
+import threading
+import time
+
+_default_sink = None
+
+class NullSink(object):
+    """A sink that discards the spans."""
+    def enter(self, name):
+        pass
+
+    def record(self, span):
+        pass
+
+class LoggingSink(object):
+    """A sink that writes the spans into a logger.
+
+    Parameters
+    ----------
+    logger : str or logging.Logger
+        The logger or its name.
+    level : int
+        The logging level of the messages.
+
+    """
+    def __init__(self, logger="pysteps", level=logging.INFO):
+        if isinstance(logger, str):
+            logger = logging.getLogger(logger)
+        self.logger = logger
+        self.level  = level
+
+    def enter(self, name):
+        pass
+
+    def record(self, span):
+        info = ", ".join(["%s=%s" % (key, str(value)) for key,value in span.items()
+                          if key not in ["name", "start", "duration"]])
+        self.logger.log(self.level, "%s: %.4f seconds (%s)", span["name"],
+                        span["duration"], info)
+
+class JSONLinesSink(object):
+    """A sink that writes each span into a file as a line containing a JSON
+    object.
+
+    Parameters
+    ----------
+    file : str or file-like
+        The name of the file or a file object opened for writing text. A file
+        given by name is opened for appending and closed by the close method.
+
+    """
+    def __init__(self, file):
+        if isinstance(file, str):
+            self.file = open(file, "a")
+            self._close = True
+        else:
+            self.file = file
+            self._close = False
+        self._lock = threading.Lock()
+
+    def enter(self, name):
+        pass
+
+    def record(self, span):
+        line = json.dumps(span, default=_to_json) + "\n"
+        with self._lock:
+            self.file.write(line)
+            self.file.flush()
+
+    def close(self):
+        """Close the file if it was opened by the sink."""
+        if self._close:
+            self.file.close()
+
+class CProfileSink(object):
+    """A sink that runs cProfile during the spans. The profiler is enabled
+    when the outermost span starts and disabled when it ends, so the
+    statistics contain the function calls made in the spans. Only the spans
+    of the thread that created the sink are profiled.
+
+    Parameters
+    ----------
+    names : list
+        Optional list of span names. If given, only the spans with these names
+        are profiled.
+
+    """
+    def __init__(self, names=None):
+        self.names   = names
+        self.profile = cProfile.Profile()
+        self._thread = threading.get_ident()
+        self._stack  = []
+
+    def enter(self, name):
+        if not self._is_profiled(name):
+            return
+        if len(self._stack) == 0:
+            self.profile.enable()
+        self._stack.append(name)
+
+    def record(self, span):
+        # spans that were not entered in this thread (e.g. spans received
+        # from worker processes) do not affect the profiler
+        if not self._is_profiled(span["name"]) or len(self._stack) == 0 or \
+           self._stack[-1] != span["name"]:
+            return
+        self._stack.pop()
+        if len(self._stack) == 0:
+            self.profile.disable()
+
+    def get_stats(self):
+        """Return the collected statistics as a pstats.Stats object."""
+        return pstats.Stats(self.profile)
+
+    def dump_stats(self, filename):
+        """Write the collected statistics into a file that can be read with
+        pstats."""
+        self.profile.dump_stats(filename)
+
+    def _is_profiled(self, name):
+        return threading.get_ident() == self._thread and \
+            (self.names is None or name in self.names)
+
+class RecordingSink(object):
+    """A sink that stores the spans into the list spans."""
+    def __init__(self):
+        self.spans = []
+
+    def enter(self, name):
+        pass
+
+    def record(self, span):
+        self.spans.append(span)
+
+    def summary(self):
+        """Return a dictionary containing the number of spans and their total
+        duration for each span name."""
+        summary = {}
+        for span in self.spans:
+            n,d = summary.get(span["name"], (0, 0.0))
+            summary[span["name"]] = (n + 1, d + span["duration"])
+
+        return summary
+
+class Span(object):
+    """A context manager that measures the duration of a block of code and
+    reports it to a sink. The duration is also available in the duration
+    attribute after the block has completed. Instead of a with statement, the
+    span can also be delimited by calling start and stop.
+
+    Parameters
+    ----------
+    sink : object
+        The sink returned by get_sink.
+    name : str
+        The name of the span.
+
+    Other Parameters
+    ----------------
+    Additional items of the span, e.g. the time step.
+
+    """
+    def __init__(self, sink, name, **info):
+        self.sink     = sink
+        self.name     = name
+        self.info     = info
+        self.shapes   = []
+        self.nbytes   = 0
+        self.duration = None
+
+    def __enter__(self):
+        self.sink.enter(self.name)
+        self._start   = time.time()
+        self._counter = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.duration = time.perf_counter() - self._counter
+        span = {"name":self.name, "start":self._start,
+                "duration":self.duration, "shapes":self.shapes,
+                "nbytes":self.nbytes}
+        span.update(self.info)
+        self.sink.record(span)
+
+        return False
+
+    def start(self):
+        """Start the span. Returns the span itself."""
+        return self.__enter__()
+
+    def stop(self):
+        """Complete the span and report it to the sink. If the code between
+        start and stop raises an exception, the span is not reported."""
+        self.__exit__(None, None, None)
+
+        return self
+
+    def add(self, *arrays):
+        """Add the sizes of the given arrays to the span. Objects that are not
+        arrays are ignored."""
+        for X in arrays:
+            if hasattr(X, "shape") and hasattr(X, "nbytes"):
+                self.shapes.append(tuple(X.shape))
+                self.nbytes += int(X.nbytes)
+
+        return self
+
+def span(profiler, name, **info):
+    """Return a Span for measuring a block of code in a with statement.
+
+    Parameters
+    ----------
+    profiler : str or object
+        A sink or its name. None uses the default sink. See get_sink.
+    name : str
+        The name of the span.
+
+    Other Parameters
+    ----------------
+    Additional items of the span, e.g. the time step.
+
+    """
+    return Span(get_sink(profiler), name, **info)
+
+def get_sink(profiler=None, **kwargs):
+    """Return a profiler sink.
+
+    Parameters
+    ----------
+    profiler : str or object
+        The name of the sink ('null', 'logging', 'jsonl', 'cprofile' or
+        'recording'), or a sink object, which is returned as such. If None,
+        return the default sink set with set_default_sink, which is initially
+        a NullSink.
+
+    Other Parameters
+    ----------------
+    Keyword arguments passed to the constructor of the sink when it is given
+    by name (e.g. file for 'jsonl'). The methods of pysteps that take the
+    profiler argument call get_sink without keyword arguments, so a sink
+    requiring them must be passed to these methods as an object.
+
+    Returns
+    -------
+    out : object
+        A sink implementing the interface described in the module
+        documentation.
+
+    """
+    global _default_sink
+
+    if profiler is None:
+        if _default_sink is None:
+            _default_sink = NullSink()
+        return _default_sink
+    elif isinstance(profiler, str):
+        try:
+            sink = _sinks[profiler.lower()]
+        except KeyError:
+            raise ValueError("unknown profiler sink %s, the available sinks are %s" % \
+                             (profiler, str(list(_sinks.keys()))))
+        try:
+            return sink(**kwargs)
+        except TypeError as e:
+            raise ValueError("the profiler sink %s cannot be created by name without arguments (%s), pass it as an object created with get_sink" % \
+                             (profiler, e))
+    else:
+        return profiler
+
+def set_default_sink(profiler, **kwargs):
+    """Set the sink used by the methods that are called without the profiler
+    argument.
+
+    Parameters
+    ----------
+    profiler : str or object
+        The sink or its name, see get_sink. None restores the NullSink.
+
+    Other Parameters
+    ----------------
+    Keyword arguments passed to the constructor of the sink when it is given
+    by name.
+
+    """
+    global _default_sink
+
+    _default_sink = get_sink(profiler, **kwargs) if profiler is not None else None
+
+def _to_json(obj):
+    # convert numpy scalars and other objects not supported by json
+    if hasattr(obj, "item"):
+        return obj.item()
+    elif isinstance(obj, (tuple, set)):
+        return list(obj)
+    else:
+        return str(obj)
+
+_sinks = {"null":NullSink, "logging":LoggingSink, "jsonl":JSONLinesSink,
+          "cprofile":CProfileSink, "recording":RecordingSink}